@@ -0,0 +1,197 @@
+# CronWeb and CronWeb-front
+# Copyright (C) 2021. Sonic Young.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""CronWeb远程agent
+连接到CronWeb的/api/agent/ws 接收任务在本机运行 并将输出和运行结果发回CronWeb
+
+python agent.py --url ws://127.0.0.1:8000/api/agent/ws --token xxx --labels gpu,linux --capacity 4
+"""
+import argparse
+import asyncio
+import codecs
+import locale
+import logging
+import socket
+import subprocess
+import typing
+
+import aiohttp
+
+import worker
+import worker.worker_aiosubprocess
+
+_py_logger = logging.getLogger('cronweb.agent')
+
+
+class Agent:
+    def __init__(self, url: str, token: str, name: str, labels: typing.List[str], capacity: int,
+                 work_dir: typing.Optional[str] = None, reconnect_max: float = 60):
+        self.url = url
+        self.token = token
+        self.name = name
+        self.labels = labels
+        self.capacity = capacity
+        self.reconnect_max = reconnect_max
+        # 复用本地worker的子进程启动逻辑(exec模式 执行参数等)
+        self._runner = worker.worker_aiosubprocess.AioSubprocessWorker(work_dir=work_dir)
+        self._runner.load_env()
+        self._procs: typing.Dict[str, typing.Any] = {}
+        # 收到过停止信号的任务
+        self._signaled: typing.Set[str] = set()
+        self.kill_grace = 1
+        # 任务结束后等待剩余输出的时间 后台子进程可能仍然持有stdout
+        self.output_grace = 5
+        self._tasks: typing.Set[asyncio.Task] = set()
+        self._ws: typing.Optional[aiohttp.ClientWebSocketResponse] = None
+        self._send_lock = asyncio.Lock()
+
+    async def _send(self, message: typing.Dict[str, typing.Any]):
+        async with self._send_lock:
+            await self._ws.send_json(message)
+
+    async def _run_task(self, message: typing.Dict[str, typing.Any]):
+        task_id = message['task_id']
+        try:
+            proc = await self._runner.create_process(message['command'], message['param'], message['uuid'],
+                                                     worker.JobOptions.from_dict(message.get('options')))
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            _py_logger.error('子进程启动失败 task_id:%s', task_id)
+            await self._send({'type': 'output', 'task_id': task_id, 'data': f'Start Failed: {e!r}\n'})
+            await self._send({'type': 'done', 'task_id': task_id, 'exit_code': -1})
+            return
+        self._procs[task_id] = proc
+        reader = asyncio.ensure_future(self._forward_output(task_id, proc))
+        waiter = asyncio.ensure_future(proc.wait())
+        exit_code = -1
+        usage = None
+        try:
+            await asyncio.wait([reader, waiter], return_when=asyncio.FIRST_COMPLETED)
+            if reader.done() and not reader.cancelled() and reader.exception() is not None:
+                # 读取输出失败时停止任务 避免子进程因管道写满而阻塞
+                proc.kill()
+            exit_code = await waiter
+            try:
+                # 被停止的任务其后台子进程可能仍然持有stdout 只等待很短的时间
+                await asyncio.wait_for(asyncio.shield(reader),
+                                       self.kill_grace if task_id in self._signaled else self.output_grace)
+            except asyncio.TimeoutError:
+                _py_logger.warning('任务结束后输出未关闭 task_id:%s', task_id)
+            except Exception as e:
+                _py_logger.error('读取输出失败 task_id:%s %r', task_id, e)
+                await self._send({'type': 'output', 'task_id': task_id, 'data': f'\nRead Failed: {e!r}\n'})
+                exit_code = -1
+            usage = getattr(proc, 'usage', None)
+        finally:
+            reader.cancel()
+            waiter.cancel()
+            self._procs.pop(task_id, None)
+            self._signaled.discard(task_id)
+            # 无论是否出错都发送结果 CronWeb收到后释放agent的容量
+            try:
+                await self._send({'type': 'done', 'task_id': task_id, 'exit_code': exit_code,
+                                  'usage': usage._asdict() if usage else None})
+            except Exception as e:
+                _py_logger.error('发送运行结果失败 task_id:%s %r', task_id, e)
+
+    async def _forward_output(self, task_id: str, proc: typing.Any):
+        """按块读取输出 每次读取到的内容作为一条消息发送."""
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding())(errors='replace')
+        while True:
+            chunk = await proc.stdout.read(worker.worker_aiosubprocess._READ_CHUNK_SIZE)
+            data = decoder.decode(chunk, final=not chunk)
+            if data:
+                await self._send({'type': 'output', 'task_id': task_id, 'data': data})
+            if not chunk:
+                break
+
+    def _spawn(self, message: typing.Dict[str, typing.Any]):
+        task = asyncio.ensure_future(self._run_task(message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _signal(self, message: typing.Dict[str, typing.Any]):
+        proc = self._procs.get(message.get('task_id'))
+        if proc is not None and proc.returncode is None:
+            self._signaled.add(message['task_id'])
+            proc.send_signal(message['signal'])
+
+    async def _kill_all(self):
+        """连接断开后CronWeb已将运行中的任务视为失败 停止它们避免与重试重复运行."""
+        for proc in list(self._procs.values()):
+            if proc.returncode is None:
+                proc.kill()
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=5)
+
+    async def _session(self, session: aiohttp.ClientSession):
+        async with session.ws_connect(self.url, heartbeat=30) as ws:
+            self._ws = ws
+            await self._send({'type': 'hello', 'token': self.token, 'name': self.name,
+                              'labels': self.labels, 'capacity': self.capacity})
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                message = msg.json()
+                if message.get('type') == 'welcome':
+                    _py_logger.info('已连接到CronWeb id:%s', message.get('id'))
+                elif message.get('type') == 'shoot':
+                    self._spawn(message)
+                elif message.get('type') == 'signal':
+                    self._signal(message)
+                elif message.get('type') == 'error':
+                    _py_logger.error('CronWeb拒绝连接 %s', message.get('message'))
+                    break
+
+    async def run(self):
+        wait_seconds = 1
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    await self._session(session)
+                    wait_seconds = 1
+                except aiohttp.ClientError as e:
+                    _py_logger.warning('连接CronWeb失败 %r', e)
+                finally:
+                    await self._kill_all()
+                _py_logger.info('%s秒后重新连接', wait_seconds)
+                await asyncio.sleep(wait_seconds)
+                wait_seconds = min(wait_seconds * 2, self.reconnect_max)
+
+    def stop(self):
+        self._runner.stop()
+
+
+async def main(args: argparse.Namespace):
+    agent = Agent(args.url, args.token, args.name, [label for label in args.labels.split(',') if label],
+                  args.capacity, args.work_dir)
+    try:
+        await agent.run()
+    finally:
+        agent.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CronWeb远程agent')
+    parser.add_argument('--url', required=True, help='CronWeb的agent地址 ws://host:port/api/agent/ws')
+    parser.add_argument('--token', required=True, help='与CronWeb配置中worker.agent_token一致')
+    parser.add_argument('--name', default=socket.gethostname(), help='agent名称')
+    parser.add_argument('--labels', default='', help='逗号分隔的标签')
+    parser.add_argument('--capacity', type=int, default=1, help='同时运行的任务数量上限')
+    parser.add_argument('--work-dir', dest='work_dir', default=None, help='任务的工作目录 默认为当前目录')
+    args_main = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    asyncio.run(main(args_main))
@@ -0,0 +1,70 @@
+"""日志写入吞吐量测试
+N个任务同时输出 对比每行写入一次aiofiles(每行一次线程池调用)和缓冲后批量writev两种方式每秒能记录的行数
+
+python benchmarks/bench_log_writer.py -s 200 -n 2000
+"""
+import argparse
+import asyncio
+import datetime
+import pathlib
+import sys
+import tempfile
+import time
+
+import aiofiles
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import logger  # noqa: E402
+import logger.logger_aio  # noqa: E402
+
+
+class PerLineLogger(logger.logger_aio.AioLogger):
+    """每行调用一次aiofiles写入的日志记录方式(不支持实时日志订阅)."""
+
+    async def _log_recording(self, queue: asyncio.Queue, path_log_file: pathlib.Path,
+                             now: datetime.datetime, timeout: float) -> None:
+        async with aiofiles.open(str(path_log_file), 'w', encoding='utf8') as afp:
+            await afp.write(f'{now}\n')
+            while True:
+                line = await asyncio.wait_for(queue.get(), timeout=timeout)
+                if line is logger.LogStop:
+                    break
+                await afp.write(line)
+            await afp.write(f'\n{datetime.datetime.now()}')
+
+
+async def shot(log: logger.logger_aio.AioLogger, index: int, lines: int, line: str):
+    queue, _ = log.get_log_queue('bench', f'shot{index}', 60)
+    for i in range(lines):
+        await queue.put(line)
+        if i % 100 == 0:
+            # 模拟子进程输出之间的间隔
+            await asyncio.sleep(0)
+    await queue.put(logger.LogStop)
+
+
+async def run(name: str, log: logger.logger_aio.AioLogger, shots: int, lines: int, line: str):
+    start = time.perf_counter()
+    await asyncio.gather(*(shot(log, i, lines, line) for i in range(shots)))
+    await asyncio.gather(*log.task_dict.values())
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed:.3f}s {shots * lines / elapsed:,.0f} lines/s')
+
+
+async def main(shots: int, lines: int, width: int):
+    line = 'x' * (width - 1) + '\n'
+    print(f'shots: {shots} lines per shot: {lines} line width: {width}')
+    with tempfile.TemporaryDirectory() as tmp:
+        await run('per-line aiofiles write', PerLineLogger(pathlib.Path(tmp) / 'per_line'), shots, lines, line)
+        await run('buffered batched writev', logger.logger_aio.AioLogger(pathlib.Path(tmp) / 'buffered'),
+                  shots, lines, line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='日志写入吞吐量测试')
+    parser.add_argument('-s', '--shots', type=int, default=200, help='同时运行的任务数')
+    parser.add_argument('-n', '--lines', type=int, default=2000, help='每个任务输出的行数')
+    parser.add_argument('-w', '--width', type=int, default=80, help='每行的字节数')
+    args = parser.parse_args()
+    asyncio.run(main(args.shots, args.lines, args.width))
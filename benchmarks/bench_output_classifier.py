@@ -0,0 +1,95 @@
+"""输出分类吞吐量测试
+生成随机的日志行 按_READ_CHUNK_SIZE切分成块(与worker读取stdout一致) 测量从块开始的完整处理路径每秒能处理的输出量
+对比切分行后逐个执行正则 切分行后执行合并的正则 以及_shoot中的指标查找+按块的字面量预过滤(可选保留最后几行)
+
+python benchmarks/bench_output_classifier.py -n 200000
+"""
+import argparse
+import collections
+import pathlib
+import random
+import re
+import sys
+import time
+import typing
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import worker.worker_aiosubprocess  # noqa: E402
+
+FAIL_PATTERNS = [r'Traceback \(most recent call last\)', r'\bERROR\b', r'FATAL', r'out of memory']
+WARN_PATTERNS = [r'\bWARN(ING)?\b', r'deprecated']
+WORDS = 'the quick brown fox jumps over lazy dog processing item rows batch done ok'.split()
+
+
+def make_lines(total: int, words: int) -> typing.List[bytes]:
+    random.seed(0)
+    return [(' '.join(random.choice(WORDS) for _ in range(words)) + '\n').encode('utf8') for _ in range(total)]
+
+
+def run(name: str, chunks: typing.List[bytes], feed: typing.Callable[[bytes], typing.Any],
+        finish: typing.Optional[typing.Callable[[], typing.Any]] = None):
+    size = sum(map(len, chunks))
+    start = time.perf_counter()
+    for chunk in chunks:
+        feed(chunk)
+    if finish is not None:
+        finish()
+    elapsed = time.perf_counter() - start
+    print(f'{name}: {elapsed:.3f}s {size / elapsed / 1e6:.1f} MB/s')
+
+
+def per_line(search: typing.Callable[[bytes], typing.Any]) -> typing.Callable[[bytes], typing.Any]:
+    splitter = worker.worker_aiosubprocess._LineSplitter()
+
+    def feed(chunk: bytes):
+        for line in splitter.feed(chunk):
+            search(line)
+    return feed
+
+
+def shoot_path(tail: bool) -> typing.Tuple[typing.Callable[[bytes], typing.Any], typing.Callable[[], typing.Any]]:
+    """与_shoot中处理每块输出的步骤相同 tail为True时相当于注册了接收上下文的hook."""
+    module = worker.worker_aiosubprocess
+    scanner = module._MetricScanner({})
+    classifier = module.OutputMatcher(FAIL_PATTERNS, WARN_PATTERNS).classifier()
+    splitter = module._LineSplitter() if tail else None
+    tail_lines: typing.Deque[bytes] = collections.deque(maxlen=20)
+
+    def feed(chunk: bytes):
+        scanner.feed(chunk)
+        classifier.feed(chunk)
+        if splitter is not None:
+            tail_lines.extend(splitter.feed(chunk))
+
+    def finish():
+        scanner.finish()
+        classifier.finish()
+        if splitter is not None:
+            tail_lines.extend(splitter.finish())
+    return feed, finish
+
+
+def main(total: int, words: int):
+    data = b''.join(make_lines(total, words))
+    size = worker.worker_aiosubprocess._READ_CHUNK_SIZE
+    chunks = [data[i:i + size] for i in range(0, len(data), size)]
+    print(f'lines: {total} bytes: {len(data)} chunks: {len(chunks)}')
+
+    regexes = [re.compile(pattern.encode('utf8')) for pattern in FAIL_PATTERNS + WARN_PATTERNS]
+    run('split lines + one regex per pattern', chunks,
+        per_line(lambda line: [regex.search(line) for regex in regexes]))
+
+    combined = worker.worker_aiosubprocess.OutputMatcher(FAIL_PATTERNS, WARN_PATTERNS).combined
+    run('split lines + combined regex', chunks, per_line(combined.regex.search))
+
+    run('metrics + chunked literal prefilter', chunks, *shoot_path(False))
+    run('metrics + chunked literal prefilter + tail lines', chunks, *shoot_path(True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='输出分类吞吐量测试')
+    parser.add_argument('-n', '--total', type=int, default=200000, help='行数')
+    parser.add_argument('-w', '--words', type=int, default=14, help='每行的单词数')
+    args = parser.parse_args()
+    main(args.total, args.words)
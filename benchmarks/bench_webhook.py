@@ -0,0 +1,86 @@
+"""webhook吞吐量测试
+在本地启动一个webhook桩服务 对比每次请求新建session和worker长连接session的吞吐量
+
+python benchmarks/bench_webhook.py -n 2000 -c 50
+"""
+import argparse
+import asyncio
+import pathlib
+import sys
+import time
+import typing
+
+import aiohttp
+import aiohttp.web
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import worker.worker_aiosubprocess  # noqa: E402
+
+
+async def start_stub_server(host: str, port: int) -> aiohttp.web.AppRunner:
+    async def handle(request: aiohttp.web.Request):
+        await request.read()
+        return aiohttp.web.json_response({'code': 0})
+
+    app = aiohttp.web.Application()
+    app.router.add_post('/hook', handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def webhook_new_session(url: str, payload: bytes):
+    """旧实现 每次请求新建session."""
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+        resp = await session.post(url, data=payload)
+        resp.close()
+
+
+async def run_on_hook_thread(hook_executor: worker.worker_aiosubprocess.HookExecutor,
+                             factory: typing.Callable[[int], typing.Coroutine],
+                             total: int, concurrency: int) -> float:
+    """在hook事件循环线程中以指定并发执行total次webhook 返回耗时."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await hook_executor.run_coroutine(factory(i), timeout=30)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return time.perf_counter() - start
+
+
+async def main(total: int, concurrency: int, host: str, port: int):
+    runner = await start_stub_server(host, port)
+    url = f'http://{host}:{port}/hook'
+    worker_inst = worker.worker_aiosubprocess.AioSubprocessWorker(webhook_url=url, webhook_secret='bench')
+    try:
+        # 预热
+        await run_on_hook_thread(worker_inst._hook_executor,
+                                 lambda i: webhook_new_session(url, b'{}'), 10, 1)
+        elapsed_new = await run_on_hook_thread(
+            worker_inst._hook_executor, lambda i: webhook_new_session(url, b'{}'), total, concurrency)
+        elapsed_pooled = await run_on_hook_thread(
+            worker_inst._hook_executor,
+            lambda i: worker_inst._webhook_post(b'{}'),
+            total, concurrency)
+    finally:
+        worker_inst.stop()
+        await runner.cleanup()
+
+    print(f'requests: {total} concurrency: {concurrency}')
+    print(f'new session per request: {elapsed_new:.3f}s {total / elapsed_new:.1f} req/s')
+    print(f'pooled keep-alive session: {elapsed_pooled:.3f}s {total / elapsed_pooled:.1f} req/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='webhook吞吐量测试')
+    parser.add_argument('-n', '--total', type=int, default=2000, help='请求总数')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='并发数')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+    asyncio.run(main(args.total, args.concurrency, args.host, args.port))
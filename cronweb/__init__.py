@@ -1,4 +1,5 @@
 import datetime
+import enum
 import functools
 
 import storage
@@ -12,8 +13,11 @@ import logging
 import logging.config
 import pathlib
 import os
+import signal
+import socket
 import sys
 import time
+from uuid import uuid4
 
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
@@ -26,7 +30,19 @@ else:
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
+class InstanceStateEnum(enum.IntEnum):
+    ACTIVE = 0
+    # 不再调度新的触发 等待运行中的任务结束
+    DRAINING = 1
+    STOPPED = 2
+
+
 class CronWeb:
+    # 定时触发认领记录的保留时间 单位:秒
+    _FIRES_KEEP = 7 * 86400
+    # 接收交接时向前多检查的时间 覆盖旧实例事件循环时间与系统时间的误差 已执行的触发由认领记录排除
+    _HANDOFF_MARGIN = 60
+
     def __init__(self,
                  log_expire_days: typing.Optional[int] = None,
                  dir_project: typing.Optional[typing.Union[str, pathlib.Path]] = None,
@@ -34,7 +50,16 @@ class CronWeb:
                  storage_instance: typing.Optional[storage.StorageBase] = None,
                  trigger_instance: typing.Optional[trigger.TriggerBase] = None,
                  web_instance: typing.Optional[web.WebBase] = None,
-                 aiolog_instance: typing.Optional[logger.LoggerBase] = None
+                 aiolog_instance: typing.Optional[logger.LoggerBase] = None,
+                 *,
+                 drain_timeout: float = 3600,
+                 heartbeat_interval: float = 10,
+                 handoff_window: float = 3600,
+                 handoff_catchup_max: int = 10,
+                 compress_existing_logs: bool = False,
+                 log_search: bool = True,
+                 log_search_batch_lines: int = 200,
+                 log_search_cpu_share: float = 0.1
                  ):
         super().__init__()
         self._worker: typing.Optional[worker.WorkerBase] = worker_instance
@@ -45,7 +70,33 @@ class CronWeb:
         self._py_logger: logging.Logger = logging.getLogger(f'cronweb.{self.__class__.__name__}')
         self._loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
         self._log_check_handle: typing.Optional[asyncio.TimerHandle] = None
+        # 下一次检查到期重试的定时器和时间(unix时间戳)
+        self._retry_handle: typing.Optional[asyncio.TimerHandle] = None
+        self._retry_next_due: typing.Optional[float] = None
         self._log_expire_days = log_expire_days or 30
+        # 启动后在后台按job设置压缩已有的未压缩日志
+        self.compress_existing_logs = compress_existing_logs
+        # 运行结束后在后台将日志按每log_search_batch_lines行一段写入全文索引
+        # 每写入一段后休眠 使建立索引的耗时占比不超过log_search_cpu_share
+        if not 0 < log_search_cpu_share <= 1:
+            raise ValueError('log_search_cpu_share must be in (0, 1]')
+        self.log_search_enabled = log_search
+        self.log_search_batch_lines = log_search_batch_lines
+        self.log_search_cpu_share = log_search_cpu_share
+        self._log_search_task: typing.Optional[asyncio.Task] = None
+        self._log_search_wakeup = asyncio.Event()
+        # 多个实例共用同一个storage时用于区分实例 排空和交接见drain
+        self.instance_id = uuid4().hex
+        self.drain_timeout = drain_timeout
+        self.heartbeat_interval = heartbeat_interval
+        # 只接收handoff_window秒内的交接 每个job最多补发handoff_catchup_max次触发
+        self.handoff_window = handoff_window
+        self.handoff_catchup_max = handoff_catchup_max
+        self._instance_registered = False
+        self._heartbeat_task: typing.Optional[asyncio.Task] = None
+        self._drain_task: typing.Optional[asyncio.Task] = None
+        # 排空的截止时间(unix时间戳) 未排空时为None
+        self._drain_deadline: typing.Optional[float] = None
 
         self.dir_project = pathlib.Path(dir_project).absolute() if dir_project else \
             pathlib.Path(__file__).parent.parent.absolute()
@@ -95,19 +146,34 @@ class CronWeb:
         return self._web.get_token()
 
     async def shoot(self, command: str, param: str, uuid: str, timeout: float, name: str,
-                    job_type: worker.JobTypeEnum = worker.JobTypeEnum.SCHEDULE) -> None:
-        """使用worker执行job."""
+                    job_type: worker.JobTypeEnum = worker.JobTypeEnum.SCHEDULE,
+                    options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                    attempt: int = 0, shot_id_root: typing.Optional[str] = None,
+                    fire_ts: typing.Optional[float] = None, run_id: typing.Optional[str] = None) -> None:
+        """使用worker执行job
+        fire_ts为定时触发的计划时间 不为None时先在storage中认领这次触发 已被其他实例认领时不执行
+        run_id为重试的分片运行
+        """
+        if fire_ts is not None and not await self._storage.fire_claim(uuid, round(fire_ts, 3), self.instance_id):
+            self._py_logger.info('定时触发已由其他实例执行 uuid:%s fire_ts:%s', uuid, fire_ts)
+            return None
         self._py_logger.info('分发任务到worker uuid:%s', uuid)
-        return await self._worker.shoot(command, param, uuid, timeout, name, job_type)
+        return await self._worker.shoot(command, param, uuid, timeout, name, job_type, options,
+                                        attempt=attempt, shot_id_root=shot_id_root, run_id=run_id)
 
     async def add_job(self, cron_exp: str, command: str, param: str,
-                      uuid: typing.Optional[str] = None, name: str = '') -> typing.Optional[trigger.JobInfo]:
+                      uuid: typing.Optional[str] = None, name: str = '',
+                      options: typing.Optional[typing.Dict[str, typing.Any]] = None
+                      ) -> typing.Optional[trigger.JobInfo]:
         """添加job 添加到trigger和storage 如果不指定uuid则自动创建uuid
         成功添加返回job info 失败(uuid已存在)返回None
+        options无效时抛出worker.JobOptionsError
         """
         self._py_logger.info('添加任务')
+        worker.JobOptions.from_dict(options)
         now = datetime.datetime.now()
-        job = self._trigger.add_job(cron_exp, command, param, str(now), uuid=uuid, name=name, active=1)
+        job = self._trigger.add_job(cron_exp, command, param, str(now), uuid=uuid, name=name, active=1,
+                                    options=options)
         if job is not None:
             await self._storage.save_job(job)
         return job
@@ -117,12 +183,16 @@ class CronWeb:
         return self._trigger.cron_is_valid(cron_exp)
 
     async def update_job(self, uuid: str, cron_exp: str, command: str, param: str,
-                         name: str = '') -> typing.Optional[trigger.JobInfo]:
+                         name: str = '',
+                         options: typing.Optional[typing.Dict[str, typing.Any]] = None
+                         ) -> typing.Optional[trigger.JobInfo]:
         """更新指定uuid的job 这项操作并不会停止正在运行的job 但是会从trigger和storage中更新
         成功更新返回job info 失败(uuid不存在)返回None
         """
         self._py_logger.info('更新任务')
-        job = self._trigger.update_job(cron_exp, command, param, uuid, name)
+        worker.JobOptions.from_dict(options)
+        now = datetime.datetime.now()
+        job = self._trigger.update_job(uuid, cron_exp, command, param, str(now), name, options)
         if job is not None:
             await self._storage.remove_job(uuid)
             await self._storage.save_job(job)
@@ -137,6 +207,7 @@ class CronWeb:
         if job is not None:
             await self._storage.remove_job(uuid)
             await self._storage.job_logs_set_deleted(uuid)
+            await self._storage.retry_remove_by_uuid(uuid)
         return job
 
     def trigger_job(self, uuid: str) -> typing.Optional[trigger.JobInfo]:
@@ -168,15 +239,20 @@ class CronWeb:
     def stop_all_trigger(self) -> typing.Dict[str, trigger.JobInfo]:
         """停止trigger中的所有任务
         但是并不从中删除(暂时不考虑写入数据库 用于停止后避免启动新进程)
+        之后通过API添加 更新或启用的任务只保存 不在这个实例启动定时触发
         """
         return self._trigger.stop_all()
 
     def get_log_queue(self, uuid: str, shot_id: str,
-                      timeout_log: float) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
+                      timeout_log: float,
+                      compress: typing.Optional[str] = None,
+                      log_path: typing.Optional[typing.Union[str, pathlib.Path]] = None
+                      ) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
         """获取对应uuid的日志queue实例
-        运行开始时间和结束时间由queue实例写入
+        运行开始时间和结束时间由queue实例写入 记录结束后按compress压缩日志文件
+        log_path不为None时在这个日志末尾继续记录
         """
-        return self._aiolog.get_log_queue(uuid, shot_id, timeout_log)
+        return self._aiolog.get_log_queue(uuid, shot_id, timeout_log, compress, log_path)
 
     async def stop_running_by_shot_id(self, shot_id: str) -> typing.Optional[str]:
         """通过shot_id结束正在运行的进程
@@ -192,14 +268,81 @@ class CronWeb:
         """通过uuid在storage中取出运行记录."""
         return await self._storage.job_logs_get_by_uuid(uuid)
 
-    async def job_log_get_by_shot_id(self, shot_id: str, limit_line: int = 1000) -> typing.Optional[str]:
-        """通过shot_id获取日志文件内容."""
+    async def job_logs_top_consumers(self, order_by: str = 'cpu', limit: int = 10,
+                                     days: typing.Optional[int] = None) -> typing.List[storage.UsageSummary]:
+        """按job汇总资源占用 返回占用最多的job
+        days不为None时只统计最近days天的运行记录
+        """
+        date_since = str(datetime.datetime.now() - datetime.timedelta(days=days)) if days else None
+        return await self._storage.job_logs_top_consumers(order_by, limit, date_since)
+
+    async def job_metrics_get(self, uuid: str, name: typing.Optional[str] = None,
+                              days: typing.Optional[int] = None,
+                              limit: int = 1000) -> typing.List[storage.MetricRecord]:
+        """job的指标时间序列 days不为None时只返回最近days天的指标."""
+        ts_since = time.time() - days * 86400 if days is not None else None
+        return await self._storage.job_metrics_get(uuid, name, ts_since, limit)
+
+    async def job_logs_durations(self, uuid: str, limit: int) -> typing.List[float]:
+        """job最近成功运行的时长(秒) 按开始时间升序."""
+        return await self._storage.job_logs_durations(uuid, limit)
+
+    def job_duration_stats(self, uuid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """job运行时长的估计(ewma和分位数)和当前的自适应超时 job未开启自适应超时或还未运行时返回None."""
+        job = self._trigger.get_jobs().get(uuid)
+        if job is None:
+            return None
+        return self._worker.get_duration_stats(uuid, worker.JobOptions.from_dict(job.options))
+
+    async def job_log_get_by_shot_id(self, shot_id: str, limit_line: int = 1000, offset: int = 0,
+                                     tail: typing.Optional[int] = None) -> typing.Optional[str]:
+        """通过shot_id获取日志文件内容 从第offset行开始的limit_line行 tail不为None时为最后tail行."""
         record = await self._storage.job_log_get_record(shot_id)
         if not record:
             return None
-        log_str = await self._aiolog.read_log_by_path(pathlib.Path(record.log_path), limit_line)
+        log_str = await self._aiolog.read_log_by_path(pathlib.Path(record.log_path), limit_line, offset, tail)
         return log_str
 
+    async def job_log_stream(self, shot_id: str,
+                             buffer_size: int = 1000) -> typing.Optional[typing.AsyncIterator[str]]:
+        """实时读取日志 先返回已有内容 运行中的任务继续返回新的输出直到运行结束
+        shot_id不存在返回None
+        """
+        record = await self._storage.job_log_get_record(shot_id)
+        if not record:
+            return None
+        return self._aiolog.stream_log(shot_id, pathlib.Path(record.log_path), buffer_size)
+
+    async def log_segment_get(self, shot_id: str) -> typing.Optional[typing.Tuple[int, int, int, int]]:
+        """日志内容在分段文件中的位置(分段编号, 起始字节, 长度, 之后的索引长度) 没有运行记录或还未写入分段文件时返回None."""
+        record = await self._storage.job_log_get_record(shot_id)
+        if record is None or record.log_segment is None:
+            return None
+        return record.log_segment, record.log_offset, record.log_length, record.log_index_length or 0
+
+    async def log_segment_set(self, shot_id: str, segment: int, offset: int, length: int,
+                              index_length: int = 0) -> bool:
+        """记录日志内容和行偏移索引在分段文件中的位置 运行记录已被删除时返回False."""
+        return await self._storage.job_log_set_segment(shot_id, segment, offset, length, index_length)
+
+    async def log_segment_get_records(self, segment: int) -> typing.List[storage.LogRecord]:
+        """日志内容在指定分段文件中的运行记录 用于压缩分段文件."""
+        return await self._storage.job_logs_get_by_segment(segment)
+
+    async def log_compress_existing(self) -> int:
+        """按job的log_compress设置逐个压缩已经结束运行的未压缩日志 返回压缩的文件数."""
+        jobs = self._trigger.get_jobs()
+        count = 0
+        for record in await self._storage.job_logs_get_all():
+            if record.state == worker.JobStateEnum.RUNNING.name:
+                continue
+            job = jobs.get(record.uuid)
+            compress = worker.JobOptions.from_dict(job.options).log_compress if job is not None else None
+            if await self._aiolog.compress_log(record.log_path, compress) is not None:
+                count += 1
+        self._py_logger.info('压缩%s个已有的日志文件', count)
+        return count
+
     async def stop_all_running_jobs(self) -> typing.Dict[str, str]:
         """停止worker所有运行中的job
         并返回成功结束的job {shot_id: uuid}
@@ -212,25 +355,319 @@ class CronWeb:
         """
         return self._worker.get_running_jobs()
 
-    async def set_job_done(self, shot_state: worker.JobState):
-        """将job状态设置为已结束(一般由worker设置)."""
+    async def set_job_done(self, shot_state: worker.JobState, webhook_payload: typing.Optional[str] = None):
+        """将job状态设置为已结束(一般由worker设置)
+        webhook_payload不为None时与运行记录一起写入webhook待投递队列
+        """
         self._py_logger.debug('任务执行结束 完成状态:%s uuid:%s', shot_state.state.name, shot_state.uuid)
-        await self._storage.job_log_done(shot_state)
+        await self._storage.job_log_done(shot_state, webhook_payload)
+        if self._log_search_active():
+            await self._storage.log_search_enqueue(shot_state.shot_id)
+            self._log_search_wakeup.set()
+
+    def _log_search_active(self) -> bool:
+        return self.log_search_enabled and self._storage.log_search_available
+
+    async def log_search(self, query: str, uuid: typing.Optional[str] = None,
+                         limit: int = 50) -> typing.List[storage.LogSearchHit]:
+        """搜索包含query的日志内容 返回shot_id 所在行和摘要 按运行时间降序."""
+        if not self._storage.log_search_available:
+            raise RuntimeError('log search is not supported by storage')
+        return await self._storage.log_search(query, uuid, limit)
+
+    async def _log_search_index(self):
+        """按加入顺序为等待中的日志建立全文索引 没有等待的日志时等待新的运行结束."""
+        while True:
+            self._log_search_wakeup.clear()
+            pending = await self._storage.log_search_pending(100)
+            if not pending:
+                await self._log_search_wakeup.wait()
+                continue
+            for shot_id, line in pending:
+                try:
+                    await self._log_search_index_shot(shot_id, line)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # 日志无法读取时放弃这个日志 避免反复重试
+                    self._py_logger.error('日志索引失败 shot_id:%s', shot_id)
+                    self._py_logger.exception(e)
+                    await self._storage.log_search_done(shot_id)
+
+    async def _log_search_index_shot(self, shot_id: str, line: int):
+        """从第line行开始继续为日志建立索引 每段写入后记录进度 重启后从中断处继续."""
+        record = await self._storage.job_log_get_record(shot_id)
+        if record is not None:
+            start = time.perf_counter()
+            async for content in self._aiolog.iter_log_lines(record.log_path, self.log_search_batch_lines, line):
+                line_next = line + content.count('\n') + (0 if content.endswith('\n') else 1)
+                await self._storage.log_search_add(shot_id, line, content, line_next)
+                line = line_next
+                elapsed = time.perf_counter() - start
+                await asyncio.sleep(elapsed * (1 - self.log_search_cpu_share) / self.log_search_cpu_share)
+                start = time.perf_counter()
+            self._py_logger.debug('日志索引完成 shot_id:%s 行数:%s', shot_id, line)
+        await self._storage.log_search_done(shot_id)
+
+    async def webhook_outbox_get_due(self, limit: int) -> typing.List[storage.OutboxEvent]:
+        """获取到达投递时间的webhook事件."""
+        return await self._storage.outbox_get_due(time.time(), limit)
+
+    async def webhook_outbox_done(self, event_ids: typing.List[int]):
+        """webhook事件投递成功 从队列中删除."""
+        await self._storage.outbox_remove(event_ids)
+
+    async def webhook_outbox_retry(self, event_ids: typing.List[int], next_try: float, error: str):
+        """webhook事件投递失败 等待下次投递."""
+        await self._storage.outbox_retry(event_ids, next_try, error)
+
+    async def get_webhook_stats(self) -> typing.Dict[str, typing.Any]:
+        """webhook投递状态
+        depth为待投递事件数 lag为最早的待投递事件已等待的秒数
+        """
+        depth, oldest = await self._storage.outbox_stats()
+        stats = {'depth': depth, 'lag': time.time() - oldest if oldest is not None else 0.0}
+        stats.update(self._worker.get_stats().get('webhook', {}))
+        return stats
+
+    def get_hook_stats(self) -> typing.Dict[str, typing.Any]:
+        """本地hook执行队列状态和每个hook的耗时分布."""
+        return self._worker.get_stats().get('hooks', {})
+
+    async def serve_agent(self, connection: typing.Any) -> None:
+        """处理远程agent的连接 直到连接断开."""
+        await self._worker.serve_agent(connection)
+
+    def get_agents(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """已连接的远程agent."""
+        return self._worker.get_stats().get('agents', [])
+
+    async def retry_schedule(self, uuid: str, shot_id_root: str, attempt: int, delay: float,
+                             run_id: typing.Optional[str] = None) -> storage.RetryRecord:
+        """安排delay秒后进行第attempt次重试(一般由worker调用) run_id为需要重试的分片运行."""
+        retry = await self._storage.retry_add(uuid, shot_id_root, attempt, time.time() + delay, run_id)
+        self._py_logger.info('安排重试 uuid:%s 第%s次 %s秒后', uuid, attempt, delay)
+        # 排空中的实例不再分发重试 由接管调度的实例执行
+        if self._drain_deadline is not None:
+            return retry
+        if self._retry_next_due is None or retry.date_due < self._retry_next_due:
+            self._timing_retry_at(retry.date_due)
+        return retry
+
+    async def retry_get_all(self) -> typing.List[storage.RetryRecord]:
+        return await self._storage.retry_get_all()
+
+    async def retry_cancel(self, retry_id: int) -> typing.Optional[storage.RetryRecord]:
+        """取消等待中的重试 不存在(或已经开始执行)返回None."""
+        retry = await self._storage.retry_remove(retry_id)
+        if retry is not None:
+            self._py_logger.info('取消重试 uuid:%s 第%s次', retry.uuid, retry.attempt)
+        return retry
+
+    async def run_start(self, uuid: str, shards: int) -> str:
+        """开始分片任务的一次运行 返回run_id."""
+        run_id = uuid4().hex
+        await self._storage.run_create(storage.RunRecord(run_id, uuid, worker.JobStateEnum.RUNNING.name, shards,
+                                                         str(datetime.datetime.now())))
+        return run_id
+
+    async def run_resume(self, run_id: str, shards: typing.List[str]) -> typing.Optional[typing.List[str]]:
+        """重试分片任务的一次运行 返回需要重新运行的分片(最近一次运行不成功的分片)
+        运行记录不存在时返回None
+        """
+        run = await self._storage.run_get(run_id)
+        if run is None:
+            return None
+        done = {rec.shard for rec in self._latest_shard_logs(await self._storage.job_logs_get_by_run_id(run_id))
+                if rec.state in self._SHARD_SUCCESS}
+        await self._storage.run_update(run_id, worker.JobStateEnum.RUNNING, None)
+        return [shard for shard in shards if shard not in done]
+
+    async def run_finish(self, run_id: str) -> worker.JobStateEnum:
+        """所有分片最近一次运行都成功(DONE或WARN)时运行状态为DONE 否则为ERROR."""
+        run = await self._storage.run_get(run_id)
+        latest = self._latest_shard_logs(await self._storage.job_logs_get_by_run_id(run_id))
+        state = worker.JobStateEnum.DONE
+        if len(latest) < run.shards or any(rec.state not in self._SHARD_SUCCESS for rec in latest):
+            state = worker.JobStateEnum.ERROR
+        await self._storage.run_update(run_id, state, str(datetime.datetime.now()))
+        self._py_logger.info('分片任务结束 run_id:%s state:%s', run_id, state.name)
+        return state
+
+    _SHARD_SUCCESS = (worker.JobStateEnum.DONE.name, worker.JobStateEnum.WARN.name)
+
+    @staticmethod
+    def _latest_shard_logs(records: typing.List[storage.LogRecord]) -> typing.List[storage.LogRecord]:
+        """每个分片最近一次的运行记录 records按开始时间升序."""
+        return list({rec.shard: rec for rec in records}.values())
+
+    async def runs_get_by_uuid(self, uuid: str, limit: int = 20) -> typing.List[storage.RunRecord]:
+        return await self._storage.runs_get_by_uuid(uuid, limit)
+
+    async def run_get_detail(self, run_id: str
+                             ) -> typing.Optional[typing.Tuple[storage.RunRecord, typing.List[storage.LogRecord]]]:
+        """分片运行记录和其中所有分片的运行记录."""
+        run = await self._storage.run_get(run_id)
+        if run is None:
+            return None
+        return run, await self._storage.job_logs_get_by_run_id(run_id)
+
+    async def run_retry(self, run_id: str) -> typing.Optional[trigger.JobInfo]:
+        """手动重试分片运行中失败的分片."""
+        run = await self._storage.run_get(run_id)
+        if run is None or run.state == worker.JobStateEnum.RUNNING.name:
+            return None
+        return self._trigger.trigger_retry(run.uuid, 0, None, run_id)
+
+    def _timing_retry_at(self, date_due: float):
+        if self._retry_handle is not None:
+            self._retry_handle.cancel()
+        self._retry_next_due = date_due
+        self._retry_handle = self._loop.call_at(
+            self._loop.time() + max(date_due - time.time(), 0),
+            self._timing_retry
+        )
+
+    def _timing_retry(self):
+        self._retry_handle = None
+        self._retry_next_due = None
+
+        def callback(ta: asyncio.Task):
+            err = ta.exception()
+            if err:
+                self._py_logger.exception(err)
+
+        asyncio.create_task(self._timing_retry_func()).add_done_callback(callback)
+
+    async def _timing_retry_func(self):
+        """分发到期的重试 与定时触发一样通过trigger执行 然后安排下一次检查."""
+        if self._drain_deadline is not None:
+            return
+        while True:
+            retries = await self._storage.retry_get_due(time.time(), 100)
+            for retry in retries:
+                # 先从storage中删除再分发 保证同一个重试只会执行一次
+                if await self._storage.retry_remove(retry.id) is None:
+                    continue
+                if self._trigger.trigger_retry(retry.uuid, retry.attempt, retry.shot_id_root, retry.run_id) is None:
+                    self._py_logger.warning('重试的任务已不存在 uuid:%s', retry.uuid)
+            if len(retries) < 100:
+                break
+        date_due = await self._storage.retry_next_due()
+        if date_due is not None and (self._retry_next_due is None or date_due < self._retry_next_due):
+            self._timing_retry_at(date_due)
 
     async def set_job_running(self, log_path: typing.Union[str, pathlib.Path], shot_state: worker.JobState):
         """将job状态设置为运行中(一般由worker设置) 返回log id."""
         self._py_logger.debug('任务开始执行 状态:%s uuid:%s', shot_state.state.name, shot_state.uuid)
-        await self._storage.job_log_shoot(log_path, shot_state)
+        await self._storage.job_log_shoot(log_path, shot_state, self.instance_id)
 
-    def add_job_done_hook(self, func: typing.Callable[[str, str, worker.JobStateEnum, worker.JobTypeEnum],
-                                                      typing.Awaitable[None]]):
+    async def drain(self, timeout: typing.Optional[float] = None) -> typing.Dict[str, typing.Any]:
+        """排空 用于不停机升级
+        不再调度新的定时触发和重试 运行中的任务继续运行 全部结束或超过timeout秒(默认drain_timeout)后退出
+        开始排空的时间作为交接时间写入storage 之后启动的实例从这个时间补发期间错过的定时触发
+        已经在运行的其他实例通过storage认领触发和重试 同一次触发只会执行一次
+        """
+        if self._drain_deadline is None:
+            now = time.time()
+            timeout = self.drain_timeout if timeout is None else timeout
+            self._drain_deadline = now + timeout
+            self._py_logger.warning('开始排空 最多等待%s秒 运行中的任务:%s', timeout, len(self.get_all_running_jobs()))
+            await self._storage.instance_set_state(self.instance_id, InstanceStateEnum.DRAINING.name, now)
+            self.stop_all_trigger()
+            if self._retry_handle is not None:
+                self._retry_handle.cancel()
+                self._retry_handle = None
+                self._retry_next_due = None
+            self._drain_task = asyncio.ensure_future(self._drain_wait())
+        return self.get_drain_status()
+
+    def get_drain_status(self) -> typing.Dict[str, typing.Any]:
+        return {'instance_id': self.instance_id, 'draining': self._drain_deadline is not None,
+                'deadline': self._drain_deadline, 'running': len(self.get_all_running_jobs())}
+
+    async def _drain_wait(self):
+        while self.get_all_running_jobs() and time.time() < self._drain_deadline:
+            await asyncio.sleep(1)
+        running = len(self.get_all_running_jobs())
+        self._py_logger.warning('排空结束 准备退出 未结束的任务:%s', running)
+        # 退出时停止剩余的任务
+        self._web.shutdown()
+
+    def _drain_signal(self):
+        self._py_logger.warning('收到SIGUSR1')
+        asyncio.ensure_future(self.drain())
+
+    async def get_instances(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """使用同一个storage的CronWeb实例 alive为实例是否仍在运行."""
+        now = time.time()
+        return [dict(instance._asdict(), alive=self._instance_alive(instance, now))
+                for instance in await self._storage.instances_get_all()]
+
+    def _instance_alive(self, instance: storage.InstanceRecord, now: float) -> bool:
+        return instance.state != InstanceStateEnum.STOPPED.name and \
+            now - instance.date_heartbeat <= self.heartbeat_interval * 3
+
+    async def _instances_alive_other(self) -> typing.Set[str]:
+        now = time.time()
+        return {instance.instance_id for instance in await self._storage.instances_get_all()
+                if instance.instance_id != self.instance_id and self._instance_alive(instance, now)}
+
+    async def _instance_register(self):
+        now = time.time()
+        await self._storage.instance_register(storage.InstanceRecord(
+            self.instance_id, socket.gethostname(), os.getpid(), InstanceStateEnum.ACTIVE.name, now, now))
+        self._instance_registered = True
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+    async def _heartbeat(self):
+        """定时更新心跳 并检查其他实例添加的重试."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self._storage.instance_heartbeat(self.instance_id, time.time())
+                if self._drain_deadline is not None:
+                    continue
+                date_due = await self._storage.retry_next_due()
+                if date_due is not None and (self._retry_next_due is None or date_due < self._retry_next_due):
+                    self._timing_retry_at(date_due)
+            except Exception as e:
+                self._py_logger.error('实例心跳更新失败')
+                self._py_logger.exception(e)
+
+    async def _handoff_catch_up(self):
+        """接收其他实例排空时留下的交接 补发交接时间之后错过的定时触发."""
+        now = time.time()
+        handoffs = [handoff for handoff in await self._storage.instances_take_handoff(self.instance_id)
+                    if now - handoff.date_drain <= self.handoff_window]
+        if not handoffs:
+            return
+        since = min(handoff.date_drain for handoff in handoffs) - self._HANDOFF_MARGIN
+        self._py_logger.info('接收%s个实例的调度交接 补发%s之后的定时触发', len(handoffs), datetime.datetime.fromtimestamp(since))
+        count = 0
+        for uuid, job in self._trigger.get_jobs().items():
+            if job.active != 1:
+                continue
+            for fire_ts in self._trigger.fire_times(uuid, since, now)[-self.handoff_catchup_max:]:
+                # 由shoot认领 已经执行过的触发不会重复执行
+                self._trigger.trigger_schedule(uuid, fire_ts)
+                count += 1
+        self._py_logger.info('检查%s次交接期间的定时触发', count)
+
+    def add_job_done_hook(self, func: typing.Callable[..., typing.Awaitable[None]]):
+        """添加job结束后执行的hook 以(name, shot_id, state, job_type)调用."""
         self._worker.add_job_done_hook(func)
 
-    async def job_check(self):
+    def add_job_done_context_hook(self, func: typing.Callable[..., typing.Awaitable[None]]):
+        """添加job结束后执行的hook 以worker.JobDoneContext调用."""
+        self._worker.add_job_done_context_hook(func)
+
+    async def job_check(self, adopt_orphans: bool = False):
         """对比trigger storage worker三者的job状态，并进行修正
         启动时会进行一次完成从storage到trigger的载入
         如果job存在于storage不在trigger 则 添加到trigger
         如果job存在于trigger不在storage 则 检查worker状态 并 添加到storage
+        adopt_orphans只在启动时为True 状态为RUNNING但不在worker中运行的记录 子进程仍在运行时由worker接管或停止
         """
         self._py_logger.info('检查任务一致性')
         jobs_trigger = self._trigger.get_jobs()
@@ -244,7 +681,7 @@ class CronWeb:
                 job = jobs_store[uuid]
                 self._trigger.add_job(job.cron_exp, job.command,
                                       job.param, job.date_create,
-                                      job.date_update, job.uuid, job.name, job.active)
+                                      job.date_update, job.uuid, job.name, job.active, job.options)
         loaded_uuid = uuid_trigger - uuid_store
         if loaded_uuid:
             # 这种情况可能不会出现
@@ -263,22 +700,32 @@ class CronWeb:
 
         running_job_storage = await self._storage.job_logs_get_by_state(worker.JobStateEnum.RUNNING)
         running_job_worker = self._worker.get_running_jobs()
-        shot_id_storage = {shot.shot_id: shot for shot in running_job_storage}
+        # 其他仍在运行的实例(例如排空中的旧实例)启动的任务由它们自己管理
+        instances_alive = await self._instances_alive_other()
+        shot_id_storage = {shot.shot_id: shot for shot in running_job_storage if shot.instance not in instances_alive}
         shot_id_worker = set(running_job_worker.keys())
         unstop_shot_id = shot_id_storage.keys() - shot_id_worker
         if unstop_shot_id:
             self._py_logger.info('更新job logs状态为RUNNING但是未在运行的记录')
+            updated = 0
             for shot_id in unstop_shot_id:
-                await self._storage.job_log_done(worker.JobState(running_job_worker[shot_id][0],
+                record = shot_id_storage[shot_id]
+                # 子进程仍在运行(例如CronWeb崩溃后重启)时由worker接管或停止 结束后由worker记录状态
+                job = jobs_store.get(record.uuid)
+                if adopt_orphans and await self._worker.adopt_orphan(record, job.name if job else ''):
+                    continue
+                await self._storage.job_log_done(worker.JobState(record.uuid,
                                                                  worker.JobStateEnum.UNKNOWN,
-                                                                 shot_id, shot_id_storage[shot_id].date_start))
-                self._py_logger.info('更新%s个运行状态错误的job log记录', len(unstop_shot_id))
+                                                                 shot_id, record.date_start))
+                updated += 1
+            self._py_logger.info('更新%s个运行状态错误的job log记录', updated)
 
     async def log_check(self):
         """检查数据库日志和日志文件一致性，并进行修正
-        数据库有日志记录 日志文件不存在时 删除日志记录
-        日志文件存在 数据库日志记录不存在时 不做操作
-        日志记录中uuid不存在于job_list时 删除日志
+        日志记录中uuid不存在于job_list时 删除日志记录
+        删除被标记为已删除的日志记录
+        日志文件存在 数据库日志记录不存在时 删除日志文件
+        数据库有日志记录 日志文件不存在时 不做操作(读取时返回None)
         """
         self._py_logger.info('检查日志一致性')
         log_all = await self._storage.job_logs_get_all()
@@ -302,7 +749,8 @@ class CronWeb:
         shot_id_set = {record.shot_id for record in log_records}
         log_files = self._aiolog.get_all_log_file_path()
         for file in log_files:
-            if file.stem.split('-')[1] not in shot_id_set:
+            # 文件名为{ts}-{shot_id}.log 压缩后的日志文件带有额外的后缀
+            if file.name.split('.')[0].split('-')[1] not in shot_id_set:
                 self._py_logger.debug('删除日志文件 %s', file)
                 try:
                     os.remove(file)
@@ -312,6 +760,12 @@ class CronWeb:
                     self._py_logger.exception(e)
         self._py_logger.info('清理掉%s个记录已标记为删除的日志文件', count)
 
+        if self._storage.log_search_available:
+            count = await self._storage.log_search_prune()
+            self._py_logger.info('清理掉%s段运行记录已删除的日志索引', count)
+
+        await self._aiolog.maintain()
+
     async def log_expire_check(self, expire_days: int):
         """检查数据库中所有日志记录
         将过期log设置为deleted
@@ -355,25 +809,64 @@ class CronWeb:
     async def _timing_check_func(self, log_expire_days):
         await self.log_expire_check(log_expire_days)
         await self.log_check()
+        before = time.time() - self._FIRES_KEEP
+        await self._storage.fires_prune(before)
+        await self._storage.instances_prune(before)
 
     async def stop(self):
         self._py_logger.info('停止各项功能 准备结束')
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+        if self._log_search_task is not None:
+            self._log_search_task.cancel()
         if self._log_check_handle is not None:
             self._py_logger.info('停止日志定时检查功能')
             self._log_check_handle.cancel()
+        if self._retry_handle is not None:
+            # 未执行的重试保存在storage中 下次启动后继续执行
+            self._py_logger.info('停止重试调度')
+            self._retry_handle.cancel()
+            self._retry_handle = None
         self._py_logger.info('停止所有任务')
         self.stop_all_trigger()
         self._py_logger.info('停止所有正在执行的任务')
         await self.stop_all_running_jobs()
         await self.job_check()
-        await self._storage.stop()
+        # worker的后台任务依赖storage 需要先停止
         self._worker.stop()
+        if self._instance_registered:
+            await self._storage.instance_set_state(self.instance_id, InstanceStateEnum.STOPPED.name)
+        await self._storage.stop()
 
     async def run(self, host: typing.Optional[str] = None,
                   port: typing.Optional[int] = None, **kwargs):
         self._py_logger.info('启动fastAPI')
         self._web.on_shutdown(self.stop)
-        # 先进行任务载入 检查日志时会用到已经载入的任务
-        await self.job_check()
+        await self._instance_register()
+        if sys.platform != 'win32':
+            self._loop.add_signal_handler(signal.SIGUSR1, self._drain_signal)
+        # 先进行任务载入 检查日志时会用到已经载入的任务 只在启动时接管遗留的子进程
+        await self.job_check(adopt_orphans=True)
+        await self._worker.start()
         self._timing_check(self._log_expire_days)
+        # 继续执行上次运行时未完成的重试
+        await self._timing_retry_func()
+        await self._handoff_catch_up()
+        if self._log_search_active():
+            # 继续上次运行时未完成的索引
+            def callback_search(ta: asyncio.Task):
+                if not ta.cancelled() and ta.exception():
+                    self._py_logger.exception(ta.exception())
+
+            self._log_search_task = asyncio.ensure_future(self._log_search_index())
+            self._log_search_task.add_done_callback(callback_search)
+        if self.compress_existing_logs:
+            def callback(ta: asyncio.Task):
+                err = ta.exception()
+                if err:
+                    self._py_logger.exception(err)
+
+            asyncio.ensure_future(self.log_compress_existing()).add_done_callback(callback)
         await self._web.start_server(host, port, **kwargs)
@@ -29,12 +29,43 @@ class LoggerBase(abc.ABC):
 
     @abc.abstractmethod
     def get_log_queue(self, uuid: str, shot_id: str,
-                      timeout_log: float) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
+                      timeout_log: float,
+                      compress: typing.Optional[str] = None,
+                      log_path: typing.Optional[typing.Union[str, pathlib.Path]] = None
+                      ) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
+        """compress为记录结束后日志文件的压缩方式 None为默认配置
+        log_path不为None时在已经结束记录的日志末尾继续记录(例如CronWeb重启后接管的任务)
+        """
         pass
 
     @abc.abstractmethod
     async def read_log_by_path(self, log_path: typing.Union[str, pathlib.Path],
-                               limit_line: int = 1000) -> typing.Optional[str]:
+                               limit_line: int = 1000, offset: int = 0,
+                               tail: typing.Optional[int] = None) -> typing.Optional[str]:
+        """读取日志从第offset行开始的limit_line行 tail不为None时读取最后tail行
+        日志文件已被压缩时log_path仍为原来的路径
+        """
+        pass
+
+    @abc.abstractmethod
+    def iter_log_lines(self, log_path: typing.Union[str, pathlib.Path],
+                       batch_lines: int = 1000, offset: int = 0) -> typing.AsyncIterator[str]:
+        """从第offset行开始按批读取日志 每批最多batch_lines行 日志文件不存在时不返回内容."""
+        pass
+
+    @abc.abstractmethod
+    async def compress_log(self, log_path: typing.Union[str, pathlib.Path],
+                           compress: typing.Optional[str] = None) -> typing.Optional[pathlib.Path]:
+        """压缩已经结束记录的日志文件 返回压缩后的路径 不需要压缩或已经压缩时返回None."""
+        pass
+
+    @abc.abstractmethod
+    def stream_log(self, shot_id: str, log_path: typing.Union[str, pathlib.Path],
+                   buffer_size: int = 1000) -> typing.AsyncIterator[str]:
+        """实时读取日志
+        先返回日志文件中已有的内容 正在记录的日志继续返回新写入的内容直到记录结束
+        buffer_size为每个订阅者最多缓存的行数 读取过慢超过缓存时结束读取
+        """
         pass
 
     @abc.abstractmethod
@@ -45,3 +76,7 @@ class LoggerBase(abc.ABC):
     def get_all_log_file_path(self) -> typing.List[pathlib.Path]:
         """获取所有日志文件的Path对象列表."""
         pass
+
+    async def maintain(self) -> None:
+        """每天检查日志一致性之后调用 用于回收日志占用的空间 默认不做操作."""
+        pass
@@ -1,61 +1,656 @@
 import os
+import io
+import gzip
+import mmap
+import shutil
+import struct
+import bisect
+import collections
+import codecs
 import functools
+import itertools
 import typing
 import pathlib
 import asyncio
 import datetime
-import aiofiles
+import logging
 import logger
 import cronweb
 
+try:
+    import zstandard
+except (ImportError, ModuleNotFoundError):
+    zstandard = None
+
+# 压缩后的日志文件在原文件名后加上的后缀
+_COMPRESS_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+# 行偏移索引文件在日志文件名后加上的后缀
+# 索引文件由文件头(INDEX_MAGIC和uint32的间隔stride)和uint64的偏移组成 第k个偏移为第k*stride行(从0开始)的起始字节
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'CWIX'
+_INDEX_HEADER = struct.Struct('<4sI')
+_INDEX_ENTRY = struct.Struct('<Q')
+# 压缩后的日志由多个独立的gzip member或zstd frame组成 每个frame约COMPRESS_FRAME_SIZE字节(未压缩)
+# 压缩后索引文件改为FRAME_INDEX_MAGIC开头 文件头中的uint32为frame大小 之后为每个从行首开始的frame的(行号, 压缩文件中的偏移)
+# 最后一项为(总行数, 压缩文件大小) 读取时从最近的frame开始解压
+FRAME_INDEX_MAGIC = b'CWIZ'
+COMPRESS_FRAME_SIZE = 1 << 20
+_FRAME_ENTRY = struct.Struct('<QQ')
+
+# 单次writev最多提交的缓冲区数量
+_IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+
+def _write_chunks(fd: int, chunks: typing.List[bytes]) -> int:
+    """将chunks按顺序完整写入fd 返回写入的字节数."""
+    total = 0
+    if not hasattr(os, 'writev'):
+        data = memoryview(b''.join(chunks))
+        while data:
+            written = os.write(fd, data)
+            total += written
+            data = data[written:]
+        return total
+    index = 0
+    while index < len(chunks):
+        written = os.writev(fd, chunks[index:index + _IOV_MAX])
+        total += written
+        # 跳过已经完整写入的部分 部分写入的缓冲区保留剩余部分
+        while index < len(chunks) and written >= len(chunks[index]):
+            written -= len(chunks[index])
+            index += 1
+        if written:
+            chunks[index] = chunks[index][written:]
+    return total
+
+
+def _compress_method(compress: typing.Optional[str]) -> typing.Optional[str]:
+    """auto为zstd(已安装zstandard时)或gzip 未安装zstandard时zstd也使用gzip none为不压缩."""
+    if compress is None or compress == 'none':
+        return None
+    if compress in ('auto', 'zstd'):
+        return 'zstd' if zstandard is not None else 'gzip'
+    return compress
+
+
+def _compress_frames(src: typing.BinaryIO, dst: typing.BinaryIO, method: str, level: typing.Optional[int],
+                     frame_size: int) -> typing.List[typing.Tuple[int, int]]:
+    """按frame_size字节分段压缩 分段尽量在换行处 返回每个从行首开始的frame的(行号, 偏移)和最后的(总行数, 大小)."""
+    if method == 'zstd':
+        compress = zstandard.ZstdCompressor(level=level or 3).compress
+    else:
+        compress = functools.partial(gzip.compress, compresslevel=level or 6, mtime=0)
+    entries = []
+    lines, line_start, carry = 0, True, b''
+    while True:
+        data = src.read(frame_size)
+        eof = not data
+        data = carry + data
+        if not data:
+            break
+        end = len(data) if eof else data.rfind(b'\n') + 1
+        if end == 0:
+            # 没有换行 超过frame_size后在行中间切分
+            if len(data) < frame_size:
+                carry = data
+                continue
+            end = len(data)
+        frame, carry = data[:end], data[end:]
+        if line_start:
+            entries.append((lines, dst.tell()))
+        dst.write(compress(frame))
+        lines += frame.count(b'\n')
+        line_start = frame.endswith(b'\n')
+        if eof:
+            break
+    # 最后一行没有换行时同样计为一行
+    entries.append((lines + (0 if line_start else 1), dst.tell()))
+    return entries
+
+
+def _compress_file(path: pathlib.Path, method: str, level: typing.Optional[int],
+                   frame_size: int = COMPRESS_FRAME_SIZE) -> pathlib.Path:
+    """压缩日志文件 先写入临时文件 完成后替换为压缩文件并删除原文件
+    行偏移索引替换为frame索引 压缩后的日志仍然可以从任意行附近开始读取
+    """
+    target = path.with_name(path.name + _COMPRESS_SUFFIXES[method])
+    tmp = target.with_name(target.name + '.tmp')
+    path_index = path.with_name(path.name + INDEX_SUFFIX)
+    tmp_index = path_index.with_name(path_index.name + '.tmp')
+    try:
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            entries = _compress_frames(src, dst, method, level, frame_size)
+        with open(tmp_index, 'wb') as fp_index:
+            fp_index.write(_INDEX_HEADER.pack(FRAME_INDEX_MAGIC, frame_size))
+            fp_index.write(b''.join(_FRAME_ENTRY.pack(*entry) for entry in entries))
+        os.replace(tmp, target)
+        os.replace(tmp_index, path_index)
+    except BaseException:
+        for path_tmp in (tmp, tmp_index):
+            if path_tmp.exists():
+                os.remove(path_tmp)
+        raise
+    os.remove(path)
+    return target
+
+
+def _read_frame_index(path_index: pathlib.Path) -> typing.List[typing.Tuple[int, int]]:
+    """读取压缩日志的frame索引 不存在或格式不正确时返回空列表."""
+    try:
+        with open(path_index, 'rb') as fp_index:
+            data = fp_index.read()
+        magic, _ = _INDEX_HEADER.unpack_from(data)
+    except (OSError, struct.error):
+        return []
+    if magic != FRAME_INDEX_MAGIC:
+        return []
+    body = memoryview(data)[_INDEX_HEADER.size:]
+    return list(_FRAME_ENTRY.iter_unpack(body[:len(body) - len(body) % _FRAME_ENTRY.size]))
+
+
+def _frame_start(entries: typing.List[typing.Tuple[int, int]], line: int) -> typing.Tuple[int, int]:
+    """第line行之前最近的frame 返回(frame开头的行号, 压缩文件中的偏移) 没有索引时从文件开头读取."""
+    if len(entries) < 2:
+        return 0, 0
+    k = bisect.bisect_right(entries, (line, float('inf')), hi=len(entries) - 1) - 1
+    return entries[max(k, 0)]
+
+
+def _decompress_file(path: pathlib.Path, target: pathlib.Path):
+    """将压缩的日志文件解压为target并删除压缩文件 用于在日志末尾继续记录."""
+    tmp = target.with_name(target.name + '.tmp')
+    try:
+        with _open_log(path) as src, open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp, target)
+    except BaseException:
+        if tmp.exists():
+            os.remove(tmp)
+        raise
+    os.remove(path)
+
+
+def _open_log(path: pathlib.Path, start: int = 0) -> typing.BinaryIO:
+    """以二进制流打开日志文件 压缩的日志文件边读边解压
+    start为开始读取的位置 压缩的日志文件需要是一个frame的开头
+    """
+    if path.suffix == '.zst' and zstandard is None:
+        raise OSError(f'zstandard is not installed, can not read {path}')
+    fp = open(path, 'rb')
+    fp.seek(start)
+    if path.suffix == '.zst':
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp, read_across_frames=True,
+                                                                           closefd=True))
+    if path.suffix == '.gz':
+        fp_gzip = gzip.GzipFile(fileobj=fp, mode='rb')
+        # 关闭时同时关闭文件
+        fp_gzip.myfileobj = fp
+        return fp_gzip
+    return fp
+
+
+def _read_lines(path: pathlib.Path, limit_line: int, offset: int = 0, tail: typing.Optional[int] = None) -> str:
+    """读取从第offset行开始的limit_line行 tail不为None时读取最后tail行
+    未压缩的日志文件通过mmap和行偏移索引读取 耗时与文件大小无关 压缩的日志文件边读边解压
+    """
+    if path.suffix != '.log':
+        # 与未压缩的日志一致 只按\n分行 从索引中最近的frame开始解压
+        entries = _read_frame_index(_path_index(path))
+        if tail is not None:
+            if tail <= 0:
+                return ''
+            line = max(entries[-1][0] - tail, 0) if entries else 0
+        else:
+            line = offset
+        line_frame, start = _frame_start(entries, line)
+        with _open_log(path, start) as fp:
+            if tail is not None:
+                lines = collections.deque(fp, maxlen=tail)
+            else:
+                lines = itertools.islice(fp, offset - line_frame, offset - line_frame + limit_line)
+            return b''.join(lines).decode('utf8', errors='replace')
+    with open(path, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size == 0 or (tail is not None and tail <= 0):
+            return ''
+        with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            if tail is not None:
+                start = _tail_start(mm, size, tail)
+                return mm[start:].decode('utf8', errors='replace')
+            start = _line_start(mm, size, path.with_name(path.name + INDEX_SUFFIX), offset)
+            if start is None:
+                return ''
+            return mm[start:_skip_lines(mm, size, start, limit_line)].decode('utf8', errors='replace')
+
+
+def _path_index(path: pathlib.Path) -> pathlib.Path:
+    """日志文件的索引文件 压缩后的日志文件与原文件使用同一个索引文件."""
+    name = path.name
+    for suffix in _COMPRESS_SUFFIXES.values():
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return path.with_name(name + INDEX_SUFFIX)
+
+
+def _skip_lines(mm: mmap.mmap, size: int, pos: int, lines: int) -> int:
+    """从pos开始跳过lines行 返回之后的位置 不足lines行时返回size."""
+    for _ in range(lines):
+        pos = mm.find(b'\n', pos, size)
+        if pos < 0:
+            return size
+        pos += 1
+    return pos
+
+
+def _tail_start(mm: mmap.mmap, size: int, lines: int, start: int = 0) -> int:
+    """[start, size)中最后lines行的起始位置 最后一个换行符之后没有内容时不计为一行."""
+    pos = size - 1 if mm[size - 1:size] == b'\n' else size
+    for _ in range(lines):
+        pos = mm.rfind(b'\n', start, pos)
+        if pos < 0:
+            return start
+    return pos + 1
+
+
+def _line_start(mm: mmap.mmap, size: int, path_index: pathlib.Path, line: int) -> typing.Optional[int]:
+    """第line行的起始位置 超出文件行数时返回None
+    通过索引找到之前最近的一个有记录的行 再向后查找 没有索引时从头查找
+    """
+    pos, line_found = 0, 0
+    try:
+        with open(path_index, 'rb') as fp_index:
+            magic, stride = _INDEX_HEADER.unpack(fp_index.read(_INDEX_HEADER.size))
+            count = (os.fstat(fp_index.fileno()).st_size - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+            if magic == INDEX_MAGIC and stride > 0 and count > 0:
+                # 正在记录的日志 索引可能比已写入的内容更新
+                for k in range(min(line // stride, count - 1), -1, -1):
+                    fp_index.seek(_INDEX_HEADER.size + k * _INDEX_ENTRY.size)
+                    entry, = _INDEX_ENTRY.unpack(fp_index.read(_INDEX_ENTRY.size))
+                    if entry <= size:
+                        pos, line_found = entry, k * stride
+                        break
+    except (OSError, struct.error):
+        pass
+    pos = _skip_lines(mm, size, pos, line - line_found)
+    return pos if pos < size else None
+
+
+def _open_lines(path: pathlib.Path, offset: int) -> typing.BinaryIO:
+    """以二进制流打开日志文件并定位到第offset行 未压缩的日志文件通过行偏移索引定位."""
+    if path.suffix != '.log':
+        line_frame, start = _frame_start(_read_frame_index(_path_index(path)), offset)
+        fp = _open_log(path, start)
+        collections.deque(itertools.islice(fp, offset - line_frame), maxlen=0)
+        return fp
+    fp = _open_log(path)
+    size = os.fstat(fp.fileno()).st_size
+    if size > 0 and offset > 0:
+        with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            start = _line_start(mm, size, path.with_name(path.name + INDEX_SUFFIX), offset)
+        fp.seek(size if start is None else start)
+    return fp
+
+
+class LogBuffer:
+    """一个正在记录的日志文件的写入缓冲
+    内容由日志记录task放入 由LogFlusher写入文件
+    """
+    __slots__ = ('fd', 'chunks', 'size', 'written', 'closing', 'waiters',
+                 'index_fd', 'index_chunks', 'index_stride', 'index_gap', 'offset')
+
+    def __init__(self, fd: int, index_fd: typing.Optional[int] = None, index_stride: int = 0):
+        self.fd = fd
+        self.chunks: typing.List[bytes] = []
+        # 缓冲中的字节数
+        self.size = 0
+        # 已经写入文件的字节数
+        self.written = 0
+        self.closing = False
+        # 等待下一次刷新完成的future
+        self.waiters: typing.List[asyncio.Future] = []
+        # 行偏移索引 每index_stride行记录一次行的起始位置 与日志内容一起写入
+        self.index_fd = index_fd
+        self.index_chunks: typing.List[bytes] = []
+        self.index_stride = index_stride
+        # 距离下一个需要记录的行还有多少个换行符
+        self.index_gap = index_stride
+        # 已经放入缓冲的总字节数
+        self.offset = 0
+        if index_fd is not None:
+            self.index_chunks.append(_INDEX_HEADER.pack(INDEX_MAGIC, index_stride) + _INDEX_ENTRY.pack(0))
+
+    def add_index(self, data: bytes):
+        """记录data中每index_stride行的起始位置."""
+        if self.index_fd is not None:
+            newlines = data.count(b'\n')
+            pos = -1
+            while newlines >= self.index_gap:
+                for _ in range(self.index_gap):
+                    pos = data.find(b'\n', pos + 1)
+                newlines -= self.index_gap
+                self.index_chunks.append(_INDEX_ENTRY.pack(self.offset + pos + 1))
+                self.index_gap = self.index_stride
+            self.index_gap -= newlines
+        self.offset += len(data)
+
+
+def _index_existing(buffer: LogBuffer, path: pathlib.Path):
+    """继续记录时 为日志文件中已有的内容建立行偏移索引."""
+    with open(path, 'rb') as fp:
+        while True:
+            chunk = fp.read(1 << 20)
+            if not chunk:
+                break
+            buffer.add_index(chunk)
+    buffer.written = buffer.offset
+
+
+class LogFlusher:
+    """所有日志文件共用的刷新task
+    每个日志文件的缓冲超过buffer_size或距上次刷新超过interval秒时刷新
+    一次刷新中所有日志文件的写入在同一次线程池调用中完成 每个文件一次writev
+    """
+
+    def __init__(self, buffer_size: int, interval: float):
+        self.buffer_size = buffer_size
+        self.interval = interval
+        self._dirty: typing.Set[LogBuffer] = set()
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._py_logger = logging.getLogger('cronweb.LogFlusher')
+
+    def _ensure_task(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def append(self, buffer: LogBuffer, content: str) -> bool:
+        """放入日志内容 缓冲超过buffer_size的4倍(写入跟不上)时返回True 调用者应等待flush."""
+        data = content.encode('utf8', errors='replace')
+        buffer.add_index(data)
+        buffer.chunks.append(data)
+        buffer.size += len(data)
+        self._dirty.add(buffer)
+        self._ensure_task()
+        if buffer.size >= self.buffer_size:
+            self._wakeup.set()
+        return buffer.size >= self.buffer_size * 4
+
+    async def flush(self, buffer: LogBuffer, close: bool = False):
+        """立即刷新缓冲 close为True时刷新后关闭文件."""
+        waiter = asyncio.get_event_loop().create_future()
+        buffer.waiters.append(waiter)
+        buffer.closing = buffer.closing or close
+        self._dirty.add(buffer)
+        self._ensure_task()
+        self._wakeup.set()
+        await waiter
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._dirty:
+                continue
+            batch = []
+            for buffer in self._dirty:
+                batch.append((buffer, (buffer.fd, buffer.chunks, buffer.index_fd, buffer.index_chunks, buffer.closing),
+                              buffer.waiters))
+                buffer.chunks, buffer.index_chunks, buffer.size, buffer.waiters = [], [], 0, []
+            self._dirty = set()
+            try:
+                results = await loop.run_in_executor(None, self._write_batch, [item for _, item, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (buffer, _, waiters), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self._py_logger.error('日志写入失败 %r', result)
+                else:
+                    buffer.written += result
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+
+    @staticmethod
+    def _write_batch(batch: typing.List[typing.Tuple[int, typing.List[bytes],
+                                                     typing.Optional[int], typing.List[bytes], bool]]
+                     ) -> typing.List[typing.Union[int, Exception]]:
+        """先写入日志内容再写入索引 读取时索引不会超前太多."""
+        results = []
+        for fd, chunks, index_fd, index_chunks, closing in batch:
+            try:
+                results.append(_write_chunks(fd, chunks) if chunks else 0)
+            except OSError as e:
+                results.append(e)
+            else:
+                try:
+                    if index_chunks:
+                        _write_chunks(index_fd, index_chunks)
+                except OSError:
+                    # 索引不完整时读取会从最后一个有效的位置向后查找
+                    pass
+            finally:
+                if closing:
+                    os.close(fd)
+                    if index_fd is not None:
+                        os.close(index_fd)
+        return results
+
+
+class LogSubscriber:
+    """实时日志的订阅者
+    由日志记录task将新写入的内容放入有界queue queue已满时不再放入并结束订阅
+    """
+    __slots__ = ('queue', 'position', 'registered', 'closed', 'lagged')
+
+    def __init__(self, buffer_size: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        # 开始订阅时日志文件已写入的字节数 之前的内容从文件中读取
+        self.position = 0
+        self.registered = asyncio.get_event_loop().create_future()
+        self.closed = False
+        self.lagged = False
+
+    def publish(self, line: typing.Any) -> bool:
+        """放入新写入的内容 queue已满时结束订阅并返回False."""
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.closed = True
+            self.lagged = line is not logger.LogStop
+            return False
+        return True
+
 
 class AioLogger(logger.LoggerBase):
+    # 从文件读取已有日志时每次读取的字节数
+    stream_chunk_size = 65536
+
     def __init__(self, log_dir: typing.Union[str, pathlib.Path],
-                 controller: typing.Optional[cronweb.CronWeb] = None):
+                 controller: typing.Optional[cronweb.CronWeb] = None,
+                 write_buffer_size: int = 65536,
+                 flush_interval: float = 0.5,
+                 compress: str = 'auto',
+                 compress_level: typing.Optional[int] = None,
+                 index_stride: int = 16):
         super().__init__(controller)
         self.log_dir = pathlib.Path(log_dir).absolute()
+        # 记录结束后日志文件的默认压缩方式 job options中的log_compress优先
+        if compress not in ('auto', 'zstd', 'gzip', 'none'):
+            raise ValueError(f'compress must be auto, zstd, gzip or none, not {compress}')
+        self.compress = compress
+        self.compress_level = compress_level
+        # 日志记录结束后的后台任务 持有引用避免task被回收
+        self._recorded_tasks: typing.Set[asyncio.Task] = set()
+        # 写入日志时每index_stride行记录一次行偏移 0为不建立索引
+        self.index_stride = index_stride
+        # 日志内容先放入每个日志文件的缓冲 按大小或时间批量写入文件
+        self._flusher = LogFlusher(write_buffer_size, flush_interval)
         self.task_dict: typing.Dict[str, asyncio.Task] = {}
+        # 正在记录的日志 {shot_id: 日志queue}
+        self.queue_dict: typing.Dict[str, asyncio.Queue] = {}
         if not self.log_dir.exists():
             self.log_dir.mkdir(parents=True)
 
     def get_log_queue(self, uuid: str, shot_id: str,
-                      timeout_log: float) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
+                      timeout_log: float,
+                      compress: typing.Optional[str] = None,
+                      log_path: typing.Optional[typing.Union[str, pathlib.Path]] = None
+                      ) -> typing.Tuple[asyncio.queues.Queue, pathlib.Path]:
         """获取日志记录的queue
+        log_path不为None时追加到这个日志文件末尾 已经压缩的日志文件先解压 记录结束后重新压缩
         返回 (日志记录的queue, 日志文件路径)
         """
         self._py_logger.debug('获取执行日志通道 uuid:%s', uuid)
         queue = asyncio.Queue()
         now = datetime.datetime.now()
-        file_name = f'{int(now.timestamp() * 1000)}-{shot_id}.log'
-        path_log_file = self.log_dir / file_name
-        task = asyncio.create_task(self._log_recording(queue, path_log_file, now, timeout_log))
+        if log_path is None:
+            file_name = f'{int(now.timestamp() * 1000)}-{shot_id}.log'
+            path_log_file = self.log_dir / file_name
+        else:
+            path_log_file = pathlib.Path(log_path)
+            file_name = path_log_file.name
+        task = asyncio.create_task(self._log_recording(queue, path_log_file, now, timeout_log,
+                                                       append=log_path is not None))
         task.add_done_callback(functools.partial(self._log_recording_cb, self.task_dict, file_name))
+        task.add_done_callback(lambda _: self.queue_dict.pop(shot_id, None))
+        task.add_done_callback(lambda _: self._log_recorded(path_log_file, compress))
         self.task_dict[file_name] = task
+        self.queue_dict[shot_id] = queue
         return queue, path_log_file
 
+    async def stream_log(self, shot_id: str, log_path: typing.Union[str, pathlib.Path],
+                         buffer_size: int = 1000) -> typing.AsyncIterator[str]:
+        subscriber = None
+        log_path = pathlib.Path(log_path)
+        queue = self.queue_dict.get(shot_id)
+        task = self.task_dict.get(log_path.name)
+        if queue is not None and task is not None and not task.done():
+            # 订阅请求与日志内容经过同一个queue 由记录task按顺序处理 保证文件内容和实时内容之间不重复不遗漏
+            subscriber = LogSubscriber(buffer_size)
+            queue.put_nowait(subscriber)
+            await subscriber.registered
+            if subscriber.closed:
+                # 订阅前记录已经结束
+                subscriber = None
+        log_path = self._resolve_log_path(log_path)
+        if log_path is None:
+            return
+        loop = asyncio.get_event_loop()
+        fp = await loop.run_in_executor(None, _open_log, log_path)
+        try:
+            remain = subscriber.position if subscriber is not None else None
+            decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+            while remain is None or remain > 0:
+                size = self.stream_chunk_size if remain is None else min(self.stream_chunk_size, remain)
+                chunk = await loop.run_in_executor(None, fp.read, size)
+                if not chunk:
+                    break
+                if remain is not None:
+                    remain -= len(chunk)
+                yield decoder.decode(chunk)
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+        finally:
+            fp.close()
+        if subscriber is None:
+            return
+        while not (subscriber.closed and subscriber.queue.empty()):
+            line = await subscriber.queue.get()
+            if line is logger.LogStop:
+                return
+            yield line
+        if subscriber.lagged:
+            yield '\n#### STREAM LAGGED ####\n'
+
     async def read_log_by_path(self, log_path: typing.Union[str, pathlib.Path],
-                               limit_line: int = 1000) -> typing.Optional[str]:
-        """根据path读取日志文件
+                               limit_line: int = 1000, offset: int = 0,
+                               tail: typing.Optional[int] = None) -> typing.Optional[str]:
+        """根据path读取日志文件 从第offset行开始读取limit_line行 tail不为None时读取最后tail行
+        未压缩的日志通过mmap和行偏移索引读取 压缩的日志文件边读边解压
         如果对应路径的日志文件不存在则返回None
         """
-        log_path = pathlib.Path(log_path)
-        if not log_path.exists() or log_path.is_dir():
+        resolved = self._resolve_log_path(log_path)
+        if resolved is None or resolved.is_dir():
             self._py_logger.error('log文件不存在 %s', log_path)
             return None
-        self._py_logger.debug('打开log文件 %s', log_path)
-        async with aiofiles.open(str(log_path), 'r', encoding='utf8 ') as afp:
-            raw: str = await afp.read()
-            lines = raw.splitlines(keepends=True)
-            if len(lines) > limit_line:
-                lines = lines[:limit_line]
-        return ''.join(lines)
+        self._py_logger.debug('打开log文件 %s', resolved)
+        return await asyncio.get_event_loop().run_in_executor(None, _read_lines, resolved, limit_line, offset, tail)
+
+    async def iter_log_lines(self, log_path: typing.Union[str, pathlib.Path],
+                             batch_lines: int = 1000, offset: int = 0) -> typing.AsyncIterator[str]:
+        """从第offset行开始 每次返回最多batch_lines行 读取过程中文件保持打开
+        每批在线程池中读取 压缩的日志文件只解压一遍
+        """
+        resolved = self._resolve_log_path(log_path)
+        if resolved is None or resolved.is_dir():
+            return
+        loop = asyncio.get_event_loop()
+        fp = await loop.run_in_executor(None, _open_lines, resolved, offset)
+        try:
+            while True:
+                lines = await loop.run_in_executor(None, lambda: b''.join(itertools.islice(fp, batch_lines)))
+                if not lines:
+                    break
+                # 每批都是完整的行 不会截断utf8字符
+                yield lines.decode('utf8', errors='replace')
+        finally:
+            fp.close()
+
+    @staticmethod
+    def _resolve_log_path(log_path: typing.Union[str, pathlib.Path]) -> typing.Optional[pathlib.Path]:
+        """日志文件的实际路径 压缩后的日志文件在原路径后加上压缩后缀 不存在时返回None."""
+        log_path = pathlib.Path(log_path)
+        if log_path.exists():
+            return log_path
+        for suffix in _COMPRESS_SUFFIXES.values():
+            path_compressed = log_path.with_name(log_path.name + suffix)
+            if path_compressed.exists():
+                return path_compressed
+        return None
+
+    async def _prepare_append(self, log_path: pathlib.Path):
+        """在日志末尾继续记录之前 将压缩的日志文件解压回原路径."""
+        resolved = self._resolve_log_path(log_path)
+        if resolved is not None and resolved != log_path:
+            await asyncio.get_event_loop().run_in_executor(None, _decompress_file, resolved, log_path)
+
+    def _log_recorded(self, log_path: pathlib.Path, compress: typing.Optional[str]):
+        """日志记录结束后在后台压缩日志文件."""
+        task = asyncio.ensure_future(self.compress_log(log_path, compress))
+        self._recorded_tasks.add(task)
+        task.add_done_callback(self._recorded_tasks.discard)
+
+    async def compress_log(self, log_path: typing.Union[str, pathlib.Path],
+                           compress: typing.Optional[str] = None) -> typing.Optional[pathlib.Path]:
+        """在线程池中压缩日志文件 compress为None时使用默认配置."""
+        method = _compress_method(compress or self.compress)
+        log_path = pathlib.Path(log_path)
+        if method is None or log_path.suffix != '.log' or not log_path.exists() or log_path.name in self.task_dict:
+            return None
+        try:
+            path_compressed = await asyncio.get_event_loop().run_in_executor(
+                None, _compress_file, log_path, method, self.compress_level)
+        except Exception as e:
+            self._py_logger.error('日志文件压缩失败 %s %r', log_path, e)
+            return None
+        self._py_logger.debug('日志文件已压缩 %s', path_compressed)
+        return path_compressed
 
     def remove_log_file(self, log_path: typing.Union[str, pathlib.Path]) -> typing.Optional[pathlib.Path]:
-        """根据path删除文件
+        """根据path删除文件 日志文件已被压缩时删除压缩后的文件 同时删除索引文件
         如果对应路径的文件不存在则返回None
         """
-        log_path = pathlib.Path(log_path)
-        if not log_path.exists() or log_path.is_dir():
+        path_index = pathlib.Path(f'{log_path}{INDEX_SUFFIX}')
+        if path_index.exists():
+            os.remove(path_index)
+        log_path = self._resolve_log_path(log_path)
+        if log_path is None or log_path.is_dir():
             return None
         os.remove(log_path)
         return log_path
@@ -64,8 +659,9 @@ class AioLogger(logger.LoggerBase):
         """获取所有日志文件的Path对象列表
         获取日志目录中所有日志文件路径
         由于是同步的 不适合过于频繁调用 仅作为检查过期日志时使用
+        包括压缩后的日志文件和索引文件 不包括正在压缩中的临时文件
         """
-        return list(self.log_dir.glob('*.log'))
+        return [path for path in self.log_dir.glob('*.log*') if not path.name.endswith('.tmp')]
 
     @staticmethod
     def _log_recording_cb(task_dict: typing.Dict[str, asyncio.Task], file_name: str,
@@ -77,22 +673,74 @@ class AioLogger(logger.LoggerBase):
         # 如果不手动获取异常 异常会在task对象销毁时传递给loop(异常发生的情况下)
         task.exception()
 
-    @staticmethod
-    async def _log_recording(queue: asyncio.queues.Queue,
+    async def _log_recording(self, queue: asyncio.queues.Queue,
                              path_log_file: typing.Union[str, pathlib.Path],
                              now: datetime.datetime,
-                             timeout: float) -> None:
-        """用于从queue中记录日志."""
-        async with aiofiles.open(str(path_log_file), 'w', encoding='utf8') as afp:
-            await afp.write(f'{now}\n')
+                             timeout: float,
+                             append: bool = False) -> None:
+        """用于从queue中记录日志
+        queue中的LogSubscriber为实时日志的订阅请求 之后写入的内容同时发送给订阅者
+        append为True时追加到已有的日志文件 不写入开始时间 索引文件重新建立
+        """
+        subscribers: typing.Set[LogSubscriber] = set()
+
+        def publish(content: typing.Any):
+            for sub in list(subscribers):
+                if not sub.publish(content):
+                    subscribers.discard(sub)
+
+        buffer = None
+        try:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+            loop = asyncio.get_event_loop()
+            if append:
+                await self._prepare_append(pathlib.Path(path_log_file))
+            flags_log = (flags & ~os.O_TRUNC) | os.O_APPEND if append else flags
+            fd = await loop.run_in_executor(None, os.open, str(path_log_file), flags_log, 0o644)
+            index_fd = None
+            if self.index_stride > 0:
+                try:
+                    index_fd = await loop.run_in_executor(None, os.open, f'{path_log_file}{INDEX_SUFFIX}', flags, 0o644)
+                except OSError as e:
+                    self._py_logger.warning('日志索引文件创建失败 %r', e)
+            buffer = LogBuffer(fd, index_fd, self.index_stride)
+            if append:
+                await loop.run_in_executor(None, _index_existing, buffer, pathlib.Path(path_log_file))
+            else:
+                self._flusher.append(buffer, f'{now}\n')
             while True:
                 try:
-                    line = await asyncio.wait_for(queue.get(), timeout=timeout)
-                except asyncio.TimeoutError:
-                    break
+                    # queue中已有内容时直接取出 只在需要等待时计算超时
+                    line = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    try:
+                        line = await asyncio.wait_for(queue.get(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        break
                 if line is logger.LogStop:
                     break
-                await afp.write(line)
-            await afp.write(f'\n{datetime.datetime.now()}')
+                if isinstance(line, LogSubscriber):
+                    # 订阅之前的内容从文件中读取 需要先写入文件
+                    await self._flusher.flush(buffer)
+                    line.position = buffer.written
+                    subscribers.add(line)
+                    line.registered.set_result(None)
+                    continue
+                if self._flusher.append(buffer, line):
+                    await self._flusher.flush(buffer)
+                publish(line)
+            end = f'\n{datetime.datetime.now()}'
+            self._flusher.append(buffer, end)
+            publish(end)
+        finally:
+            if buffer is not None:
+                await self._flusher.flush(buffer, close=True)
+            publish(logger.LogStop)
+            # 记录结束后仍在queue中的订阅请求
+            while not queue.empty():
+                line = queue.get_nowait()
+                if isinstance(line, LogSubscriber) and not line.registered.done():
+                    line.closed = True
+                    line.registered.set_result(None)
 
         return None
@@ -0,0 +1,397 @@
+import os
+import io
+import mmap
+import shutil
+import codecs
+import itertools
+import typing
+import pathlib
+import asyncio
+import cronweb
+from logger.logger_aio import (AioLogger, _skip_lines, _tail_start, INDEX_SUFFIX, INDEX_MAGIC,
+                               _INDEX_HEADER, _INDEX_ENTRY)
+
+# 分段文件的文件名为{编号}.seg
+SEGMENT_SUFFIX = '.seg'
+
+
+def _shot_id(log_path: typing.Union[str, pathlib.Path]) -> str:
+    """日志文件名为{ts}-{shot_id}.log."""
+    return pathlib.Path(log_path).name.split('.')[0].split('-')[1]
+
+
+class _ExtentReader(io.RawIOBase):
+    """只读取文件中[start, start+length)部分的原始流."""
+
+    def __init__(self, path: pathlib.Path, start: int, length: int):
+        super().__init__()
+        self._fp = open(path, 'rb')
+        self._fp.seek(start)
+        self._remain = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._remain)
+        if size <= 0:
+            return 0
+        read = self._fp.readinto(memoryview(buffer)[:size])
+        self._remain -= read
+        return read
+
+    def close(self):
+        self._fp.close()
+        super().close()
+
+
+def _extent_line_start(mm: mmap.mmap, begin: int, end: int, index_length: int, line: int) -> int:
+    """[begin, end)中第line行的起始位置 超出行数时返回end
+    日志内容之后的index_length字节为记录结束时的行偏移索引(偏移相对于begin) 从索引中之前最近的一行开始查找
+    """
+    pos, line_found = begin, 0
+    count = (index_length - _INDEX_HEADER.size) // _INDEX_ENTRY.size
+    if count > 0:
+        magic, stride = _INDEX_HEADER.unpack_from(mm, end)
+        if magic == INDEX_MAGIC and stride > 0:
+            k = min(line // stride, count - 1)
+            entry, = _INDEX_ENTRY.unpack_from(mm, end + _INDEX_HEADER.size + k * _INDEX_ENTRY.size)
+            if entry <= end - begin:
+                pos, line_found = begin + entry, k * stride
+    return _skip_lines(mm, end, pos, line - line_found)
+
+
+def _map_extent(fp: typing.BinaryIO, start: int, length: int) -> typing.Tuple[mmap.mmap, int]:
+    """mmap分段文件中[start, start+length)部分 返回(mmap, start在mmap中的位置)."""
+    # mmap的起始位置需要按ALLOCATIONGRANULARITY对齐
+    base = start - start % mmap.ALLOCATIONGRANULARITY
+    return mmap.mmap(fp.fileno(), start + length - base, access=mmap.ACCESS_READ, offset=base), start - base
+
+
+def _open_extent(path: pathlib.Path, start: int, length: int, index_length: int = 0,
+                 offset: int = 0) -> typing.BinaryIO:
+    """以二进制流打开分段文件中一次运行的日志内容 并跳过前offset行 有索引时通过索引定位."""
+    skip = 0
+    if offset > 0 and length > 0:
+        with open(path, 'rb') as fp:
+            mm, begin = _map_extent(fp, start, length + index_length)
+            with mm:
+                skip = _extent_line_start(mm, begin, begin + length, index_length, offset) - begin
+    return io.BufferedReader(_ExtentReader(path, start + skip, length - skip))
+
+
+def _read_extent_lines(path: pathlib.Path, start: int, length: int, index_length: int, limit_line: int,
+                       offset: int = 0, tail: typing.Optional[int] = None) -> str:
+    """读取分段文件中一次运行的日志从第offset行开始的limit_line行 tail不为None时读取最后tail行."""
+    if length <= 0 or (tail is not None and tail <= 0):
+        return ''
+    with open(path, 'rb') as fp:
+        mm, begin = _map_extent(fp, start, length + index_length)
+        with mm:
+            end = begin + length
+            if tail is not None:
+                return mm[_tail_start(mm, end, tail, begin):end].decode('utf8', errors='replace')
+            pos = _extent_line_start(mm, begin, end, index_length, offset)
+            if pos >= end:
+                return ''
+            return mm[pos:_skip_lines(mm, end, pos, limit_line)].decode('utf8', errors='replace')
+
+
+def _copy_stream(fp: typing.BinaryIO, path: pathlib.Path):
+    with open(path, 'wb') as dst:
+        shutil.copyfileobj(fp, dst, 1 << 20)
+
+
+class SegmentLogger(AioLogger):
+    """所有运行的日志追加写入同一组分段文件 避免每次运行一个日志文件
+    运行中的日志与AioLogger相同 写入log_dir/spool中的日志文件 支持实时日志和按行读取
+    记录结束后日志和行偏移索引依次追加到当前分段文件(log_dir/segments/{编号}.seg)末尾
+    在storage中记录(分段编号, 起始字节, 长度, 索引长度)后删除spool中的文件
+    当前分段文件超过segment_size字节后写入新的分段文件
+    运行记录被删除后内容仍留在分段文件中 maintain时有效内容占比低于compact_ratio的分段文件被压缩:
+    有效内容复制到只由压缩写入的分段文件并更新storage中的位置 然后删除原分段文件
+    分段文件不压缩 compress和job的log_compress不生效
+    """
+
+    def __init__(self, log_dir: typing.Union[str, pathlib.Path],
+                 controller: typing.Optional[cronweb.CronWeb] = None,
+                 segment_size: int = 256 * 1024 * 1024,
+                 compact_ratio: float = 0.5,
+                 fsync: bool = True,
+                 **kwargs):
+        log_dir = pathlib.Path(log_dir).absolute()
+        kwargs['compress'] = 'none'
+        super().__init__(log_dir / 'spool', controller, **kwargs)
+        self.segment_dir = log_dir / 'segments'
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        # 写入分段文件后同步到磁盘再删除spool中的文件
+        self.fsync = fsync
+        # 同一时间只有一个写入分段文件的操作 当前分段文件编号在第一次写入时确定
+        self._segment_lock = asyncio.Lock()
+        self._segment_current: typing.Optional[int] = None
+        if not self.segment_dir.exists():
+            self.segment_dir.mkdir(parents=True)
+
+    def get_all_log_file_path(self) -> typing.List[pathlib.Path]:
+        """spool中的日志文件和切换到分段日志之前log_dir中的日志文件 不包括分段文件
+        运行记录删除后切换前的日志文件也在检查日志时删除
+        """
+        return super().get_all_log_file_path() + [
+            path for path in self.log_dir.parent.glob('*.log*') if not path.name.endswith('.tmp')]
+
+    def _segment_path(self, segment: int) -> pathlib.Path:
+        return self.segment_dir / f'{segment:010d}{SEGMENT_SUFFIX}'
+
+    def _segments(self) -> typing.List[int]:
+        return sorted(int(path.stem) for path in self.segment_dir.glob(f'*{SEGMENT_SUFFIX}') if path.stem.isdigit())
+
+    def _segment_append(self, *parts: typing.Tuple[pathlib.Path, int, typing.Optional[int]]
+                        ) -> typing.Tuple[int, int, typing.List[int]]:
+        """将每个(文件, 起始字节, 长度)中的内容依次追加到当前分段文件 长度为None时到文件末尾
+        返回(分段编号, 起始字节, 每部分的长度) 在线程池中调用 调用时需要持有_segment_lock
+        """
+        if self._segment_current is None:
+            self._segment_current = max(self._segments(), default=0)
+        path_segment = self._segment_path(self._segment_current)
+        if path_segment.exists() and path_segment.stat().st_size >= self.segment_size:
+            self._segment_current += 1
+            path_segment = self._segment_path(self._segment_current)
+        offset, lengths = self._append_parts(path_segment, *parts)
+        return self._segment_current, offset, lengths
+
+    def _append_parts(self, path_segment: pathlib.Path, *parts: typing.Tuple[pathlib.Path, int, typing.Optional[int]]
+                      ) -> typing.Tuple[int, typing.List[int]]:
+        """将parts的内容依次追加到path_segment 返回(起始字节, 每部分的长度)."""
+        lengths = []
+        with open(path_segment, 'ab') as dst:
+            offset = os.fstat(dst.fileno()).st_size
+            for path_src, start, length in parts:
+                with open(path_src, 'rb') as src:
+                    if length is None:
+                        length = os.fstat(src.fileno()).st_size - start
+                    src.seek(start)
+                    remain = length
+                    while remain > 0:
+                        data = src.read(min(remain, 1 << 20))
+                        if not data:
+                            raise EOFError(f'{path_src} is shorter than expected')
+                        dst.write(data)
+                        remain -= len(data)
+                lengths.append(length)
+            dst.flush()
+            if self.fsync:
+                os.fsync(dst.fileno())
+        return offset, lengths
+
+    async def _reserve_segment(self) -> int:
+        """分配一个只由压缩写入的分段文件编号 之后的日志写入编号更大的分段文件."""
+        async with self._segment_lock:
+            if self._segment_current is None:
+                self._segment_current = max(self._segments(), default=0)
+            reserved = self._segment_current + 1
+            self._segment_current = reserved + 1
+        return reserved
+
+    async def _prepare_append(self, log_path: pathlib.Path):
+        """在日志末尾继续记录之前 已经写入分段文件的日志复制回spool 记录结束后作为新的一段写入分段文件."""
+        if log_path.exists() or self._core is None:
+            return
+        fp = await self._read_segment(log_path, _open_extent)
+        if fp is None:
+            return
+        try:
+            # 只复制日志内容 索引在继续记录时重新建立
+            await asyncio.get_event_loop().run_in_executor(None, _copy_stream, fp, log_path)
+        finally:
+            fp.close()
+
+    def _log_recorded(self, log_path: pathlib.Path, compress: typing.Optional[str]):
+        """日志记录结束后在后台写入分段文件."""
+        task = asyncio.ensure_future(self.seal_log(log_path))
+        self._recorded_tasks.add(task)
+        task.add_done_callback(self._recorded_tasks.discard)
+
+    async def seal_log(self, log_path: typing.Union[str, pathlib.Path]
+                       ) -> typing.Optional[typing.Tuple[int, int, int, int]]:
+        """将已经结束记录的spool日志文件和行偏移索引写入分段文件 返回(分段编号, 起始字节, 长度, 索引长度)
+        写入失败时保留spool中的文件
+        """
+        log_path = pathlib.Path(log_path)
+        if self._core is None or not log_path.exists() or log_path.name in self.task_dict:
+            return None
+        shot_id = _shot_id(log_path)
+        path_index = log_path.with_name(log_path.name + INDEX_SUFFIX)
+        parts = [(log_path, 0, None)]
+        if path_index.exists():
+            parts.append((path_index, 0, None))
+        loop = asyncio.get_event_loop()
+        try:
+            # 写入分段文件和在storage中记录位置之间不能压缩这个分段文件
+            async with self._segment_lock:
+                segment, offset, lengths = await loop.run_in_executor(None, self._segment_append, *parts)
+                extent = (segment, offset, lengths[0], sum(lengths[1:]))
+                if not await self._core.log_segment_set(shot_id, *extent):
+                    self._py_logger.warning('运行记录不存在 分段文件中的日志将在压缩时回收 shot_id:%s', shot_id)
+        except Exception as e:
+            self._py_logger.error('日志写入分段文件失败 %s %r', log_path, e)
+            return None
+        # storage中已经记录了位置 之后的读取从分段文件中读取
+        self.remove_log_file(log_path)
+        self._py_logger.debug('日志已写入分段文件 shot_id:%s %s', shot_id, extent)
+        return extent
+
+    async def _read_segment(self, log_path: typing.Union[str, pathlib.Path],
+                            func: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        """在线程池中用func(分段文件路径, 起始字节, 长度, 索引长度, *args)读取日志 不存在时返回None
+        读取时分段文件可能刚被压缩删除 重新获取位置后再读取一次
+        """
+        shot_id = _shot_id(log_path)
+        loop = asyncio.get_event_loop()
+        for retry in range(2):
+            extent = await self._core.log_segment_get(shot_id)
+            if extent is None:
+                return None
+            segment, start, length, index_length = extent
+            try:
+                return await loop.run_in_executor(None, func, self._segment_path(segment), start, length,
+                                                  index_length, *args)
+            except FileNotFoundError:
+                if retry:
+                    raise
+        return None
+
+    async def read_log_by_path(self, log_path: typing.Union[str, pathlib.Path],
+                               limit_line: int = 1000, offset: int = 0,
+                               tail: typing.Optional[int] = None) -> typing.Optional[str]:
+        """运行中或还未写入分段文件的日志从spool中读取 其余从分段文件中读取 读取分段文件时通过一起写入的索引查找offset
+        切换到分段日志之前的日志文件仍然可以读取
+        """
+        if self._resolve_log_path(log_path) is not None:
+            try:
+                return await super().read_log_by_path(log_path, limit_line, offset, tail)
+            except FileNotFoundError:
+                # 读取时刚好写入分段文件
+                pass
+        log_str = await self._read_segment(log_path, _read_extent_lines, limit_line, offset, tail)
+        if log_str is None:
+            self._py_logger.error('log不存在 %s', log_path)
+        return log_str
+
+    async def stream_log(self, shot_id: str, log_path: typing.Union[str, pathlib.Path],
+                         buffer_size: int = 1000) -> typing.AsyncIterator[str]:
+        if shot_id in self.queue_dict or self._resolve_log_path(log_path) is not None:
+            empty = True
+            async for content in super().stream_log(shot_id, log_path, buffer_size):
+                empty = False
+                yield content
+            if not empty or self._resolve_log_path(log_path) is not None:
+                return
+        fp = await self._read_segment(log_path, _open_extent)
+        if fp is None:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+            while True:
+                chunk = await loop.run_in_executor(None, fp.read, self.stream_chunk_size)
+                if not chunk:
+                    break
+                yield decoder.decode(chunk)
+            tail = decoder.decode(b'', final=True)
+            if tail:
+                yield tail
+        finally:
+            fp.close()
+
+    async def iter_log_lines(self, log_path: typing.Union[str, pathlib.Path],
+                             batch_lines: int = 1000, offset: int = 0) -> typing.AsyncIterator[str]:
+        if self._resolve_log_path(log_path) is not None:
+            async for lines in super().iter_log_lines(log_path, batch_lines, offset):
+                yield lines
+            return
+        fp = await self._read_segment(log_path, _open_extent, offset)
+        if fp is None:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                lines = await loop.run_in_executor(None, lambda: b''.join(itertools.islice(fp, batch_lines)))
+                if not lines:
+                    break
+                yield lines.decode('utf8', errors='replace')
+        finally:
+            fp.close()
+
+    async def compress_log(self, log_path: typing.Union[str, pathlib.Path],
+                           compress: typing.Optional[str] = None) -> typing.Optional[pathlib.Path]:
+        """分段文件不压缩."""
+        return None
+
+    async def maintain(self) -> None:
+        await self.seal_orphans()
+        await self.compact()
+
+    async def seal_orphans(self) -> int:
+        """将spool中没有在记录也不属于运行中任务的日志文件写入分段文件(例如CronWeb异常退出时留下的) 返回数量."""
+        running = self._core.get_all_running_jobs() if self._core is not None else {}
+        count = 0
+        for path in super().get_all_log_file_path():
+            if path.suffix != '.log' or path.name in self.task_dict or _shot_id(path) in running:
+                continue
+            if await self.seal_log(path) is not None:
+                count += 1
+        if count:
+            self._py_logger.info('将%s个遗留的日志文件写入分段文件', count)
+        return count
+
+    async def compact(self) -> int:
+        """压缩有效内容占比低于compact_ratio的分段文件 返回回收的字节数
+        有效内容在不持有锁的情况下复制到只由压缩写入的分段文件 复制后持有锁检查位置没有变化再更新storage
+        当前写入的分段文件不压缩
+        """
+        if self._core is None:
+            return 0
+        loop = asyncio.get_event_loop()
+        reclaimed = 0
+        segments = self._segments()
+        # 本次压缩写入的分段文件 超过segment_size后分配新的编号
+        output: typing.Optional[int] = None
+        for segment in segments[:-1]:
+            if self._segment_current is not None and segment >= self._segment_current:
+                break
+            path_segment = self._segment_path(segment)
+            size = path_segment.stat().st_size
+            records = await self._core.log_segment_get_records(segment)
+            live = sum(record.log_length + (record.log_index_length or 0) for record in records)
+            if size > 0 and live / size >= self.compact_ratio:
+                continue
+            moved = []
+            try:
+                for record in records:
+                    if output is None or (self._segment_path(output).exists() and
+                                          self._segment_path(output).stat().st_size >= self.segment_size):
+                        output = await self._reserve_segment()
+                    index_length = record.log_index_length or 0
+                    parts = [(path_segment, record.log_offset, record.log_length)]
+                    if index_length:
+                        parts.append((path_segment, record.log_offset + record.log_length, index_length))
+                    offset, _ = await loop.run_in_executor(None, self._append_parts, self._segment_path(output),
+                                                           *parts)
+                    moved.append((record, (segment, record.log_offset, record.log_length, index_length),
+                                  (output, offset, record.log_length, index_length)))
+            except Exception as e:
+                self._py_logger.error('分段文件压缩失败 %s %r', path_segment, e)
+                continue
+            async with self._segment_lock:
+                # 复制期间运行记录可能被删除或日志被重新写入 只更新位置没有变化的记录
+                for record, extent_old, extent_new in moved:
+                    if await self._core.log_segment_get(record.shot_id) == extent_old:
+                        await self._core.log_segment_set(record.shot_id, *extent_new)
+                if await self._core.log_segment_get_records(segment):
+                    self._py_logger.error('分段文件压缩后仍有日志 %s', path_segment)
+                    continue
+                os.remove(path_segment)
+            reclaimed += size - live
+            self._py_logger.info('压缩分段文件 %s 移动%s条日志 回收%s字节', path_segment.name, len(records), size - live)
+        return reclaimed
@@ -51,21 +51,31 @@ def load_hooks(core: cronweb.CronWeb):
                 _py_logger.warning('函数 %s 并非有效的异步函数 跳过', name)
                 continue
             _py_logger.warning('注册函数 %s', name)
-            core.add_job_done_hook(func)
+            if name.startswith('hook_job_done_context'):
+                core.add_job_done_context_hook(func)
+            else:
+                core.add_job_done_hook(func)
 
 
 async def init(config: typing.Dict[str, typing.Any]) -> cronweb.CronWeb:
     import logger.logger_aio
+    import logger.logger_segment
     import storage.storage_aiosqlite
     import trigger.trigger_aiocron
     import web.web_fastapi
-    import worker.worker_aiosubprocess
+    import worker.worker_remote
+    # logger.backend为file时每次运行一个日志文件 为segment时所有运行的日志追加写入分段文件
+    config_logger = dict(config.get('logger', {}))
+    backend = config_logger.pop('backend', 'file')
+    factories_logger = {'file': logger.logger_aio.AioLogger, 'segment': logger.logger_segment.SegmentLogger}
+    if backend not in factories_logger:
+        raise ValueError(f'logger.backend must be one of {list(factories_logger)}, not {backend}')
     core = await cronweb.CronWeb.create_from_config(
-        config,
-        logger.logger_aio.AioLogger,
+        {**config, 'logger': config_logger},
+        factories_logger[backend],
         trigger.trigger_aiocron.TriggerAioCron,
         web.web_fastapi.WebFastAPI,
-        worker.worker_aiosubprocess.AioSubprocessWorker,
+        worker.worker_remote.RemoteWorker,
         storage.storage_aiosqlite.AioSqliteStorage.create
     )
     return core
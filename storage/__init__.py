@@ -17,12 +17,116 @@ class LogRecord(typing.NamedTuple):
     log_path: str
     date_start: str
     date_end: typing.Optional[str] = None
+    cpu_user: typing.Optional[float] = None
+    cpu_sys: typing.Optional[float] = None
+    max_rss: typing.Optional[int] = None
+    io_read: typing.Optional[int] = None
+    io_write: typing.Optional[int] = None
+    # 分片任务的运行id和分片参数 非分片任务为None
+    run_id: typing.Optional[str] = None
+    shard: typing.Optional[str] = None
+    # 子进程的pid 进程组id和启动标识 CronWeb重启后用于找回仍在运行的子进程
+    pid: typing.Optional[int] = None
+    pgid: typing.Optional[int] = None
+    proc_start: typing.Optional[str] = None
+    # 启动这次运行的CronWeb实例
+    instance: typing.Optional[str] = None
+    # 使用分段日志(logger.backend: segment)时日志内容所在的分段文件编号 起始字节和长度 记录结束前为None
+    log_segment: typing.Optional[int] = None
+    log_offset: typing.Optional[int] = None
+    log_length: typing.Optional[int] = None
+    # 紧接在日志内容之后的行偏移索引的长度 没有索引时为0
+    log_index_length: typing.Optional[int] = None
+
+
+class RunRecord(typing.NamedTuple):
+    """分片任务的一次运行 包含多个分片的运行记录."""
+    run_id: str
+    uuid: str
+    state: str
+    shards: int
+    date_start: str
+    date_end: typing.Optional[str] = None
+
+
+class UsageSummary(typing.NamedTuple):
+    """按job汇总的资源占用."""
+    uuid: str
+    name: typing.Optional[str]
+    shots: int
+    cpu_user: float
+    cpu_sys: float
+    max_rss: int
+    io_read: int
+    io_write: int
+
+
+class MetricRecord(typing.NamedTuple):
+    """任务输出中报告的一个指标值."""
+    shot_id: str
+    name: str
+    value: float
+    # 运行结束时的unix时间戳 单位:秒
+    ts: float
+
+
+class OutboxEvent(typing.NamedTuple):
+    """等待投递的webhook事件."""
+    id: int
+    shot_id: str
+    payload: str
+    # unix时间戳 单位:秒
+    date_create: float
+    attempts: int
+
+
+class RetryRecord(typing.NamedTuple):
+    """等待执行的重试."""
+    id: int
+    uuid: str
+    # 第一次运行失败的shot_id
+    shot_id_root: str
+    # 第几次重试 从1开始
+    attempt: int
+    # unix时间戳 单位:秒
+    date_due: float
+    date_create: float
+    # 分片任务的重试 只重新运行这次分片运行中失败的分片
+    run_id: typing.Optional[str] = None
+
+
+class InstanceRecord(typing.NamedTuple):
+    """使用同一个storage的CronWeb实例."""
+    instance_id: str
+    hostname: str
+    pid: int
+    # cronweb.InstanceStateEnum的name
+    state: str
+    # unix时间戳 单位:秒
+    date_start: float
+    date_heartbeat: float
+    # 开始排空的时间 即定时调度交接的时间点
+    date_drain: typing.Optional[float] = None
+    # 交接是否已经被其他实例接收
+    handoff_taken: int = 0
+
+
+class LogSearchHit(typing.NamedTuple):
+    """日志全文搜索的一条结果 对应日志中从line行开始的一段内容."""
+    shot_id: str
+    uuid: str
+    # 这段内容在日志中的起始行(从0开始)
+    line: int
+    snippet: str
+    date_start: str
 
 
 class StorageBase(abc.ABC):
     def __init__(self, controller: typing.Optional[cronweb.CronWeb] = None, **kwargs):
         super().__init__()
         self._core: typing.Optional[cronweb.CronWeb] = controller
+        # 是否支持日志全文搜索 由init_db设置
+        self.log_search_available = False
         self._py_logger: logging.Logger = logging.getLogger(f'cronweb.{self.__class__.__name__}')
         self.controller_default()
 
@@ -72,20 +176,140 @@ class StorageBase(abc.ABC):
 
     @abc.abstractmethod
     async def job_log_shoot(self, log_path: typing.Union[str, pathlib.Path],
-                            shot_state: worker.JobState):
+                            shot_state: worker.JobState, instance: typing.Optional[str] = None):
         """新建一条job log的运行记录
-        uuid 日志路径 状态(运行中)
+        uuid 日志路径 状态(运行中) instance为启动运行的CronWeb实例id
         返回log id
         """
         pass
 
     @abc.abstractmethod
-    async def job_log_done(self, shot_state: worker.JobState):
+    async def job_log_done(self, shot_state: worker.JobState, outbox_payload: typing.Optional[str] = None):
         """修改job log的运行记录
         状态为实际的状态
+        shot_state中的指标和outbox_payload(不为None时)在同一事务中写入
         """
         pass
 
+    @abc.abstractmethod
+    async def outbox_get_due(self, now: float, limit: int) -> typing.List[OutboxEvent]:
+        """获取到达投递时间的webhook事件 按创建顺序."""
+        pass
+
+    @abc.abstractmethod
+    async def outbox_remove(self, event_ids: typing.List[int]) -> None:
+        """删除已投递的webhook事件."""
+        pass
+
+    @abc.abstractmethod
+    async def outbox_retry(self, event_ids: typing.List[int], next_try: float, error: str) -> None:
+        """投递失败 增加尝试次数并设置下次投递时间."""
+        pass
+
+    @abc.abstractmethod
+    async def outbox_stats(self) -> typing.Tuple[int, typing.Optional[float]]:
+        """返回(待投递事件数, 最早的待投递事件创建时间)."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_add(self, uuid: str, shot_id_root: str, attempt: int, date_due: float,
+                        run_id: typing.Optional[str] = None) -> RetryRecord:
+        """添加一个在date_due执行的重试 run_id为重试的分片运行."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_get_due(self, now: float, limit: int) -> typing.List[RetryRecord]:
+        """获取到达执行时间的重试 按执行时间排序."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_get_all(self) -> typing.List[RetryRecord]:
+        """获取所有等待执行的重试 按执行时间排序."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_next_due(self) -> typing.Optional[float]:
+        """最早的重试执行时间 没有等待执行的重试时返回None."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_remove(self, retry_id: int) -> typing.Optional[RetryRecord]:
+        """删除重试 返回被删除的记录 不存在时返回None."""
+        pass
+
+    @abc.abstractmethod
+    async def retry_remove_by_uuid(self, uuid: str) -> int:
+        """删除job的所有重试 返回删除数量."""
+        pass
+
+    @abc.abstractmethod
+    async def fire_claim(self, uuid: str, fire_ts: float, instance_id: str) -> bool:
+        """认领job在fire_ts的一次定时触发 同一次触发只有第一个认领的实例返回True."""
+        pass
+
+    @abc.abstractmethod
+    async def fires_prune(self, before: float) -> int:
+        """删除before之前的定时触发认领记录 返回删除数量."""
+        pass
+
+    @abc.abstractmethod
+    async def instance_register(self, instance: InstanceRecord) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def instance_heartbeat(self, instance_id: str, now: float) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def instance_set_state(self, instance_id: str, state: str, date_drain: typing.Optional[float] = None) -> None:
+        """更新实例状态 date_drain不为None时同时记录交接时间."""
+        pass
+
+    @abc.abstractmethod
+    async def instances_get_all(self) -> typing.List[InstanceRecord]:
+        pass
+
+    @abc.abstractmethod
+    async def instances_take_handoff(self, instance_id: str) -> typing.List[InstanceRecord]:
+        """接收其他实例排空时留下的调度交接 返回所有未被接收的交接并标记为已接收."""
+        pass
+
+    @abc.abstractmethod
+    async def instances_prune(self, before: float) -> int:
+        """删除before之前已经停止的实例记录 返回删除数量."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search_enqueue(self, shot_id: str) -> None:
+        """将运行结束的日志加入全文索引队列."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search_pending(self, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """等待建立索引的日志 返回[(shot_id, 已索引的行数)] 按加入顺序."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search_add(self, shot_id: str, line: int, content: str, line_next: int) -> None:
+        """写入日志从line行开始的一段内容 并将已索引的行数更新为line_next."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search_done(self, shot_id: str) -> None:
+        """日志已全部写入索引 从队列中删除."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search(self, query: str, uuid: typing.Optional[str] = None,
+                         limit: int = 50) -> typing.List[LogSearchHit]:
+        """搜索包含query的日志内容 按运行时间降序."""
+        pass
+
+    @abc.abstractmethod
+    async def log_search_prune(self) -> int:
+        """删除运行记录已经不存在的日志索引 返回删除的内容段数."""
+        pass
+
     @abc.abstractmethod
     async def job_log_get_record(self, shot_id: str) -> typing.Optional[LogRecord]:
         """通过shot_id获取日志文件的数据库记录."""
@@ -96,6 +320,22 @@ class StorageBase(abc.ABC):
         """通过uuid获取job log的状态."""
         pass
 
+    @abc.abstractmethod
+    async def job_logs_durations(self, uuid: str, limit: int) -> typing.List[float]:
+        """job最近limit次成功(DONE或WARN)运行的时长(秒) 按开始时间升序."""
+        pass
+
+    @abc.abstractmethod
+    async def job_log_set_segment(self, shot_id: str, segment: int, offset: int, length: int,
+                                  index_length: int = 0) -> bool:
+        """记录日志内容和之后的行偏移索引在分段文件中的位置 运行记录不存在时返回False."""
+        pass
+
+    @abc.abstractmethod
+    async def job_logs_get_by_segment(self, segment: int) -> typing.List[LogRecord]:
+        """获取日志内容在指定分段文件中的运行记录 包括deleted 按起始字节排序."""
+        pass
+
     @abc.abstractmethod
     async def job_logs_get_by_state(self, state: worker.JobStateEnum) -> typing.List[LogRecord]:
         """获取所有状态为指定状态的job log."""
@@ -135,6 +375,45 @@ class StorageBase(abc.ABC):
         """
         pass
 
+    @abc.abstractmethod
+    async def job_logs_top_consumers(self, order_by: str, limit: int,
+                                     date_since: typing.Optional[str] = None) -> typing.List[UsageSummary]:
+        """按job汇总资源占用 并按指定资源(cpu rss io)降序返回前limit个
+        date_since不为None时只统计在此之后开始的运行记录
+        """
+        pass
+
+    @abc.abstractmethod
+    async def run_create(self, run: RunRecord) -> None:
+        """添加分片任务的运行记录."""
+        pass
+
+    @abc.abstractmethod
+    async def run_update(self, run_id: str, state: worker.JobStateEnum, date_end: typing.Optional[str]) -> None:
+        """修改分片任务运行记录的状态和结束时间."""
+        pass
+
+    @abc.abstractmethod
+    async def run_get(self, run_id: str) -> typing.Optional[RunRecord]:
+        pass
+
+    @abc.abstractmethod
+    async def runs_get_by_uuid(self, uuid: str, limit: int) -> typing.List[RunRecord]:
+        """获取job最近的分片运行记录 按开始时间降序."""
+        pass
+
+    @abc.abstractmethod
+    async def job_logs_get_by_run_id(self, run_id: str) -> typing.List[LogRecord]:
+        """获取分片运行中所有分片的运行记录(包括重试) 按开始时间升序."""
+        pass
+
+    @abc.abstractmethod
+    async def job_metrics_get(self, uuid: str, name: typing.Optional[str] = None,
+                              ts_since: typing.Optional[float] = None,
+                              limit: int = 1000) -> typing.List[MetricRecord]:
+        """获取job的指标时间序列 按时间升序 name为None时返回所有指标."""
+        pass
+
     @abc.abstractmethod
     async def stop(self):
         pass
@@ -6,6 +6,8 @@ import aiosqlite
 import pathlib
 import logging
 import typing
+import json
+import time
 import contextlib
 
 if typing.TYPE_CHECKING:
@@ -83,10 +85,42 @@ class AioSqlitePool:
         try:
             yield conn
         finally:
+            if conn.in_transaction:
+                # 未提交的写事务会一直持有锁 其他连接的写入会失败(database is locked)
+                self._py_logger.warning('归还的数据库连接有未提交的事务 回滚')
+                await conn.rollback()
             await self.back_connection(conn)
 
 
 class AioSqliteStorage(storage.StorageBase):
+    # 相对于最初版本表结构新增的列 启动时自动补充到旧版本数据库中
+    _COLUMNS_EXTRA_JOBS: typing.Dict[str, str] = {
+        'options': "NVARCHAR NOT NULL DEFAULT '{}'",
+    }
+    _COLUMNS_JOBS = 'uuid, cron_exp, command, param, name, date_create, date_update, active, options'
+    _COLUMNS_EXTRA_JOB_LOGS: typing.Dict[str, str] = {
+        'cpu_user': 'REAL DEFAULT NULL',
+        'cpu_sys': 'REAL DEFAULT NULL',
+        'max_rss': 'INTEGER DEFAULT NULL',
+        'io_read': 'INTEGER DEFAULT NULL',
+        'io_write': 'INTEGER DEFAULT NULL',
+        'run_id': 'NCHAR(32) DEFAULT NULL',
+        'shard': 'NVARCHAR DEFAULT NULL',
+        'pid': 'INTEGER DEFAULT NULL',
+        'pgid': 'INTEGER DEFAULT NULL',
+        'proc_start': 'TEXT DEFAULT NULL',
+        'instance': 'NCHAR(32) DEFAULT NULL',
+        'log_segment': 'INTEGER DEFAULT NULL',
+        'log_offset': 'INTEGER DEFAULT NULL',
+        'log_length': 'INTEGER DEFAULT NULL',
+        'log_index_length': 'INTEGER DEFAULT NULL',
+    }
+    _COLUMNS_EXTRA_JOB_RETRIES: typing.Dict[str, str] = {
+        'run_id': 'NCHAR(32) DEFAULT NULL',
+    }
+    # 与storage.LogRecord字段一一对应
+    _COLUMNS_JOB_LOGS = ', '.join(storage.LogRecord._fields)
+
     def __init__(self, db_pool: AioSqlitePool, db_path: typing.Union[str, pathlib.Path],
                  controller: typing.Optional[cronweb.CronWeb] = None):
         super().__init__(controller)
@@ -118,6 +152,74 @@ class AioSqliteStorage(storage.StorageBase):
                     self._py_logger.info('job_logs表不存在 尝试创建')
                     await self._create_table_job_log()
 
+            async with conn.execute(sql.format(table_name='webhook_outbox')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('webhook_outbox表不存在 尝试创建')
+                    await self._create_table_webhook_outbox()
+
+            async with conn.execute(sql.format(table_name='job_metrics')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('job_metrics表不存在 尝试创建')
+                    await self._create_table_job_metrics()
+
+            async with conn.execute(sql.format(table_name='job_runs')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('job_runs表不存在 尝试创建')
+                    await self._create_table_job_runs()
+
+            async with conn.execute(sql.format(table_name='job_retries')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('job_retries表不存在 尝试创建')
+                    await self._create_table_job_retries()
+
+            async with conn.execute(sql.format(table_name='job_fires')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('job_fires表不存在 尝试创建')
+                    await self._create_table_job_fires()
+
+            async with conn.execute(sql.format(table_name='instances')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('instances表不存在 尝试创建')
+                    await self._create_table_instances()
+
+            async with conn.execute(sql.format(table_name='log_chunks')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('log_chunks表不存在 尝试创建')
+                    await self._create_table_log_chunks()
+
+            async with conn.execute(sql.format(table_name='log_fts')) as cursor:
+                if (await cursor.fetchone())[0] == 0:
+                    self._py_logger.info('log_fts表不存在 尝试创建')
+                    await self._create_table_log_fts()
+            async with conn.execute(sql.format(table_name='log_fts')) as cursor:
+                self.log_search_available = (await cursor.fetchone())[0] == 1
+
+        await self._migrate_columns('jobs', self._COLUMNS_EXTRA_JOBS)
+        await self._migrate_columns('job_logs', self._COLUMNS_EXTRA_JOB_LOGS)
+        await self._migrate_columns('job_retries', self._COLUMNS_EXTRA_JOB_RETRIES)
+        async with self.db_pool.connect() as conn:
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_job_logs_run_id ON job_logs(run_id);')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_job_logs_uuid_date_start ON job_logs(uuid, date_start);')
+            await conn.execute('CREATE INDEX IF NOT EXISTS idx_job_logs_log_segment ON job_logs(log_segment);')
+            await conn.commit()
+
+    async def _migrate_columns(self, table_name: str, columns: typing.Dict[str, str]):
+        """检查表中是否缺少新增的列 缺少则添加."""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(f'PRAGMA table_info({table_name});') as cursor:
+                columns_exists = {row[1] for row in await cursor.fetchall()}
+            for column, definition in columns.items():
+                if column in columns_exists:
+                    continue
+                self._py_logger.info('%s表缺少%s列 尝试添加', table_name, column)
+                await conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column} {definition};')
+            await conn.commit()
+
+    @staticmethod
+    def _row_to_job_info(row: typing.Sequence[typing.Any]) -> trigger.JobInfo:
+        return trigger.JobInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7],
+                               json.loads(row[8]) if row[8] else {})
+
     async def _create_table_job(self):
         sql = """
             CREATE TABLE jobs(
@@ -152,35 +254,167 @@ class AioSqliteStorage(storage.StorageBase):
             await conn.execute(sql)
             await conn.commit()
 
+    async def _create_table_webhook_outbox(self):
+        sql = """
+            CREATE TABLE webhook_outbox(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shot_id NCHAR(32) NOT NULL,
+                payload NVARCHAR NOT NULL,
+                date_create REAL NOT NULL,
+                next_try REAL NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                last_error NVARCHAR DEFAULT NULL
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.execute('CREATE INDEX idx_webhook_outbox_next_try ON webhook_outbox(next_try);')
+            await conn.commit()
+
+    async def _create_table_job_metrics(self):
+        sql = """
+            CREATE TABLE job_metrics(
+                shot_id NCHAR(32) NOT NULL,
+                uuid NCHAR(32) NOT NULL,
+                name NVARCHAR NOT NULL,
+                value REAL NOT NULL,
+                ts REAL NOT NULL,
+                PRIMARY KEY (shot_id, name)
+            ) WITHOUT ROWID;
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.execute('CREATE INDEX idx_job_metrics_uuid_name_ts ON job_metrics(uuid, name, ts);')
+            await conn.commit()
+
+    async def _create_table_job_runs(self):
+        sql = """
+            CREATE TABLE job_runs(
+                run_id NCHAR(32) PRIMARY KEY NOT NULL,
+                uuid NCHAR(32) NOT NULL,
+                state NCHAR(8) NOT NULL,
+                shards INTEGER NOT NULL,
+                date_start TEXT NOT NULL,
+                date_end TEXT DEFAULT NULL
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.execute('CREATE INDEX idx_job_runs_uuid ON job_runs(uuid, date_start);')
+            await conn.commit()
+
+    async def _create_table_job_retries(self):
+        sql = """
+            CREATE TABLE job_retries(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uuid NCHAR(32) NOT NULL,
+                shot_id_root NCHAR(32) NOT NULL,
+                attempt INTEGER NOT NULL,
+                date_due REAL NOT NULL,
+                date_create REAL NOT NULL,
+                run_id NCHAR(32) DEFAULT NULL
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.execute('CREATE INDEX idx_job_retries_date_due ON job_retries(date_due);')
+            await conn.commit()
+
+    async def _create_table_job_fires(self):
+        sql = """
+            CREATE TABLE job_fires(
+                uuid NCHAR(32) NOT NULL,
+                fire_ts REAL NOT NULL,
+                instance_id NCHAR(32) NOT NULL,
+                date_claim REAL NOT NULL,
+                PRIMARY KEY (uuid, fire_ts)
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.commit()
+
+    async def _create_table_instances(self):
+        sql = """
+            CREATE TABLE instances(
+                instance_id NCHAR(32) PRIMARY KEY NOT NULL,
+                hostname NVARCHAR NOT NULL,
+                pid INTEGER NOT NULL,
+                state NCHAR(8) NOT NULL,
+                date_start REAL NOT NULL,
+                date_heartbeat REAL NOT NULL,
+                date_drain REAL DEFAULT NULL,
+                handoff_taken INTEGER NOT NULL DEFAULT 0
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.commit()
+
+    async def _create_table_log_chunks(self):
+        """日志全文索引中每段内容所属的运行记录和起始行 以及等待建立索引的日志."""
+        sql = """
+            CREATE TABLE log_chunks(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shot_id NCHAR(32) NOT NULL,
+                line INTEGER NOT NULL
+            );
+        """
+        sql_pending = """
+            CREATE TABLE log_search_pending(
+                shot_id NCHAR(32) PRIMARY KEY NOT NULL,
+                line INTEGER NOT NULL DEFAULT 0,
+                date_add REAL NOT NULL
+            );
+        """
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql)
+            await conn.execute('CREATE INDEX idx_log_chunks_shot_id ON log_chunks(shot_id);')
+            await conn.execute(sql_pending)
+            await conn.commit()
+
+    async def _create_table_log_fts(self):
+        """日志内容的FTS5全文索引 rowid与log_chunks.id对应
+        优先使用trigram分词(sqlite>=3.34) 可以搜索任意子串(包括中文) 不支持时使用unicode61分词
+        sqlite未编译FTS5时不支持日志搜索
+        """
+        async with self.db_pool.connect() as conn:
+            for tokenize in ('trigram', 'unicode61'):
+                try:
+                    await conn.execute(f"CREATE VIRTUAL TABLE log_fts USING fts5(content, tokenize='{tokenize}');")
+                    await conn.commit()
+                    return
+                except aiosqlite.OperationalError as e:
+                    self._py_logger.warning('log_fts表创建失败 tokenize:%s %r', tokenize, e)
+        self._py_logger.warning('sqlite不支持FTS5 日志搜索不可用')
+
     async def get_job(self, uuid: str) -> typing.Optional[trigger.JobInfo]:
-        sql = r"""SELECT * FROM jobs WHERE uuid=? AND deleted=0"""
+        sql = f"""SELECT {self._COLUMNS_JOBS} FROM jobs WHERE uuid=? AND deleted=0"""
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql, (uuid,)) as cursor:
                 row = await cursor.fetchone()
-                if len(row) == 0:
+                if not row:
                     self._py_logger.warning('任务不存在于storage uuid:%s', uuid)
                     return None
-                return trigger.JobInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+                return self._row_to_job_info(row)
 
     async def get_all_jobs(self) -> typing.Dict[str, trigger.JobInfo]:
-        sql = r"""SELECT * FROM jobs WHERE deleted=0"""
+        sql = f"""SELECT {self._COLUMNS_JOBS} FROM jobs WHERE deleted=0"""
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql) as cursor:
                 rows = await cursor.fetchall()
                 if len(rows) == 0:
                     self._py_logger.warning('storage中无任务')
                     return {}
-                return {row[0]: trigger.JobInfo(row[0], row[1], row[2],
-                                                row[3], row[4], row[5], row[6], row[7])
-                        for row in rows}
+                return {row[0]: self._row_to_job_info(row) for row in rows}
 
     async def save_job(self, job_info: trigger.JobInfo) -> typing.Optional[trigger.JobInfo]:
-        sql = r"""INSERT INTO jobs (uuid, cron_exp, command, param, name, date_create, date_update, active)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""
+        sql = f"""INSERT INTO jobs ({self._COLUMNS_JOBS})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
         self._py_logger.debug('在storage中添加新任务 %s', job_info)
         async with self.db_pool.connect() as conn:
             try:
-                await conn.execute(sql, tuple(job_info))
+                await conn.execute(sql, (*job_info[:8], json.dumps(job_info.options or {}, ensure_ascii=False)))
                 await conn.commit()
             except Exception as e:
                 self._py_logger.error('storage任务添加失败')
@@ -218,9 +452,10 @@ class AioSqliteStorage(storage.StorageBase):
                 self._py_logger.exception(e)
 
     async def job_log_shoot(self, log_path: typing.Union[str, pathlib.Path],
-                            shot_state: worker.JobState):
-        sql = r"""INSERT INTO job_logs (shot_id, uuid, state, log_path, date_start)
-                    VALUES (?, ?, ?, ?, ?);"""
+                            shot_state: worker.JobState, instance: typing.Optional[str] = None):
+        sql = r"""INSERT INTO job_logs (shot_id, uuid, state, log_path, date_start, run_id, shard,
+                                        pid, pgid, proc_start, instance)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
         uuid = shot_state.uuid
         shot_id = shot_state.shot_id
         self._py_logger.debug('在storage中添加新任务log记录 %s', uuid)
@@ -228,19 +463,32 @@ class AioSqliteStorage(storage.StorageBase):
             try:
                 log_path = pathlib.Path(log_path)
                 await conn.execute(sql, (shot_id, uuid, shot_state.state.name,
-                                         str(log_path), shot_state.date_start))
+                                         str(log_path), shot_state.date_start,
+                                         shot_state.run_id, shot_state.shard,
+                                         shot_state.pid, shot_state.pgid, shot_state.proc_start, instance))
                 await conn.commit()
 
             except Exception as e:
                 self._py_logger.error('storage任务log添加失败')
                 self._py_logger.exception(e)
 
-    async def job_log_done(self, shot_state: worker.JobState):
-        sql = r"""UPDATE job_logs SET state=?, date_end=? WHERE shot_id=?;"""
+    async def job_log_done(self, shot_state: worker.JobState, outbox_payload: typing.Optional[str] = None):
+        sql = r"""UPDATE job_logs SET state=?, date_end=?,
+                    cpu_user=?, cpu_sys=?, max_rss=?, io_read=?, io_write=? WHERE shot_id=?;"""
+        sql_outbox = r"""INSERT INTO webhook_outbox (shot_id, payload, date_create, next_try)
+                    VALUES (?, ?, ?, ?);"""
+        sql_metrics = r"""INSERT OR REPLACE INTO job_metrics (shot_id, uuid, name, value, ts) VALUES (?, ?, ?, ?, ?);"""
         self._py_logger.debug('在storage中更新新任务log记录 shot_id:%s', shot_state.shot_id)
+        usage = tuple(shot_state.usage) if shot_state.usage else (None,) * 5
+        now = time.time()
         async with self.db_pool.connect() as conn:
             try:
-                await conn.execute(sql, (shot_state.state.name, shot_state.date_end, shot_state.shot_id))
+                await conn.execute(sql, (shot_state.state.name, shot_state.date_end, *usage, shot_state.shot_id))
+                if shot_state.metrics:
+                    await conn.executemany(sql_metrics, [(shot_state.shot_id, shot_state.uuid, name, value, now)
+                                                         for name, value in shot_state.metrics.items()])
+                if outbox_payload is not None:
+                    await conn.execute(sql_outbox, (shot_state.shot_id, outbox_payload, now, now))
                 await conn.commit()
             except Exception as e:
                 self._py_logger.error('storage任务log更新失败')
@@ -248,43 +496,78 @@ class AioSqliteStorage(storage.StorageBase):
 
     async def job_log_get_record(self, shot_id: str) -> typing.Optional[storage.LogRecord]:
         """通过shot_id获取日志文件的数据库记录."""
-        sql = r"""SELECT * FROM job_logs WHERE shot_id=? AND deleted=0;"""
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE shot_id=? AND deleted=0;"""
         self._py_logger.debug('在storage中查询任务log记录 shot_id:%s', shot_id)
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql, (shot_id,)) as cursor:
                 row = await cursor.fetchone()
                 if not row:
                     return None
-                record = storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5])
+                record = storage.LogRecord(*row)
                 return record
 
     async def job_logs_get_by_uuid(self, uuid: str) -> typing.List[storage.LogRecord]:
-        sql = r"""SELECT * FROM job_logs WHERE uuid=? AND deleted=0;"""
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE uuid=? AND deleted=0;"""
         self._py_logger.debug('在storage中查询任务log记录 uuid:%s', uuid)
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql, (uuid,)) as cursor:
                 rows = await cursor.fetchall()
-                out_list = [storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+                out_list = [storage.LogRecord(*row) for row in rows]
+        return out_list
+
+    async def job_logs_durations(self, uuid: str, limit: int) -> typing.List[float]:
+        sql = r"""SELECT (julianday(date_end) - julianday(date_start)) * 86400 FROM job_logs
+                    WHERE uuid=? AND state IN ('DONE', 'WARN') AND date_end IS NOT NULL
+                    ORDER BY date_start DESC LIMIT ?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (uuid, limit)) as cursor:
+                rows = await cursor.fetchall()
+        return [row[0] for row in reversed(rows) if row[0] is not None]
+
+    async def job_log_set_segment(self, shot_id: str, segment: int, offset: int, length: int,
+                                  index_length: int = 0) -> bool:
+        sql = r"""UPDATE job_logs SET log_segment=?, log_offset=?, log_length=?, log_index_length=?
+                    WHERE shot_id=?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (segment, offset, length, index_length, shot_id)) as cursor:
+                updated = cursor.rowcount == 1
+            await conn.commit()
+        return updated
+
+    async def job_logs_get_by_segment(self, segment: int) -> typing.List[storage.LogRecord]:
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE log_segment=? ORDER BY log_offset;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (segment,)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.LogRecord(*row) for row in rows]
         return out_list
 
     async def job_logs_get_by_state(self, state: worker.JobStateEnum) -> typing.List[storage.LogRecord]:
-        sql = r"""SELECT * FROM job_logs WHERE state=? AND deleted=0;"""
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE state=? AND deleted=0;"""
         self._py_logger.debug('在storage中查询任务log记录 state:%s', state.name)
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql, (state.name,)) as cursor:
                 rows = await cursor.fetchall()
-                out_list = [storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+                out_list = [storage.LogRecord(*row) for row in rows]
         self._py_logger.debug('storage中有%s条未标记为deleted的log记录', len(out_list))
         return out_list
 
     async def job_logs_remove_shot_id(self, shot_id: typing.Union[str, typing.List[str]]) -> typing.List[str]:
-        """根据shot_id从storage中删除记录."""
+        """根据shot_id从storage中删除记录 同时删除运行中报告的指标和日志全文索引."""
         sql = r"""DELETE FROM job_logs WHERE shot_id=?;"""
+        sql_metrics = r"""DELETE FROM job_metrics WHERE shot_id=?;"""
+        sql_search = [r"""DELETE FROM log_fts WHERE rowid IN (SELECT id FROM log_chunks WHERE shot_id=?);""",
+                      r"""DELETE FROM log_chunks WHERE shot_id=?;""",
+                      r"""DELETE FROM log_search_pending WHERE shot_id=?;"""]
         if not isinstance(shot_id, list):
             shot_id = [shot_id]
         async with self.db_pool.connect() as conn:
             for shot in shot_id:
                 await conn.execute(sql, (shot,))
+                await conn.execute(sql_metrics, (shot,))
+                if self.log_search_available:
+                    for sql_delete in sql_search:
+                        await conn.execute(sql_delete, (shot,))
             await conn.commit()
         return shot_id
 
@@ -302,12 +585,12 @@ class AioSqliteStorage(storage.StorageBase):
         """获取所有设置为deleted的shot_id
         用于进一步清理
         """
-        sql = r"""SELECT * FROM job_logs WHERE deleted=1;"""
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE deleted=1;"""
         self._py_logger.debug('在storage中查询已删除任务log记录')
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql) as cursor:
                 rows = await cursor.fetchall()
-                out_list = [storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+                out_list = [storage.LogRecord(*row) for row in rows]
         self._py_logger.debug('storage中有%s条被标记为deleted的log记录', len(out_list))
         return out_list
 
@@ -316,14 +599,14 @@ class AioSqliteStorage(storage.StorageBase):
         用于api
         """
         if limit <= 0:
-            sql = r"SELECT * FROM job_logs WHERE deleted=0 ORDER BY datetime(date_start) DESC ;"
+            sql = f"SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE deleted=0 ORDER BY datetime(date_start) DESC ;"
         else:
-            sql = r"SELECT * FROM job_logs WHERE deleted=0 ORDER BY datetime(date_start) DESC LIMIT ?"
+            sql = f"SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE deleted=0 ORDER BY datetime(date_start) DESC LIMIT ?"
         self._py_logger.debug('在storage中查询未标记删除任务log记录 limit:%s', limit)
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql, (limit,) if limit else None) as cursor:
                 rows = await cursor.fetchall()
-                out_list = [storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+                out_list = [storage.LogRecord(*row) for row in rows]
         self._py_logger.debug('storage中有%s条未标记删除的log记录', len(out_list))
         return out_list
 
@@ -331,15 +614,320 @@ class AioSqliteStorage(storage.StorageBase):
         """获取所有shot_id
         包括deleted
         """
-        sql = r"""SELECT * FROM job_logs;"""
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs;"""
         self._py_logger.debug('在storage中查询所有任务log记录')
         async with self.db_pool.connect() as conn:
             async with conn.execute(sql) as cursor:
                 rows = await cursor.fetchall()
-                out_list = [storage.LogRecord(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows]
+                out_list = [storage.LogRecord(*row) for row in rows]
         self._py_logger.debug('storage中共有%s条log记录', len(out_list))
         return out_list
 
+    async def job_logs_top_consumers(self, order_by: str, limit: int,
+                                     date_since: typing.Optional[str] = None) -> typing.List[storage.UsageSummary]:
+        """按job汇总资源占用 并按指定资源(cpu rss io)降序返回前limit个."""
+        order_columns = {
+            'cpu': 'total(cpu_user) + total(cpu_sys)',
+            'rss': 'max(max_rss)',
+            'io': 'total(io_read) + total(io_write)',
+        }
+        if order_by not in order_columns:
+            raise ValueError(f'order_by must be one of {list(order_columns)}')
+        sql = f"""SELECT job_logs.uuid, jobs.name, count(*),
+                        total(cpu_user), total(cpu_sys), ifnull(max(max_rss), 0),
+                        ifnull(sum(io_read), 0), ifnull(sum(io_write), 0)
+                    FROM job_logs LEFT JOIN jobs ON jobs.uuid=job_logs.uuid
+                    WHERE job_logs.deleted=0 AND job_logs.cpu_user IS NOT NULL AND job_logs.date_start>=?
+                    GROUP BY job_logs.uuid ORDER BY {order_columns[order_by]} DESC LIMIT ?;"""
+        self._py_logger.debug('在storage中统计资源占用 order_by:%s limit:%s', order_by, limit)
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (date_since or '', limit)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.UsageSummary(*row) for row in rows]
+        return out_list
+
+    async def outbox_get_due(self, now: float, limit: int) -> typing.List[storage.OutboxEvent]:
+        sql = r"""SELECT id, shot_id, payload, date_create, attempts FROM webhook_outbox
+                    WHERE next_try<=? ORDER BY id LIMIT ?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (now, limit)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.OutboxEvent(*row) for row in rows]
+        return out_list
+
+    async def outbox_remove(self, event_ids: typing.List[int]) -> None:
+        sql = r"""DELETE FROM webhook_outbox WHERE id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.executemany(sql, [(event_id,) for event_id in event_ids])
+            await conn.commit()
+
+    async def outbox_retry(self, event_ids: typing.List[int], next_try: float, error: str) -> None:
+        sql = r"""UPDATE webhook_outbox SET attempts=attempts+1, next_try=?, last_error=? WHERE id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.executemany(sql, [(next_try, error, event_id) for event_id in event_ids])
+            await conn.commit()
+
+    async def outbox_stats(self) -> typing.Tuple[int, typing.Optional[float]]:
+        sql = r"""SELECT count(*), min(date_create) FROM webhook_outbox;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql) as cursor:
+                row = await cursor.fetchone()
+        return row[0], row[1]
+
+    async def run_create(self, run: storage.RunRecord) -> None:
+        sql = r"""INSERT INTO job_runs (run_id, uuid, state, shards, date_start, date_end)
+                    VALUES (?, ?, ?, ?, ?, ?);"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, tuple(run))
+            await conn.commit()
+
+    async def run_update(self, run_id: str, state: worker.JobStateEnum, date_end: typing.Optional[str]) -> None:
+        sql = r"""UPDATE job_runs SET state=?, date_end=? WHERE run_id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, (state.name, date_end, run_id))
+            await conn.commit()
+
+    async def run_get(self, run_id: str) -> typing.Optional[storage.RunRecord]:
+        sql = r"""SELECT run_id, uuid, state, shards, date_start, date_end FROM job_runs WHERE run_id=?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (run_id,)) as cursor:
+                row = await cursor.fetchone()
+        return storage.RunRecord(*row) if row else None
+
+    async def runs_get_by_uuid(self, uuid: str, limit: int) -> typing.List[storage.RunRecord]:
+        sql = r"""SELECT run_id, uuid, state, shards, date_start, date_end FROM job_runs
+                    WHERE uuid=? ORDER BY date_start DESC LIMIT ?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (uuid, limit)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.RunRecord(*row) for row in rows]
+        return out_list
+
+    async def job_logs_get_by_run_id(self, run_id: str) -> typing.List[storage.LogRecord]:
+        sql = f"""SELECT {self._COLUMNS_JOB_LOGS} FROM job_logs WHERE run_id=? ORDER BY date_start;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (run_id,)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.LogRecord(*row) for row in rows]
+        return out_list
+
+    async def job_metrics_get(self, uuid: str, name: typing.Optional[str] = None,
+                              ts_since: typing.Optional[float] = None,
+                              limit: int = 1000) -> typing.List[storage.MetricRecord]:
+        sql = r"""SELECT shot_id, name, value, ts FROM job_metrics WHERE uuid=?"""
+        params: typing.List[typing.Any] = [uuid]
+        if name is not None:
+            sql += r""" AND name=?"""
+            params.append(name)
+        if ts_since is not None:
+            sql += r""" AND ts>=?"""
+            params.append(ts_since)
+        # 取最近的limit条 再按时间升序返回
+        sql = f"""SELECT * FROM ({sql} ORDER BY ts DESC LIMIT ?) ORDER BY ts;"""
+        params.append(limit)
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.MetricRecord(*row) for row in rows]
+        return out_list
+
+    async def retry_add(self, uuid: str, shot_id_root: str, attempt: int, date_due: float,
+                        run_id: typing.Optional[str] = None) -> storage.RetryRecord:
+        sql = r"""INSERT INTO job_retries (uuid, shot_id_root, attempt, date_due, date_create, run_id)
+                    VALUES (?, ?, ?, ?, ?, ?);"""
+        now = time.time()
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (uuid, shot_id_root, attempt, date_due, now, run_id)) as cursor:
+                retry_id = cursor.lastrowid
+            await conn.commit()
+        return storage.RetryRecord(retry_id, uuid, shot_id_root, attempt, date_due, now, run_id)
+
+    async def retry_get_due(self, now: float, limit: int) -> typing.List[storage.RetryRecord]:
+        sql = r"""SELECT id, uuid, shot_id_root, attempt, date_due, date_create, run_id FROM job_retries
+                    WHERE date_due<=? ORDER BY date_due LIMIT ?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (now, limit)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.RetryRecord(*row) for row in rows]
+        return out_list
+
+    async def retry_get_all(self) -> typing.List[storage.RetryRecord]:
+        sql = r"""SELECT id, uuid, shot_id_root, attempt, date_due, date_create, run_id FROM job_retries
+                    ORDER BY date_due;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.RetryRecord(*row) for row in rows]
+        return out_list
+
+    async def retry_next_due(self) -> typing.Optional[float]:
+        sql = r"""SELECT min(date_due) FROM job_retries;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql) as cursor:
+                row = await cursor.fetchone()
+        return row[0]
+
+    async def retry_remove(self, retry_id: int) -> typing.Optional[storage.RetryRecord]:
+        sql_select = r"""SELECT id, uuid, shot_id_root, attempt, date_due, date_create, run_id FROM job_retries
+                    WHERE id=?;"""
+        sql_delete = r"""DELETE FROM job_retries WHERE id=?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql_select, (retry_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            async with conn.execute(sql_delete, (retry_id,)) as cursor:
+                # 可能已经被其他调用删除
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    return None
+            await conn.commit()
+        return storage.RetryRecord(*row)
+
+    async def retry_remove_by_uuid(self, uuid: str) -> int:
+        sql = r"""DELETE FROM job_retries WHERE uuid=?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (uuid,)) as cursor:
+                count = cursor.rowcount
+            await conn.commit()
+        return count
+
+    async def fire_claim(self, uuid: str, fire_ts: float, instance_id: str) -> bool:
+        sql = r"""INSERT OR IGNORE INTO job_fires (uuid, fire_ts, instance_id, date_claim) VALUES (?, ?, ?, ?);"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (uuid, fire_ts, instance_id, time.time())) as cursor:
+                claimed = cursor.rowcount == 1
+            await conn.commit()
+        return claimed
+
+    async def fires_prune(self, before: float) -> int:
+        sql = r"""DELETE FROM job_fires WHERE fire_ts<?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (before,)) as cursor:
+                count = cursor.rowcount
+            await conn.commit()
+        return count
+
+    _COLUMNS_INSTANCES = ', '.join(storage.InstanceRecord._fields)
+
+    async def instance_register(self, instance: storage.InstanceRecord) -> None:
+        sql = f"""INSERT OR REPLACE INTO instances ({self._COLUMNS_INSTANCES}) VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, tuple(instance))
+            await conn.commit()
+
+    async def instance_heartbeat(self, instance_id: str, now: float) -> None:
+        sql = r"""UPDATE instances SET date_heartbeat=? WHERE instance_id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, (now, instance_id))
+            await conn.commit()
+
+    async def instance_set_state(self, instance_id: str, state: str, date_drain: typing.Optional[float] = None) -> None:
+        sql = r"""UPDATE instances SET state=?, date_heartbeat=?, date_drain=coalesce(?, date_drain)
+                    WHERE instance_id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, (state, time.time(), date_drain, instance_id))
+            await conn.commit()
+
+    async def instances_get_all(self) -> typing.List[storage.InstanceRecord]:
+        sql = f"""SELECT {self._COLUMNS_INSTANCES} FROM instances ORDER BY date_start;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.InstanceRecord(*row) for row in rows]
+        return out_list
+
+    async def instances_take_handoff(self, instance_id: str) -> typing.List[storage.InstanceRecord]:
+        sql_select = f"""SELECT {self._COLUMNS_INSTANCES} FROM instances
+                    WHERE instance_id!=? AND date_drain IS NOT NULL AND handoff_taken=0 ORDER BY date_drain;"""
+        sql_update = r"""UPDATE instances SET handoff_taken=1 WHERE instance_id=? AND handoff_taken=0;"""
+        out_list = []
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql_select, (instance_id,)) as cursor:
+                rows = await cursor.fetchall()
+            for row in rows:
+                record = storage.InstanceRecord(*row)
+                async with conn.execute(sql_update, (record.instance_id,)) as cursor:
+                    # 可能已经被其他实例接收
+                    if cursor.rowcount == 1:
+                        out_list.append(record)
+            await conn.commit()
+        return out_list
+
+    async def instances_prune(self, before: float) -> int:
+        sql = r"""DELETE FROM instances WHERE state='STOPPED' AND date_heartbeat<?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (before,)) as cursor:
+                count = cursor.rowcount
+            await conn.commit()
+        return count
+
+    async def log_search_enqueue(self, shot_id: str) -> None:
+        sql = r"""INSERT OR IGNORE INTO log_search_pending (shot_id, line, date_add) VALUES (?, 0, ?);"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, (shot_id, time.time()))
+            await conn.commit()
+
+    async def log_search_pending(self, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        sql = r"""SELECT shot_id, line FROM log_search_pending ORDER BY date_add LIMIT ?;"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (limit,)) as cursor:
+                rows = await cursor.fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    async def log_search_add(self, shot_id: str, line: int, content: str, line_next: int) -> None:
+        sql_pending = r"""UPDATE log_search_pending SET line=? WHERE shot_id=?;"""
+        sql_chunk = r"""INSERT INTO log_chunks (shot_id, line) VALUES (?, ?);"""
+        sql_fts = r"""INSERT INTO log_fts (rowid, content) VALUES (?, ?);"""
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql_pending, (line_next, shot_id)) as cursor:
+                # 建立索引的过程中运行记录已被删除
+                if cursor.rowcount == 0:
+                    await conn.rollback()
+                    return
+            async with conn.execute(sql_chunk, (shot_id, line)) as cursor:
+                chunk_id = cursor.lastrowid
+            await conn.execute(sql_fts, (chunk_id, content))
+            await conn.commit()
+
+    async def log_search_done(self, shot_id: str) -> None:
+        sql = r"""DELETE FROM log_search_pending WHERE shot_id=?;"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql, (shot_id,))
+            await conn.commit()
+
+    async def log_search(self, query: str, uuid: typing.Optional[str] = None,
+                         limit: int = 50) -> typing.List[storage.LogSearchHit]:
+        """query作为一个短语搜索 不使用FTS5查询语法 trigram分词时query至少需要3个字符."""
+        sql = f"""SELECT log_chunks.shot_id, job_logs.uuid, log_chunks.line,
+                        snippet(log_fts, 0, '[', ']', '...', 32), job_logs.date_start
+                    FROM log_fts JOIN log_chunks ON log_chunks.id=log_fts.rowid
+                        JOIN job_logs ON job_logs.shot_id=log_chunks.shot_id
+                    WHERE log_fts MATCH ? AND job_logs.deleted=0 {'AND job_logs.uuid=?' if uuid else ''}
+                    ORDER BY log_fts.rowid DESC LIMIT ?;"""
+        if not query:
+            return []
+        phrase = '"' + query.replace('"', '""') + '"'
+        self._py_logger.debug('在storage中搜索日志 query:%s uuid:%s', query, uuid)
+        async with self.db_pool.connect() as conn:
+            async with conn.execute(sql, (phrase, uuid, limit) if uuid else (phrase, limit)) as cursor:
+                rows = await cursor.fetchall()
+                out_list = [storage.LogSearchHit(*row) for row in rows]
+        return out_list
+
+    async def log_search_prune(self) -> int:
+        sql_fts = r"""DELETE FROM log_fts WHERE rowid IN
+                        (SELECT id FROM log_chunks WHERE shot_id NOT IN (SELECT shot_id FROM job_logs));"""
+        sql_chunks = r"""DELETE FROM log_chunks WHERE shot_id NOT IN (SELECT shot_id FROM job_logs);"""
+        sql_pending = r"""DELETE FROM log_search_pending WHERE shot_id NOT IN (SELECT shot_id FROM job_logs);"""
+        async with self.db_pool.connect() as conn:
+            await conn.execute(sql_fts)
+            async with conn.execute(sql_chunks) as cursor:
+                count = cursor.rowcount
+            await conn.execute(sql_pending)
+            await conn.commit()
+        return count
+
     async def stop(self):
         self._py_logger.info('关闭storage连接池')
         await self.db_pool.close()
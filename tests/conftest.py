@@ -0,0 +1,41 @@
+import os
+import sys
+import pathlib
+import typing
+import pytest
+
+ROOT = pathlib.Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import manage  # noqa: E402
+import worker  # noqa: E402
+
+
+@pytest.fixture
+def make_core(tmp_path):
+    """按配置创建CronWeb 未指定的配置使用tmp_path下的目录."""
+    async def make(**extra):
+        (tmp_path / 'static').exists() or os.symlink(ROOT / 'static', tmp_path / 'static')
+        config = {'core': {'dir_project': str(tmp_path)},
+                  'storage': {'db_path': str(tmp_path / 'db.sqlite3')},
+                  'logger': {'log_dir': str(tmp_path / 'logs')},
+                  'worker': {'work_dir': str(tmp_path), 'times_retry': 0},
+                  'web': {}}
+        for key, value in extra.items():
+            config.setdefault(key, {}).update(value)
+        core = await manage.init(config)
+        await core.job_check()
+        await core._worker.start()
+        return core
+    return make
+
+
+@pytest.fixture
+def shoot():
+    """手动运行一次任务 返回这次运行的记录."""
+    async def run(core, job, timeout: float = 30) -> typing.Any:
+        shot_ids = {record.shot_id for record in await core.job_logs_get_by_uuid(job.uuid)}
+        await core.shoot(job.command, job.param, job.uuid, timeout, job.name,
+                         worker.JobTypeEnum.MANUAL, options=job.options)
+        return next(record for record in await core.job_logs_get_by_uuid(job.uuid) if record.shot_id not in shot_ids)
+    return run
@@ -0,0 +1,76 @@
+import asyncio
+import random
+import time
+import pytest
+from worker.worker_aiosubprocess import DurationEstimator
+
+
+def test_estimator_quantiles():
+    estimator = DurationEstimator(window=10000, accuracy=0.02)
+    rng = random.Random(0)
+    samples = [rng.uniform(1, 100) for _ in range(5000)]
+    for seconds in samples:
+        estimator.add(seconds)
+    samples.sort()
+    for q in (0.5, 0.9, 0.99):
+        exact = samples[int(q * len(samples)) - 1]
+        assert estimator.quantile(q) == pytest.approx(exact, rel=0.05)
+    assert estimator.count == 5000
+
+
+def test_estimator_follows_recent_runs():
+    estimator = DurationEstimator(window=50)
+    for _ in range(200):
+        estimator.add(10)
+    for _ in range(300):
+        estimator.add(1)
+    # 旧样本的权重已经衰减 估计值只反映最近的运行
+    assert estimator.quantile(0.99) == pytest.approx(1, rel=0.03)
+    assert estimator.ewma == pytest.approx(1, rel=0.01)
+
+
+async def _prepare(make_core, tmp_path, action: str):
+    core = await make_core(worker={'adaptive_min_samples': 3, 'adaptive_min_timeout': 0.5})
+    duration = tmp_path / 'duration'
+    duration.write_text('0.05')
+    job = await core.add_job('0 0 1 1 *', f'sleep $(cat {duration})', '', name='adaptive',
+                             options={'adaptive_timeout': 2, 'adaptive_timeout_action': action})
+    return core, job, duration
+
+
+def test_adaptive_timeout_kills_slow_run(make_core, shoot, tmp_path):
+    async def main():
+        core, job, duration = await _prepare(make_core, tmp_path, 'kill')
+        try:
+            for _ in range(3):
+                assert (await shoot(core, job)).state == 'DONE'
+            stats = core._worker.get_duration_stats(job.uuid, None)
+            assert stats['count'] == 3
+            duration.write_text('10')
+            begin = time.monotonic()
+            record = await shoot(core, job)
+            # 样本足够后 超过max(adaptive_min_timeout, 2 * p99)的运行被停止
+            assert record.state == 'KILLED'
+            assert time.monotonic() - begin < 5
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100)
+            assert 'Killed Adaptive Timeout 0.5s' in log
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_adaptive_timeout_warns(make_core, shoot, tmp_path):
+    async def main():
+        core, job, duration = await _prepare(make_core, tmp_path, 'warn')
+        try:
+            for _ in range(3):
+                assert (await shoot(core, job)).state == 'DONE'
+            duration.write_text('1')
+            record = await shoot(core, job)
+            # 继续运行到结束 状态为WARN
+            assert record.state == 'WARN'
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100)
+            assert 'RUNNING LONGER THAN ADAPTIVE TIMEOUT' in log and 'Job WARN' in log
+        finally:
+            await core.stop()
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import os
+import asyncio
+import subprocess
+import pytest
+import logger
+import worker
+from worker.worker_aiosubprocess import AdoptedProcess, _process_start_id
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='requires /proc')
+
+
+def test_signal_rechecks_start_id():
+    async def main():
+        popen = subprocess.Popen(['sleep', '30'], start_new_session=True)
+        try:
+            stale = AdoptedProcess(popen.pid, popen.pid, 'boot:0')
+            # 启动标识不一致时不发送信号
+            with pytest.raises(ProcessLookupError):
+                stale.terminate()
+            assert popen.poll() is None
+            assert await stale.wait() == -1
+            stale.close()
+            adopted = AdoptedProcess(popen.pid, popen.pid, _process_start_id(popen.pid))
+            adopted.kill()
+            assert popen.wait(timeout=5) == -9
+            adopted.close()
+        finally:
+            if popen.poll() is None:
+                popen.kill()
+                popen.wait()
+    asyncio.run(main())
+
+
+def test_job_check_while_starting_does_not_adopt(make_core, shoot):
+    async def main():
+        core = await make_core(worker={'orphan_policy': 'kill'}, logger={'compress': 'none'})
+        set_job_running = core.set_job_running
+
+        async def set_job_running_checked(log_path, shot_state):
+            await set_job_running(log_path, shot_state)
+            # 记录为RUNNING之后立即检查一致性 包括启动时的接管
+            await core.job_check(adopt_orphans=True)
+            await core.job_check()
+
+        core.set_job_running = set_job_running_checked
+        try:
+            job = await core.add_job('0 0 1 1 *', 'sleep 0.3; echo finished', '', name='starting')
+            record = await shoot(core, job)
+            assert record.state == 'DONE'
+            assert 'finished' in await core.job_log_get_by_shot_id(record.shot_id)
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_periodic_job_check_does_not_adopt(make_core):
+    async def main():
+        core = await make_core()
+        popen = subprocess.Popen(['sleep', '30'], start_new_session=True)
+        try:
+            job = await core.add_job('0 0 1 1 *', 'sleep 30', '', name='orphan')
+            queue, log_path = core.get_log_queue(job.uuid, 'f' * 32, 10)
+            await core.set_job_running(log_path, worker.JobState(
+                job.uuid, worker.JobStateEnum.RUNNING, 'f' * 32, '2000-01-01 00:00:00',
+                pid=popen.pid, pgid=popen.pid, proc_start=_process_start_id(popen.pid)))
+            await core.job_check()
+            assert 'f' * 32 not in core.get_all_running_jobs()
+            assert popen.poll() is None
+            await queue.put(logger.LogStop)
+        finally:
+            popen.kill()
+            popen.wait()
+            await core.stop()
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+import asyncio
+import socket
+import pytest
+import agent as agent_module
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='agent tests run on posix')
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def _shoot(shoot, core, job):
+    """agent没有发回结果时在测试中失败而不是一直等待."""
+    return asyncio.wait_for(shoot(core, job), 20)
+
+
+@pytest.fixture
+def agent_cluster(make_core, tmp_path):
+    """本机的CronWeb和两个agent: gpu(容量1) cpu(容量2) 每个agent使用自己的工作目录."""
+    async def start():
+        port = _free_port()
+        core = await make_core(worker={'agent_token': 'token', 'agent_wait': 10})
+        server = asyncio.ensure_future(core._web.start_server('127.0.0.1', port, log_level='warning'))
+        agents = []
+        for name, labels, capacity in (('gpu', ['gpu', 'linux'], 1), ('cpu', ['cpu', 'linux'], 2)):
+            work_dir = tmp_path / f'agent-{name}'
+            work_dir.mkdir()
+            agent = agent_module.Agent(f'ws://127.0.0.1:{port}/api/agent/ws', 'token', name, labels, capacity,
+                                       str(work_dir))
+            agent.output_grace = 0.5
+            agents.append((agent, asyncio.ensure_future(agent.run())))
+        await _wait_for(lambda: len(core.get_agents()) == 2)
+
+        async def stop():
+            for agent, task in agents:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in agents), return_exceptions=True)
+            for agent, _ in agents:
+                agent.stop()
+            await core.stop()
+            core._web.shutdown()
+            await server
+        return core, port, stop
+    return start
+
+
+def test_agents_route_by_label_and_release_capacity(agent_cluster, shoot, tmp_path):
+    async def main():
+        core, port, stop = await agent_cluster()
+        try:
+            # 同时运行的每次运行使用各自的job 以便找到对应的运行记录
+            labels = ('gpu', 'gpu', 'cpu', 'cpu')
+            jobs = [await core.add_job('0 0 1 1 *', 'sleep 0.3; pwd', '', name=label, options={'labels': [label]})
+                    for label in labels]
+            running = []
+            sampling = True
+
+            async def sample():
+                while sampling:
+                    running.append({agent['name']: agent['running'] for agent in core.get_agents()})
+                    await asyncio.sleep(0.02)
+
+            sampler = asyncio.ensure_future(sample())
+            records = await asyncio.gather(*(_shoot(shoot, core, job) for job in jobs))
+            sampling = False
+            await sampler
+            for label, record in zip(labels, records):
+                assert record.state == 'DONE'
+                assert f'agent-{label}\n' in await core.job_log_get_by_shot_id(record.shot_id)
+            # gpu容量为1 两次运行依次执行 cpu容量为2 同时执行
+            assert max(sample['gpu'] for sample in running) == 1
+            assert max(sample['cpu'] for sample in running) == 2
+            assert all(agent['running'] == 0 for agent in core.get_agents())
+            # 没有agent拥有全部标签时不会分发
+            nobody = await core.add_job('0 0 1 1 *', 'pwd', '', name='nobody', options={'labels': ['gpu', 'cpu']})
+            core._worker.agent_wait = 0.2
+            assert (await _shoot(shoot, core, nobody)).state != 'DONE'
+        finally:
+            await stop()
+    asyncio.run(main())
+
+
+def test_agent_output_errors_release_capacity(agent_cluster, shoot):
+    async def main():
+        core, port, stop = await agent_cluster()
+        try:
+            # 超过64KiB的单行输出
+            long_line = await core.add_job('0 0 1 1 *', 'python3 -c "print(\'x\' * 300000)"', '', name='long',
+                                           options={'labels': ['gpu']})
+            record = await _shoot(shoot, core, long_line)
+            assert record.state == 'DONE'
+            assert 'x' * 300000 in await core.job_log_get_by_shot_id(record.shot_id)
+            # http任务的输出不是StreamReader
+            http = await core.add_job('0 0 1 1 *', f'http://127.0.0.1:{port}/api/sys/connection', '', name='http',
+                                      options={'labels': ['gpu'], 'exec_mode': 'http'})
+            record = await _shoot(shoot, core, http)
+            assert record.state == 'DONE'
+            assert 'hello' in await core.job_log_get_by_shot_id(record.shot_id)
+            # 后台子进程仍然持有stdout 任务结束后只等待output_grace
+            background = await core.add_job('0 0 1 1 *', 'sleep 3 & echo started', '', name='background',
+                                            options={'labels': ['gpu']})
+            record = await _shoot(shoot, core, background)
+            assert record.state == 'DONE'
+            # 读取输出失败时仍然发送done 容量被释放
+            gpu_agent = next(agent for agent in core._worker._agents.values() if agent.name == 'gpu')
+            assert not gpu_agent.processes
+            assert (await _shoot(shoot, core, long_line)).state == 'DONE'
+        finally:
+            await stop()
+    asyncio.run(main())
+
+
+def test_agent_reports_read_failure(agent_cluster, shoot, monkeypatch):
+    async def main():
+        core, port, stop = await agent_cluster()
+        try:
+            async def broken(self, task_id, proc):
+                raise ValueError('broken reader')
+
+            monkeypatch.setattr(agent_module.Agent, '_forward_output', broken)
+            job = await core.add_job('0 0 1 1 *', 'sleep 30', '', name='broken', options={'labels': ['gpu']})
+            record = await _shoot(shoot, core, job)
+            assert record.state == 'ERROR'
+            assert 'broken reader' in await core.job_log_get_by_shot_id(record.shot_id)
+            assert all(agent['running'] == 0 for agent in core.get_agents())
+        finally:
+            await stop()
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+import asyncio
+import cronweb
+import worker
+
+
+def test_positional_instances(tmp_path):
+    async def main():
+        worker_instance, storage_instance = object(), object()
+        core = cronweb.CronWeb(7, tmp_path, worker_instance, storage_instance, drain_timeout=5)
+        assert core._worker is worker_instance and core._storage is storage_instance
+        assert core._log_expire_days == 7 and core.drain_timeout == 5
+    asyncio.run(main())
+
+
+async def _wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if await condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def _watch_shutdown(core) -> asyncio.Event:
+    """排空结束时CronWeb停止web服务 测试中没有启动服务 记录调用."""
+    called = asyncio.Event()
+    core._web.shutdown = called.set
+    return called
+
+
+def test_drain_waits_for_running_jobs(make_core, tmp_path):
+    async def main():
+        core = await make_core(worker={'times_retry': 1, 'wait_retry_base': 0.05})
+        shutdown = _watch_shutdown(core)
+        try:
+            await core._instance_register()
+            job = await core.add_job('0 0 1 1 *', 'sleep 1.2', '', name='long')
+            failing = await core.add_job('0 0 1 1 *', 'exit 1', '', name='fail')
+            running = asyncio.ensure_future(core.shoot(job.command, job.param, job.uuid, 30, job.name,
+                                                       worker.JobTypeEnum.MANUAL, options=job.options))
+
+            async def started():
+                return bool(core.get_all_running_jobs())
+            await _wait_until(started)
+            status = await core.drain()
+            assert status['draining'] and status['running'] == 1
+            instance, = await core.get_instances()
+            assert instance['state'] == 'DRAINING' and instance['date_drain'] is not None
+            # 排空中安排的重试留在storage中 由接管的实例执行
+            await core.shoot(failing.command, failing.param, failing.uuid, 30, failing.name,
+                             worker.JobTypeEnum.MANUAL, options=failing.options)
+            assert len(await core.retry_get_all()) == 1 and core._retry_handle is None
+            await asyncio.sleep(0.3)
+            assert not shutdown.is_set()
+            await running
+            await asyncio.wait_for(shutdown.wait(), 5)
+            record, = await core.job_logs_get_by_uuid(job.uuid)
+            assert record.state == 'DONE'
+            assert len(await core.job_logs_get_by_uuid(failing.uuid)) == 1
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_drain_timeout(make_core):
+    async def main():
+        core = await make_core(core={'drain_timeout': 0.5})
+        shutdown = _watch_shutdown(core)
+        try:
+            job = await core.add_job('0 0 1 1 *', 'sleep 30', '', name='stuck')
+            asyncio.ensure_future(core.shoot(job.command, job.param, job.uuid, 60, job.name,
+                                             worker.JobTypeEnum.MANUAL, options=job.options))
+
+            async def started():
+                return bool(core.get_all_running_jobs())
+            await _wait_until(started)
+            await core.drain()
+            # 超过drain_timeout后不再等待 退出时停止剩余的任务
+            await asyncio.wait_for(shutdown.wait(), 5)
+            assert core.get_all_running_jobs()
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_handoff_catches_up_missed_fires(make_core):
+    async def main():
+        old = await make_core()
+        _watch_shutdown(old)
+        old.stop_all_trigger()
+        new = None
+        try:
+            await old._instance_register()
+            job = await old.add_job('* * * * *', 'echo fired', '', name='minutely')
+            await old.drain()
+            new = await make_core()
+            new.stop_all_trigger()
+            await new._instance_register()
+            # 接收交接 补发排空开始前一段时间内的定时触发(每分钟至少一次)
+            await new._handoff_catch_up()
+
+            async def fired():
+                records = await new.job_logs_get_by_uuid(job.uuid)
+                return len(records) == 1 and records[0].state == 'DONE'
+            await _wait_until(fired)
+            # 交接只接收一次 已经认领的触发不会重复执行
+            await new._handoff_catch_up()
+            drained, = [instance for instance in await new.get_instances()
+                        if instance['instance_id'] == old.instance_id]
+            date_drain = drained['date_drain']
+            fire_ts = new._trigger.fire_times(job.uuid, date_drain - new._HANDOFF_MARGIN, date_drain)[-1]
+            await new.shoot(job.command, job.param, job.uuid, 30, job.name, fire_ts=fire_ts)
+            await asyncio.sleep(0.3)
+            assert len(await new.job_logs_get_by_uuid(job.uuid)) == 1
+        finally:
+            await old.stop()
+            if new is not None:
+                await new.stop()
+    asyncio.run(main())
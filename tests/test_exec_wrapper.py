@@ -0,0 +1,90 @@
+import os
+import asyncio
+import pytest
+from worker import exec_wrapper
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='exec_wrapper is only used on posix')
+
+
+def _job_log(make_core, shoot, command, options):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', command, 'p1', name='wrapped', options=options)
+            record = await shoot(core, job)
+            return record, await core.job_log_get_by_shot_id(record.shot_id)
+        finally:
+            await core.stop()
+    return asyncio.run(main())
+
+
+_PROBE = ('echo nice=$(cut -d" " -f19 /proc/self/stat); echo nofile=$(ulimit -Sn); '
+          'echo param=$(cat "$CRONWEB_PARAM_FILE"); grep Cpus_allowed_list /proc/self/status')
+
+
+@pytest.fixture(params=['pid', 'wrapper'])
+def apply_mode(request, monkeypatch):
+    """pid: worker启动子进程后从外部设置 wrapper: 不支持从外部设置时通过exec_wrapper启动."""
+    if request.param == 'pid':
+        if not exec_wrapper.pid_supported({'rlimits': [('RLIMIT_NOFILE', 64, 64)]}):
+            pytest.skip('resource.prlimit is not available')
+
+        def no_wrapper(settings, args):
+            raise AssertionError('exec_wrapper should not be used')
+        monkeypatch.setattr(exec_wrapper, 'wrap_args', no_wrapper)
+    else:
+        monkeypatch.setattr(exec_wrapper, 'pid_supported', lambda settings: False)
+    return request.param
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='requires /proc')
+@pytest.mark.parametrize('exec_mode', ['shell', 'exec'])
+def test_settings_applied_before_exec(make_core, shoot, apply_mode, exec_mode):
+    nice = os.getpriority(os.PRIO_PROCESS, 0) + 3
+    options = {'nice': nice, 'rlimit_nofile': 64, 'param_mode': 'file', 'exec_mode': exec_mode}
+    if hasattr(os, 'sched_setaffinity'):
+        options['cpu_affinity'] = [min(os.sched_getaffinity(0))]
+    command = _PROBE if exec_mode == 'shell' else f"sh -c '{_PROBE}'"
+    record, log = _job_log(make_core, shoot, command, options)
+    assert record.state == 'DONE', log
+    assert f'nice={nice}\n' in log and 'nofile=64\n' in log and 'param=p1\n' in log
+    if 'cpu_affinity' in options:
+        assert f"Cpus_allowed_list:\t{options['cpu_affinity'][0]}\n" in log
+
+
+def test_apply_failure_stops_before_command(make_core, shoot, monkeypatch, tmp_path):
+    if not exec_wrapper.pid_supported({}):
+        pytest.skip('resource.prlimit is not available')
+
+    def failing(settings, pid=0):
+        raise PermissionError('apply failed')
+    monkeypatch.setattr(exec_wrapper, 'apply', failing)
+    marker = tmp_path / 'marker'
+    record, log = _job_log(make_core, shoot, f'touch {marker}', {'nice': 1})
+    assert record.state == 'ERROR'
+    assert 'apply failed' in log
+    assert not marker.exists()
+
+
+def test_setup_failure_is_reported(make_core, shoot, apply_mode):
+    # 非特权进程不能提高优先级
+    if os.geteuid() == 0:
+        pytest.skip('root can lower nice values')
+    record, log = _job_log(make_core, shoot, 'echo unreachable', {'nice': -20})
+    assert record.state != 'DONE'
+    assert 'unreachable' not in log
+    if apply_mode == 'wrapper':
+        assert 'exec_wrapper' in log
+
+
+def test_wrapper_exit_codes(tmp_path):
+    argv = exec_wrapper.wrap_args({}, [str(tmp_path / 'missing')])
+    assert asyncio.run(_returncode(argv)) == exec_wrapper.EXIT_NOT_FOUND
+    argv = exec_wrapper.wrap_args({'rlimits': [('RLIMIT_NOT_EXISTS', 1, 1)]}, ['true'])
+    assert asyncio.run(_returncode(argv)) == exec_wrapper.EXIT_SETUP_FAILED
+    assert asyncio.run(_returncode(exec_wrapper.wrap_args({'nice': None}, ['true']))) == 0
+
+
+async def _returncode(argv) -> int:
+    proc = await asyncio.create_subprocess_exec(*argv, stderr=asyncio.subprocess.DEVNULL)
+    return await proc.wait()
@@ -0,0 +1,141 @@
+import asyncio
+import pytest
+from worker.worker_aiosubprocess import HookExecutor
+
+
+def make_hook(calls, tag):
+    async def hook(value):
+        calls.append((tag, value))
+    return hook
+
+
+def make_blocking_hook(calls, release: asyncio.Event, loop: asyncio.AbstractEventLoop):
+    async def hook(value):
+        # hook在hook线程的事件循环中执行 等待主循环中的release
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(release.wait(), loop))
+        calls.append(value)
+    return hook
+
+
+async def wait_for(condition, timeout: float = 5):
+    for _ in range(int(timeout * 100)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('condition not met')
+
+
+def test_closures_from_one_factory_are_distinct():
+    async def main():
+        executor = HookExecutor()
+        calls = []
+        hook_a, hook_b = make_hook(calls, 'a'), make_hook(calls, 'b')
+        name_a, name_b = executor.register(hook_a), executor.register(hook_b)
+        assert name_a != name_b
+        assert executor.register(hook_a) == name_a
+        executor.start()
+        try:
+            await executor.submit(hook_a, (1,))
+            await executor.submit(hook_b, (2,))
+            await wait_for(lambda: len(calls) == 2)
+            assert sorted(calls) == [('a', 1), ('b', 2)]
+            hooks = executor.get_stats()['hooks']
+            assert hooks[name_a]['count'] == 1 and hooks[name_b]['count'] == 1
+        finally:
+            executor.stop()
+    asyncio.run(main())
+
+
+def test_spill_rejects_duplicate_names(tmp_path):
+    async def main():
+        executor = HookExecutor(overflow='spill', spill_path=tmp_path / 'spill.jsonl')
+        try:
+            executor.register(make_hook([], 'a'))
+            with pytest.raises(ValueError):
+                executor.register(make_hook([], 'b'))
+            executor.register(make_hook([], 'b'), name='hook_b')
+        finally:
+            executor.stop()
+    asyncio.run(main())
+
+
+def test_drop_oldest():
+    async def main():
+        release = asyncio.Event()
+        calls = []
+        executor = HookExecutor(queue_size=2, concurrency=1)
+        hook = make_blocking_hook(calls, release, asyncio.get_event_loop())
+        name = executor.register(hook)
+        executor.start()
+        try:
+            await executor.submit(hook, (0,))
+            await wait_for(lambda: not executor._queue)
+            for i in range(1, 5):
+                await executor.submit(hook, (i,))
+            release.set()
+            await wait_for(lambda: len(calls) == 3)
+            assert calls == [0, 3, 4]
+            assert executor.get_stats()['hooks'][name]['dropped'] == 2
+        finally:
+            executor.stop()
+    asyncio.run(main())
+
+
+def test_block_timeout():
+    async def main():
+        release = asyncio.Event()
+        calls = []
+        executor = HookExecutor(queue_size=1, concurrency=1, overflow='block', block_timeout=0.1)
+        hook = make_blocking_hook(calls, release, asyncio.get_event_loop())
+        name = executor.register(hook)
+        executor.start()
+        try:
+            await executor.submit(hook, (0,))
+            await wait_for(lambda: not executor._queue)
+            await executor.submit(hook, (1,))
+            await executor.submit(hook, (2,))
+            assert executor.get_stats()['hooks'][name]['dropped'] == 1
+            release.set()
+            await wait_for(lambda: len(calls) == 2)
+            assert calls == [0, 1]
+        finally:
+            executor.stop()
+    asyncio.run(main())
+
+
+def test_spill_and_restart(tmp_path):
+    spill_path = tmp_path / 'spill.jsonl'
+
+    async def first():
+        release = asyncio.Event()
+        executor = HookExecutor(queue_size=2, concurrency=1, overflow='spill', spill_path=spill_path)
+        hook = make_blocking_hook([], release, asyncio.get_event_loop())
+        executor.register(hook, name='hook')
+        executor.start()
+        try:
+            await executor.submit(hook, (0,))
+            await wait_for(lambda: not executor._queue)
+            for i in range(1, 8):
+                await executor.submit(hook, (i,))
+            assert executor.get_stats()['spilled'] == 5
+        finally:
+            # 停止时队列中的hook同样写入磁盘 重启后执行
+            executor.stop()
+
+    async def second():
+        calls = []
+        executor = HookExecutor(queue_size=2, concurrency=1, overflow='spill', spill_path=spill_path)
+
+        async def hook(value):
+            calls.append(value)
+        executor.register(hook, name='hook')
+        executor.start()
+        try:
+            await wait_for(lambda: len(calls) == 7 and not executor.get_stats()['spilled'])
+        finally:
+            executor.stop()
+        return calls
+
+    asyncio.run(first())
+    assert sorted(asyncio.run(second())) == list(range(1, 8))
+    assert spill_path.stat().st_size == 0
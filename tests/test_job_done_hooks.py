@@ -0,0 +1,37 @@
+import asyncio
+import functools
+import worker
+
+
+def test_context_hook_registration(make_core, shoot):
+    received = {}
+
+    async def hook_plain(name, shot_id, state, job_type):
+        received['plain'] = (name, shot_id, state, job_type)
+
+    async def hook_context(context, extra=None):
+        received['context'] = context
+
+    async def hook_partial(tag, context):
+        received[tag] = context
+
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            core.add_job_done_hook(hook_plain)
+            # 有默认值的参数和partial不影响调用方式
+            core.add_job_done_context_hook(hook_context)
+            core.add_job_done_context_hook(functools.partial(hook_partial, 'partial'))
+            job = await core.add_job('0 0 1 1 *', 'echo hi', '', name='hooks')
+            record = await shoot(core, job)
+            for _ in range(200):
+                if len(received) == 3:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await core.stop()
+        assert received['plain'] == ('hooks', record.shot_id, worker.JobStateEnum.DONE, worker.JobTypeEnum.MANUAL)
+        assert received['context'].shot_id == record.shot_id
+        assert received['context'].output_tail == 'hi\n'
+        assert received['partial'] is received['context']
+    asyncio.run(main())
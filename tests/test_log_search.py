@@ -0,0 +1,130 @@
+import asyncio
+import pytest
+import manage
+
+# 输出的内容不出现在日志头部的命令行中
+COMMAND = "printf 'alpha\\nneedle%s\\nomega\\ntail%s\\n' 42 77"
+
+
+async def _wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if await condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+async def _make_search_core(make_core):
+    core = await make_core(core={'log_search_batch_lines': 2, 'log_search_cpu_share': 1},
+                           logger={'compress': 'none'})
+    if not core._storage.log_search_available:
+        await core.stop()
+        pytest.skip('sqlite has no fts5')
+    return core
+
+
+def _start_indexer(core):
+    """与run()相同 在后台建立索引 core.stop()时取消."""
+    core._log_search_task = asyncio.ensure_future(core._log_search_index())
+
+
+async def _wait_indexed(core):
+    async def indexed():
+        return not await core._storage.log_search_pending(100)
+    await _wait_until(indexed)
+
+
+def test_search_finds_output_by_batch(make_core, shoot):
+    async def main():
+        core = await _make_search_core(make_core)
+        _start_indexer(core)
+        try:
+            job = await core.add_job('0 0 1 1 *', COMMAND, '', name='a')
+            other = await core.add_job('0 0 1 1 *', "printf 'unrel%s\\n' ated", '', name='b')
+            record = await shoot(core, job)
+            await shoot(core, other)
+            await _wait_indexed(core)
+
+            hits = await core.log_search('NEEDLE42')
+            assert [(hit.shot_id, hit.uuid) for hit in hits] == [(record.shot_id, job.uuid)]
+            # 每log_search_batch_lines行一段 needle42和tail77不在同一段
+            assert 'tail77' not in hits[0].snippet
+            tail = await core.log_search('tail77')
+            assert tail[0].line == hits[0].line + 2
+            # line可以定位日志中的内容
+            lines = core._aiolog.iter_log_lines(record.log_path, 1, hits[0].line)
+            assert await lines.__anext__() == 'needle42\n'
+            await lines.aclose()
+
+            assert await core.log_search('needle42', other.uuid) == []
+            assert len(await core.log_search('unrelated', other.uuid)) == 1
+            assert await core.log_search('needle42 tail77') == []
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_pending_log_indexed_after_restart(make_core, shoot):
+    async def main():
+        old = await _make_search_core(make_core)
+        try:
+            # 索引任务没有运行 运行结束的日志留在等待队列
+            job = await old.add_job('0 0 1 1 *', COMMAND, '', name='a')
+            record = await shoot(old, job)
+            assert [shot_id for shot_id, _ in await old._storage.log_search_pending(100)] == [record.shot_id]
+            assert await old.log_search('needle42') == []
+        finally:
+            await old.stop()
+
+        new = await _make_search_core(make_core)
+        _start_indexer(new)
+        try:
+            await _wait_indexed(new)
+            assert [hit.shot_id for hit in await new.log_search('needle42')] == [record.shot_id]
+        finally:
+            await new.stop()
+    asyncio.run(main())
+
+
+def test_index_resumes_from_recorded_line(make_core, shoot):
+    async def main():
+        core = await _make_search_core(make_core)
+        try:
+            job = await core.add_job('0 0 1 1 *', COMMAND, '', name='a')
+            record = await shoot(core, job)
+            ((shot_id, line),) = await core._storage.log_search_pending(100)
+            assert line == 0
+            # 模拟索引第一段后中断 继续时从记录的行开始 不重复写入
+            await core._storage.log_search_add(shot_id, 0, 'first batch\n', 2)
+            assert await core._storage.log_search_pending(100) == [(shot_id, 2)]
+            await core._log_search_index_shot(shot_id, 2)
+            assert await core._storage.log_search_pending(100) == []
+            assert len(await core.log_search('first batch')) == 1
+            assert [hit.shot_id for hit in await core.log_search('needle42')] == [record.shot_id]
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_search_disabled(make_core, shoot):
+    async def main():
+        core = await make_core(core={'log_search': False})
+        try:
+            job = await core.add_job('0 0 1 1 *', COMMAND, '', name='a')
+            await shoot(core, job)
+            if core._storage.log_search_available:
+                assert await core._storage.log_search_pending(100) == []
+                assert await core.log_search('needle42') == []
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('share', [0, -0.5, 1.5])
+def test_cpu_share_validated(tmp_path, share):
+    config = {'core': {'dir_project': str(tmp_path), 'log_search_cpu_share': share},
+              'storage': {'db_path': str(tmp_path / 'db.sqlite3')},
+              'logger': {'log_dir': str(tmp_path / 'logs')},
+              'worker': {'work_dir': str(tmp_path)}, 'web': {}}
+    with pytest.raises(ValueError):
+        asyncio.run(manage.init(config))
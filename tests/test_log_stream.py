@@ -0,0 +1,101 @@
+import asyncio
+import socket
+import aiohttp
+import worker
+
+# 分几次输出 订阅时任务仍在运行
+SLOW_OUTPUT = 'for i in 1 2 3 4 5 6; do echo line$i; sleep 0.1; done'
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _start_running(core, command: str, name: str):
+    """在后台运行任务 返回(job, 运行记录, 运行的task) 返回时任务正在运行."""
+    job = await core.add_job('0 0 1 1 *', command, '', name=name)
+    task = asyncio.ensure_future(core.shoot(job.command, job.param, job.uuid, 30, job.name,
+                                            worker.JobTypeEnum.MANUAL, options=job.options))
+    for _ in range(500):
+        records = await core.job_logs_get_by_uuid(job.uuid)
+        if records:
+            return job, records[0], task
+        await asyncio.sleep(0.01)
+    raise AssertionError('job did not start')
+
+
+async def _collect(stream) -> str:
+    return ''.join([content async for content in stream])
+
+
+def test_stream_viewers_get_full_log(make_core):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job, record, task = await _start_running(core, SLOW_OUTPUT, 'slow')
+            first = asyncio.ensure_future(_collect(await core.job_log_stream(record.shot_id)))
+            await asyncio.sleep(0.25)
+            # 之后加入的订阅者先读取文件中已有的内容 再接收实时内容 两部分之间不重复不遗漏
+            second = asyncio.ensure_future(_collect(await core.job_log_stream(record.shot_id)))
+            await task
+            outputs = await asyncio.wait_for(asyncio.gather(first, second), 10)
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000)
+            assert outputs[0] == outputs[1] == log
+            assert ''.join(f'line{i}\n' for i in range(1, 7)) in log
+            # 结束后订阅只读取文件
+            assert await _collect(await core.job_log_stream(record.shot_id)) == log
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_stream_slow_viewer_is_dropped(make_core):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job, record, task = await _start_running(core, SLOW_OUTPUT, 'slow')
+            stream = await core.job_log_stream(record.shot_id, buffer_size=1)
+            # 开始订阅后不再读取 缓冲满后订阅结束 不阻塞日志记录
+            contents = [await stream.__anext__()]
+            await asyncio.wait_for(task, 10)
+            contents += [content async for content in stream]
+            received = ''.join(contents)
+            assert received.endswith('\n#### STREAM LAGGED ####\n')
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000)
+            assert log.startswith(received[:-len('\n#### STREAM LAGGED ####\n')])
+            assert 'Job DONE' in log
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_stream_sse_endpoint(make_core):
+    async def main():
+        port = _free_port()
+        core = await make_core(logger={'compress': 'none'})
+        server = asyncio.ensure_future(core._web.start_server('127.0.0.1', port, log_level='warning'))
+        try:
+            job, record, task = await _start_running(core, SLOW_OUTPUT, 'slow')
+            url = f'http://127.0.0.1:{port}/api/log/{record.shot_id}/stream'
+            for _ in range(250):
+                try:
+                    async with aiohttp.ClientSession() as session:
+                        async with session.get(url) as resp:
+                            assert resp.headers['Content-Type'].startswith('text/event-stream')
+                            body = await asyncio.wait_for(resp.text(), 10)
+                    break
+                except aiohttp.ClientConnectorError:
+                    await asyncio.sleep(0.02)
+            await task
+            events = body.split('\n\n')
+            assert events[-2] == 'event: end\ndata: '
+            # 每个事件是一段日志内容 事件中的多行data以换行连接
+            data = ''.join('\n'.join(line[len('data: '):] for line in event.split('\n')) for event in events[:-2])
+            assert data == await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000)
+        finally:
+            await core.stop()
+            core._web.shutdown()
+            await server
+    asyncio.run(main())
@@ -0,0 +1,228 @@
+import asyncio
+import pathlib
+import threading
+import pytest
+import logger
+
+
+async def wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def log_settled(core, log_path: str, backend: str) -> bool:
+    """日志记录结束后的压缩或写入分段文件已经完成."""
+    aiolog = core._aiolog
+    if aiolog._recorded_tasks or aiolog.task_dict:
+        return False
+    return not pathlib.Path(log_path).exists() if backend == 'segment' else True
+
+
+@pytest.mark.parametrize('backend, compress', [('file', 'gzip'), ('file', 'none'), ('segment', 'none')])
+def test_append_to_finished_log(make_core, shoot, backend, compress):
+    async def main():
+        core = await make_core(logger={'backend': backend, 'compress': compress})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'seq 1 50', '', name='seq')
+            record = await shoot(core, job)
+            await wait_until(lambda: log_settled(core, record.log_path, backend))
+            queue, path = core.get_log_queue(job.uuid, record.shot_id, 10, log_path=record.log_path)
+            assert str(path) == record.log_path
+            await queue.put('\nappended 1\nappended 2\n')
+            await queue.put(logger.LogStop)
+            await wait_until(lambda: log_settled(core, record.log_path, backend))
+            log = await core.job_log_get_by_shot_id(record.shot_id)
+            assert log.count('#### OUTPUT ####') == 1
+            assert '50\n' in log and 'appended 1\nappended 2\n' in log
+            lines = log.splitlines(keepends=True)
+            assert await core.job_log_get_by_shot_id(record.shot_id, offset=30, limit_line=5) == ''.join(lines[30:35])
+            assert await core.job_log_get_by_shot_id(record.shot_id, tail=3) == ''.join(lines[-3:])
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def _reference(lines, offset=0, limit=1000, tail=None):
+    if tail is not None:
+        return ''.join(lines[-tail:] if tail else [])
+    return ''.join(lines[offset:offset + limit])
+
+
+@pytest.mark.parametrize('method', ['gzip', 'zstd'])
+@pytest.mark.parametrize('last_newline', [True, False])
+def test_compressed_offset_and_tail(tmp_path, method, last_newline):
+    from logger import logger_aio
+    if method == 'zstd' and logger_aio.zstandard is None:
+        pytest.skip('zstandard is not installed')
+    lines = [f'line {i} ' + 'x' * (i % 37) + '\n' for i in range(2000)]
+    # 超过frame大小且没有换行的行
+    lines[700] = 'y' * 300 + '\n'
+    if not last_newline:
+        lines[-1] = lines[-1].rstrip('\n')
+    path = tmp_path / '1-shot.log'
+    path.write_bytes(''.join(lines).encode('utf8'))
+    path_compressed = logger_aio._compress_file(path, method, None, frame_size=128)
+    assert not path.exists()
+    entries = logger_aio._read_frame_index(logger_aio._path_index(path_compressed))
+    assert len(entries) > 100 and entries[-1] == (2000, path_compressed.stat().st_size)
+    for offset in (0, 1, 5, 699, 700, 701, 1234, 1999, 2000, 2500):
+        for limit in (1, 3, 50):
+            assert logger_aio._read_lines(path_compressed, limit, offset) == _reference(lines, offset, limit)
+        with logger_aio._open_lines(path_compressed, offset) as fp:
+            assert fp.read().decode('utf8') == ''.join(lines[offset:])
+    for tail in (0, 1, 2, 17, 1999, 2000, 3000):
+        assert logger_aio._read_lines(path_compressed, 1000, tail=tail) == _reference(lines, tail=tail)
+
+
+def test_segment_offset_and_tail(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'backend': 'segment', 'segment_size': 1, 'compact_ratio': 1.1})
+        aiolog = core._aiolog
+        try:
+            job = await core.add_job('0 0 1 1 *', 'seq 1 3000', '', name='seq')
+            records = []
+            for _ in range(3):
+                record = await shoot(core, job)
+                await wait_until(lambda: log_settled(core, record.log_path, 'segment'))
+                records.append(record)
+
+            async def check(record):
+                segment, _, length, index_length = await core.log_segment_get(record.shot_id)
+                assert index_length > 0
+                log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=10000)
+                assert len(log.encode('utf8')) == length
+                lines = log.splitlines(keepends=True)
+                for offset in (0, 1, 15, 16, 17, 1000, len(lines) - 1, len(lines), len(lines) + 5):
+                    for limit in (1, 40):
+                        assert (await core.job_log_get_by_shot_id(record.shot_id, offset=offset, limit_line=limit)
+                                == _reference(lines, offset, limit))
+                    read = ''.join([batch async for batch in aiolog.iter_log_lines(record.log_path, 100, offset)])
+                    assert read == ''.join(lines[offset:])
+                for tail in (1, 3, len(lines), len(lines) + 5):
+                    assert await core.job_log_get_by_shot_id(record.shot_id, tail=tail) == _reference(lines, tail=tail)
+                return segment
+
+            segments = [await check(record) for record in records]
+            assert len(set(segments)) == 3
+            # 压缩后日志和索引一起移动到当前分段文件
+            await aiolog.compact()
+            for record, segment in zip(records, segments):
+                assert (await check(record) != segment) == (segment < segments[-1])
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_segment_compact_does_not_block_writes(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'backend': 'segment', 'segment_size': 1, 'compact_ratio': 1.1})
+        aiolog = core._aiolog
+        try:
+            job = await core.add_job('0 0 1 1 *', 'seq 1 100', '', name='seq')
+            old = []
+            for _ in range(2):
+                old.append(await shoot(core, job))
+                await wait_until(lambda: log_settled(core, old[-1].log_path, 'segment'))
+            expected = await core.job_log_get_by_shot_id(old[0].shot_id, limit_line=1000)
+            copying, release = threading.Event(), threading.Event()
+            append_parts = aiolog._append_parts
+
+            def slow_append(path, *parts):
+                if path != aiolog._segment_path(aiolog._segment_current):
+                    # 压缩的复制
+                    copying.set()
+                    release.wait(10)
+                return append_parts(path, *parts)
+            aiolog._append_parts = slow_append
+            compact = asyncio.ensure_future(aiolog.compact())
+            await asyncio.get_event_loop().run_in_executor(None, copying.wait, 10)
+            # 复制期间新的日志仍然可以写入分段文件
+            record = await shoot(core, job)
+            await wait_until(lambda: log_settled(core, record.log_path, 'segment'))
+            assert not compact.done()
+            release.set()
+            await compact
+            assert await core.job_log_get_by_shot_id(old[0].shot_id, limit_line=1000) == expected
+            segments = {(await core.log_segment_get(r.shot_id))[0] for r in (*old, record)}
+            assert aiolog._segments() == sorted(segments)
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_segment_log_check_removes_legacy_files(make_core, shoot, tmp_path):
+    async def main():
+        core = await make_core(logger={'backend': 'segment'})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo 1', '', name='echo')
+            record = await shoot(core, job)
+            await wait_until(lambda: log_settled(core, record.log_path, 'segment'))
+            # 切换到分段日志之前log_dir中的日志文件
+            legacy_kept = tmp_path / 'logs' / f'1-{record.shot_id}.log'
+            legacy_removed = [tmp_path / 'logs' / name for name in ('1-0deleted.log', '1-0deleted.log.idx')]
+            for path in [legacy_kept, *legacy_removed]:
+                path.write_text('legacy\n')
+            await core.log_check()
+            assert legacy_kept.exists()
+            assert not any(path.exists() for path in legacy_removed)
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_job_log_compress_option(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            plain = await core.add_job('0 0 1 1 *', 'seq 1 2000', '', name='plain')
+            packed = await core.add_job('0 0 1 1 *', 'seq 1 2000', '', name='packed',
+                                        options={'log_compress': 'gzip'})
+            logs = {}
+            for job in (plain, packed):
+                record = await shoot(core, job)
+                await wait_until(lambda: log_settled(core, record.log_path, 'file'))
+                logs[job.name] = record
+            # job的log_compress优先于logger的默认设置
+            assert pathlib.Path(logs['plain'].log_path).exists()
+            path = pathlib.Path(logs['packed'].log_path)
+            assert not path.exists() and path.with_name(path.name + '.gz').exists()
+            expected = await core.job_log_get_by_shot_id(logs['plain'].shot_id, limit_line=10000)
+            log = await core.job_log_get_by_shot_id(logs['packed'].shot_id, limit_line=10000)
+            # 读取时透明解压 输出部分相同
+            def output(text):
+                return text.split('#### OUTPUT ####')[1].split('#### OUTPUT END ####')[0]
+            assert output(log) == output(expected) == '\n' + ''.join(f'{i}\n' for i in range(1, 2001)) + '\n'
+            stream = await core.job_log_stream(logs['packed'].shot_id)
+            assert ''.join([content async for content in stream]) == log
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_compress_existing_logs(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'seq 1 100', '', name='old')
+            kept = await core.add_job('0 0 1 1 *', 'seq 1 100', '', name='kept', options={'log_compress': 'none'})
+            record = await shoot(core, job)
+            record_kept = await shoot(core, kept)
+            await wait_until(lambda: log_settled(core, record_kept.log_path, 'file'))
+            before = await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000)
+        finally:
+            await core.stop()
+        # 切换默认压缩方式后压缩已有的日志 job设置了不压缩的日志保持不变
+        core = await make_core(logger={'compress': 'gzip'})
+        try:
+            assert await core.log_compress_existing() == 1
+            path = pathlib.Path(record.log_path)
+            assert not path.exists() and path.with_name(path.name + '.gz').exists()
+            assert pathlib.Path(record_kept.log_path).exists()
+            assert await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000) == before
+            assert await core.log_compress_existing() == 0
+        finally:
+            await core.stop()
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+import re
+import random
+import pytest
+import worker
+from worker.worker_aiosubprocess import OutputMatcher, _required_literal
+
+
+@pytest.mark.parametrize('pattern, literal', [
+    (r'\x41BC', b'ABC'),
+    (r'\101', b'A'),
+    (r'a\x42c', b'aBc'),
+    (r'\0', b'\x00'),
+    (r'a\tb', b'a\tb'),
+    (r'\bERROR\b', b'ERROR'),
+    (r'foo\d+bar', b'foo'),
+    (r'a\.b', b'a.b'),
+    (r'ab*', b'a'),
+    (r'a\x42*', b'a'),
+    (r'(a)\1xyz', b'xyz'),
+    (r'x\N{DIGIT ONE}yz', b'yz'),
+    ('é\\xe9', 'é'.encode('utf8') + b'\xe9'),
+    (r'a|b', None),
+    (r'(?i)error', None),
+])
+def test_required_literal(pattern, literal):
+    assert _required_literal(pattern) == literal
+
+
+@pytest.mark.parametrize('pattern, line', [
+    (r'\x41BC', b'xxABCxx\n'),
+    (r'\101', b'A\n'),
+    (r'a\x42c', b'aBc\n'),
+])
+def test_required_literal_matches(pattern, line):
+    # 字面量必须出现在匹配的行中 否则预过滤会漏掉匹配
+    assert re.search(pattern.encode('utf8'), line)
+    assert _required_literal(pattern) in line
+
+
+def _classify(fail_patterns, warn_patterns, lines):
+    classifier = OutputMatcher(fail_patterns, warn_patterns).classifier()
+    for line in lines:
+        classifier.feed(line)
+    classifier.finish()
+    return classifier.state, classifier.line
+
+
+def test_classifier_escaped_literal():
+    lines = [b'ok\n'] * 1000 + [b'code ABC failed\n'] + [b'ok\n'] * 1000
+    assert _classify([r'\x41BC'], [], lines) == (worker.JobStateEnum.ERROR, b'code ABC failed\n')
+
+
+def test_classifier_warn_then_fail():
+    lines = [b'a deprecated call\n', b'xERRORx\n'] * 50000 + [b'ERROR here\n']
+    state, line = _classify([r'\bERROR\b'], ['deprecated'], lines)
+    assert state == worker.JobStateEnum.ERROR
+    assert line == b'ERROR here\n'
+
+
+def test_classifier_across_chunks():
+    classifier = OutputMatcher(['FATAL'], ['WARN']).classifier()
+    filler = b'x' * 1000 + b'\n'
+    for _ in range(classifier.chunk_size // len(filler)):
+        classifier.feed(filler)
+    classifier.feed(b'WARN 1\n')
+    classifier.finish()
+    assert classifier.state == worker.JobStateEnum.WARN
+
+
+@pytest.mark.parametrize('fail_patterns, warn_patterns', [
+    ([r'\bERROR\b'], ['deprecated']),
+    # 没有字面量时逐行执行正则
+    ([r'^E\d+$'], [r'^W.*$']),
+])
+def test_classifier_raw_chunks(fail_patterns, warn_patterns):
+    output = b''.join([b'ok line\n'] * 20000 + [b'W deprecated\n'] + [b'ok\n'] * 20000 +
+                      [b'xERRORx\n', b'E12\n', b'ERROR at end'])
+    lines = output.splitlines(keepends=True)
+    expected = _classify(fail_patterns, warn_patterns, lines)
+    assert expected[0] == worker.JobStateEnum.ERROR
+    random.seed(0)
+    for _ in range(20):
+        cuts = sorted(random.sample(range(1, len(output)), 30))
+        chunks = [output[start:end] for start, end in zip([0] + cuts, cuts + [len(output)])]
+        assert _classify(fail_patterns, warn_patterns, chunks) == expected
+
+
+def test_classifier_bounds_long_line():
+    classifier = OutputMatcher(['FATAL'], []).classifier()
+    classifier.max_line = classifier.chunk_size
+    classifier.feed(b'x' * classifier.chunk_size)
+    # 没有换行的输出不会一直留在缓冲区中
+    assert not classifier._buffer
+    classifier.feed(b'FATAL\n')
+    classifier.finish()
+    assert classifier.state == worker.JobStateEnum.ERROR and classifier.line == b'FATAL\n'
@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+import os
+import pytest
+
+# 比ARG_MAX中单个参数的上限(128KB)大得多
+PAYLOAD = ''.join(f'{i:08d}\n' for i in range(200000))
+DIGEST = hashlib.md5(PAYLOAD.encode()).hexdigest()
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='param_mode file requires posix')
+
+
+async def _run(make_core, shoot, command: str, options: dict):
+    core = await make_core(logger={'compress': 'none'})
+    try:
+        job = await core.add_job('0 0 1 1 *', command, PAYLOAD, name='payload', options=options)
+        record = await shoot(core, job)
+        return record, await core.job_log_get_by_shot_id(record.shot_id, limit_line=1000)
+    finally:
+        await core.stop()
+
+
+@pytest.mark.parametrize('param_mode, exec_mode, command', [
+    ('stdin', 'shell', 'md5sum'),
+    ('stdin', 'exec', 'md5sum'),
+    ('file', 'shell', 'md5sum "$CRONWEB_PARAM_FILE"'),
+    ('file', 'exec', """sh -c 'md5sum "$CRONWEB_PARAM_FILE"'"""),
+])
+def test_large_param_delivered(make_core, shoot, param_mode, exec_mode, command):
+    record, log = asyncio.run(_run(make_core, shoot, command, {'param_mode': param_mode, 'exec_mode': exec_mode}))
+    assert record.state == 'DONE', log
+    assert DIGEST in log
+    # 日志中只记录param的开头部分
+    assert f'... ({len(PAYLOAD)} chars)' in log
+    assert PAYLOAD[-100:] not in log
+
+
+def test_param_not_in_command_line(make_core, shoot):
+    command = 'tr "\\0" " " < /proc/$$/cmdline; echo; head -c 8 "$CRONWEB_PARAM_FILE"; echo'
+    record, log = asyncio.run(_run(make_core, shoot, command, {'param_mode': 'file'}))
+    assert record.state == 'DONE', log
+    output = log.partition('#### OUTPUT ####\n')[2]
+    cmdline, head = output.split('\n')[:2]
+    assert '--param' not in cmdline and PAYLOAD[:8] not in cmdline
+    assert head == PAYLOAD[:8]
@@ -0,0 +1,71 @@
+import asyncio
+
+
+async def wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if await condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def test_retries_run_from_queue(make_core, shoot):
+    async def main():
+        core = await make_core(worker={'times_retry': 2, 'wait_retry_base': 0.05})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'exit 3', '', name='fail')
+            first = await shoot(core, job)
+            assert first.state == 'ERROR'
+            # 第一次重试已经写入队列 不占用运行中的协程
+            retry, = await core.retry_get_all()
+            assert (retry.shot_id_root, retry.attempt) == (first.shot_id, 1)
+
+            async def retried():
+                records = await core.job_logs_get_by_uuid(job.uuid)
+                return len(records) == 3 and all(record.state == 'ERROR' for record in records)
+            await wait_until(retried)
+            await asyncio.sleep(0.3)
+            # 达到times_retry后不再重试
+            assert len(await core.job_logs_get_by_uuid(job.uuid)) == 3
+            assert not await core.retry_get_all()
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_retry_survives_restart(make_core, shoot):
+    async def main():
+        core = await make_core(worker={'times_retry': 1, 'wait_retry_base': 0.5})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'exit 3', '', name='fail')
+            await shoot(core, job)
+        finally:
+            await core.stop()
+        core = await make_core(worker={'times_retry': 1, 'wait_retry_base': 0.5})
+        try:
+            assert len(await core.retry_get_all()) == 1
+            # 与run()一样 启动时调度storage中等待的重试
+            await core._timing_retry_func()
+
+            async def retried():
+                return len(await core.job_logs_get_by_uuid(job.uuid)) == 2 and not await core.retry_get_all()
+            await wait_until(retried)
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_retry_cancel(make_core, shoot):
+    async def main():
+        core = await make_core(worker={'times_retry': 1, 'wait_retry_base': 0.3})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'exit 3', '', name='fail')
+            await shoot(core, job)
+            retry, = await core.retry_get_all()
+            assert (await core.retry_cancel(retry.id)).id == retry.id
+            assert await core.retry_cancel(retry.id) is None
+            await asyncio.sleep(0.6)
+            assert len(await core.job_logs_get_by_uuid(job.uuid)) == 1
+        finally:
+            await core.stop()
+    asyncio.run(main())
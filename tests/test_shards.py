@@ -0,0 +1,81 @@
+import asyncio
+import worker
+
+# 分片参数为b时失败
+FAIL_ON_B = 'p=$(cat "$CRONWEB_PARAM_FILE"); echo shard=$p; test "$p" != b'
+
+
+async def wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if await condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def test_shard_retry_keeps_run_id(make_core):
+    async def main():
+        core = await make_core(worker={'times_retry': 1, 'wait_retry_base': 0.5})
+        try:
+            job = await core.add_job('0 0 1 1 *', FAIL_ON_B, '', name='shards',
+                                     options={'shards': ['a', 'b'], 'param_mode': 'file'})
+            await core.shoot(job.command, job.param, job.uuid, 30, job.name, worker.JobTypeEnum.MANUAL,
+                             options=job.options)
+            run, = await core.runs_get_by_uuid(job.uuid)
+            _, records = await core.run_get_detail(run.run_id)
+            failed, = [record for record in records if record.shard == 'b']
+            retry, = await core.retry_get_all()
+            # 重试记录中分别保存分片运行和失败分片的shot_id
+            assert retry.run_id == run.run_id and retry.shot_id_root == failed.shot_id
+
+            async def retried():
+                _, records = await core.run_get_detail(run.run_id)
+                return len(records) == 3 and all(record.state != 'RUNNING' for record in records)
+            await wait_until(retried)
+            _, records = await core.run_get_detail(run.run_id)
+            # 只重新运行失败的分片 仍属于同一个运行
+            assert sorted(record.shard for record in records) == ['a', 'b', 'b']
+            assert not await core.retry_get_all()
+            # 手动重试同样只运行失败的分片
+            assert await core.run_retry(run.run_id) is not None
+
+            async def retried_manually():
+                _, records = await core.run_get_detail(run.run_id)
+                return len(records) == 4 and all(record.state != 'RUNNING' for record in records)
+            await wait_until(retried_manually)
+            _, records = await core.run_get_detail(run.run_id)
+            assert sorted(record.shard for record in records) == ['a', 'b', 'b', 'b']
+            assert len(await core.runs_get_by_uuid(job.uuid)) == 1
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_shard_range_concurrency_and_param(make_core):
+    async def main():
+        core = await make_core()
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo param=$(cat "$CRONWEB_PARAM_FILE"); sleep 0.2', 'id={shard}',
+                                     name='range', options={'shard_range': [0, 6], 'shard_concurrency': 2,
+                                                            'param_mode': 'file'})
+            running = []
+            shot = asyncio.ensure_future(core.shoot(job.command, job.param, job.uuid, 30, job.name,
+                                                    worker.JobTypeEnum.MANUAL, options=job.options))
+            while not shot.done():
+                running.append(len(core._worker.get_running_jobs()))
+                await asyncio.sleep(0.01)
+            await shot
+            # 同时运行的分片不超过shard_concurrency
+            assert max(running) == 2
+            run, = await core.runs_get_by_uuid(job.uuid)
+            assert run.state == 'DONE' and run.shards == 6
+            _, records = await core.run_get_detail(run.run_id)
+            assert sorted(record.shard for record in records) == [str(i) for i in range(6)]
+            for record in records:
+                assert record.state == 'DONE'
+                log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100)
+                # param中的{shard}替换为分片参数
+                assert f'param=id={record.shard}\n' in log
+        finally:
+            await core.stop()
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import time
+import pytest
+import worker
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='process groups are posix only')
+
+
+async def _start(core, command: str, name: str):
+    job = await core.add_job('0 0 1 1 *', command, '', name=name)
+    task = asyncio.ensure_future(core.shoot(job.command, job.param, job.uuid, 60, job.name,
+                                            worker.JobTypeEnum.MANUAL, options=job.options))
+    return job, task
+
+
+async def _wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def _gone(pid: int) -> bool:
+    try:
+        with open(f'/proc/{pid}/stat') as fp:
+            # 已退出但还没有被回收
+            return fp.read().rsplit(')', 1)[1].split()[0] == 'Z'
+    except FileNotFoundError:
+        return True
+
+
+def test_kill_all_shares_one_deadline(make_core, tmp_path):
+    async def main():
+        core = await make_core(worker={'kill_timeout': 0.5})
+        try:
+            # 忽略SIGTERM 每个任务都要等到超时后SIGKILL
+            started = []
+            for i in range(4):
+                marker = tmp_path / f'started-{i}'
+                started.append(marker)
+                await _start(core, f"trap '' TERM; touch {marker}; sleep 30", f'stubborn{i}')
+            await _wait_until(lambda: all(marker.exists() for marker in started))
+            begin = time.monotonic()
+            killed = await core._worker.kill_all_running_jobs()
+            elapsed = time.monotonic() - begin
+            assert len(killed) == 4
+            # 所有任务同时等待 总耗时约为一个kill_timeout而不是每个任务一个
+            assert elapsed < 1.5
+            await _wait_until(lambda: not core._worker.get_running_jobs())
+            for uuid in set(killed.values()):
+                record, = await core.job_logs_get_by_uuid(uuid)
+                assert record.state == 'KILLED'
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_kill_stops_process_group(make_core, tmp_path):
+    async def main():
+        core = await make_core(worker={'kill_timeout': 2})
+        pid_file = tmp_path / 'child.pid'
+        try:
+            await _start(core, f'sleep 30 & echo $! > {pid_file}.tmp; mv {pid_file}.tmp {pid_file}; wait', 'group')
+            await _wait_until(pid_file.exists)
+            child = int(pid_file.read_text())
+            assert not _gone(child)
+            await core._worker.kill_all_running_jobs()
+            # shell启动的后台进程和shell在同一个进程组中 一起停止
+            await _wait_until(lambda: _gone(child))
+        finally:
+            await core.stop()
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+import time
+import asyncio
+import pytest
+from storage.storage_aiosqlite import AioSqliteStorage
+
+
+def _with_storage(tmp_path, func):
+    async def main():
+        store = await AioSqliteStorage.create(tmp_path / 'db.sqlite3')
+        try:
+            return await func(store)
+        finally:
+            await store.stop()
+    return asyncio.run(main())
+
+
+async def _assert_writable(store):
+    """连接池中所有连接都可以写入 没有连接遗留未提交的写事务."""
+    for _ in range(store.db_pool._pool_size + 1):
+        retry = await asyncio.wait_for(store.retry_add('u' * 32, 's' * 32, 1, time.time() + 60), 2)
+        assert await store.retry_remove(retry.id) is not None
+
+
+def test_log_search_add_for_removed_record_releases_lock(tmp_path):
+    async def check(store):
+        if not store.log_search_available:
+            pytest.skip('sqlite has no fts5')
+        await store.log_search_add('0' * 32, 0, 'content', 10)
+        await _assert_writable(store)
+    _with_storage(tmp_path, check)
+
+
+def test_retry_remove_twice_releases_lock(tmp_path):
+    async def check(store):
+        retry = await store.retry_add('u' * 32, 's' * 32, 1, time.time())
+        assert (await store.retry_remove(retry.id)).id == retry.id
+        assert await store.retry_remove(retry.id) is None
+        await _assert_writable(store)
+    _with_storage(tmp_path, check)
+
+
+def test_pool_rolls_back_open_transaction(tmp_path):
+    async def check(store):
+        async with store.db_pool.connect() as conn:
+            await conn.execute('DELETE FROM job_retries;')
+            assert conn.in_transaction
+        await _assert_writable(store)
+    _with_storage(tmp_path, check)
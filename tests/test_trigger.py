@@ -0,0 +1,25 @@
+import asyncio
+
+
+def test_no_cron_start_after_stop_all(make_core):
+    async def main():
+        core = await make_core()
+        try:
+            crons = core._trigger._job_dict
+            job = await core.add_job('* * * * *', 'echo 1', '', name='before')
+            await asyncio.sleep(0)
+            assert crons[job.uuid].cron.handle is not None
+            # 排空时停止所有定时触发
+            core.stop_all_trigger()
+            assert crons[job.uuid].cron.handle is None
+            added = await core.add_job('* * * * *', 'echo 2', '', name='added')
+            await core.update_job(job.uuid, '*/2 * * * *', 'echo 3', '', name='updated')
+            await core.update_job_state(job.uuid, 0)
+            enabled = await core.update_job_state(job.uuid, 1)
+            await asyncio.sleep(0)
+            assert enabled.active == 1
+            assert all(cronjob.cron.handle is None for cronjob in crons.values())
+            assert {added.uuid, job.uuid} <= set(await core._storage.get_all_jobs())
+        finally:
+            await core.stop()
+    asyncio.run(main())
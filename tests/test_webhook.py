@@ -0,0 +1,153 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import aiohttp.web
+
+SECRET = 'secret'
+
+
+class StubServer:
+    """记录收到的webhook请求 fail为True时返回503."""
+
+    def __init__(self):
+        self.requests = []
+        self.fail = False
+        self.runner = None
+        self.url = ''
+
+    async def start(self):
+        async def handle(request: aiohttp.web.Request):
+            body = await request.read()
+            if self.fail:
+                return aiohttp.web.Response(status=503)
+            self.requests.append((body, request.headers, request.transport.get_extra_info('peername')))
+            return aiohttp.web.json_response({'code': 0})
+        app = aiohttp.web.Application()
+        app.router.add_post('/hook', handle)
+        self.runner = aiohttp.web.AppRunner(app)
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/hook'
+        return self
+
+    def events(self):
+        out = []
+        for body, _, _ in self.requests:
+            payload = json.loads(body)
+            out.extend(payload['events'] if 'events' in payload else [payload])
+        return out
+
+
+async def wait_until(condition, timeout: float = 10):
+    for _ in range(int(timeout * 50)):
+        if await condition():
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError('condition not met')
+
+
+def _worker_config(server: StubServer, **extra):
+    return {'webhook_url': server.url, 'webhook_secret': SECRET, 'webhook_retry_base': 0.05,
+            'webhook_poll_interval': 0.05, **extra}
+
+
+def test_webhook_keepalive_and_signature(make_core, shoot):
+    async def main():
+        server = await StubServer().start()
+        core = await make_core(worker=_worker_config(server))
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo 1', '', name='hook')
+            shot_ids = []
+            for i in range(3):
+                shot_ids.append((await shoot(core, job)).shot_id)
+
+                async def delivered():
+                    return len(server.requests) == i + 1
+                await wait_until(delivered)
+            assert [event['shot_id'] for event in server.events()] == shot_ids
+            for body, headers, _ in server.requests:
+                sign = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+                assert headers['X-Cronweb-Token'] == sign
+            # 依次发送的请求复用同一个连接
+            assert len({peer for _, _, peer in server.requests}) == 1
+        finally:
+            await core.stop()
+            await server.runner.cleanup()
+    asyncio.run(main())
+
+
+def test_webhook_batch_retry(make_core, shoot):
+    async def main():
+        server = await StubServer().start()
+        server.fail = True
+        core = await make_core(worker=_worker_config(server, webhook_batch_size=5))
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo 1', '', name='hook')
+            shot_ids = {(await shoot(core, job)).shot_id for _ in range(3)}
+
+            async def failed():
+                return (await core.get_webhook_stats())['failed'] >= 3
+            await wait_until(failed)
+            assert (await core.get_webhook_stats())['depth'] == 3
+            server.fail = False
+
+            async def drained():
+                return (await core.get_webhook_stats())['depth'] == 0
+            await wait_until(drained)
+            # 每个事件只投递一次 批量发送时包装为events列表
+            events = server.events()
+            assert len(events) == 3 and {event['shot_id'] for event in events} == shot_ids
+            assert all('events' in json.loads(body) for body, _, _ in server.requests)
+            assert (await core.get_webhook_stats())['delivered'] == 3
+        finally:
+            await core.stop()
+            await server.runner.cleanup()
+    asyncio.run(main())
+
+
+def test_webhook_outbox_survives_restart(make_core, shoot):
+    async def main():
+        server = await StubServer().start()
+        server.fail = True
+        core = await make_core(worker=_worker_config(server))
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo 1', '', name='hook')
+            shot_id = (await shoot(core, job)).shot_id
+            assert (await core.get_webhook_stats())['depth'] == 1
+        finally:
+            await core.stop()
+        # 重启后继续投递未成功的事件
+        server.fail = False
+        core = await make_core(worker=_worker_config(server))
+        try:
+            async def delivered():
+                return len(server.requests) == 1
+            await wait_until(delivered)
+            assert server.events()[0]['shot_id'] == shot_id
+        finally:
+            await core.stop()
+            await server.runner.cleanup()
+    asyncio.run(main())
+
+
+def test_webhook_max_attempts_drops_event(make_core, shoot):
+    async def main():
+        server = await StubServer().start()
+        server.fail = True
+        core = await make_core(worker=_worker_config(server, webhook_max_attempts=2))
+        try:
+            job = await core.add_job('0 0 1 1 *', 'echo 1', '', name='hook')
+            await shoot(core, job)
+
+            async def dropped():
+                stats = await core.get_webhook_stats()
+                return stats['dropped'] == 1 and stats['depth'] == 0
+            await wait_until(dropped)
+            assert (await core.get_webhook_stats())['failed'] == 2
+        finally:
+            await core.stop()
+            await server.runner.cleanup()
+    asyncio.run(main())
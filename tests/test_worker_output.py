@@ -0,0 +1,152 @@
+import asyncio
+import random
+import aiohttp.web
+from worker.worker_aiosubprocess import OutputCapture, OutputPipe, _LineSplitter, _MetricScanner, _parse_metric_line
+
+
+def test_line_splitter_keeps_partial_line():
+    splitter = _LineSplitter()
+    assert splitter.feed(b'a\nb') == [b'a\n']
+    assert splitter.feed(b'c\n\nd') == [b'bc\n', b'\n']
+    assert splitter.finish() == [b'd']
+    assert splitter.finish() == []
+
+
+def test_line_splitter_bounds_long_line():
+    splitter = _LineSplitter(max_line=8)
+    assert splitter.feed(b'x' * 5) == []
+    assert splitter.feed(b'x' * 5) == [b'x' * 10]
+    assert splitter.feed(b'yy\n') == [b'yy\n']
+
+
+def test_metric_scanner_matches_line_split():
+    output = (b'::metric a=1\nx ::metric b=2\n::metric c=3 d=4\n::metri\n'
+              b'::metricx e=5\n' + b'y' * 100 + b'::metric f=6\n::metric g=7')
+    expected = {}
+    for line in output.split(b'\n'):
+        if line.startswith(b'::metric '):
+            _parse_metric_line(line, expected)
+    assert expected == {'a': 1.0, 'c': 3.0, 'd': 4.0, 'g': 7.0}
+    random.seed(0)
+    for _ in range(200):
+        # 在任意位置切分成块
+        cuts = sorted(random.sample(range(1, len(output)), random.randint(1, 20)))
+        metrics = {}
+        scanner = _MetricScanner(metrics)
+        for start, end in zip([0] + cuts, cuts + [len(output)]):
+            scanner.feed(output[start:end])
+        scanner.finish()
+        assert metrics == expected
+
+
+def test_metric_scanner_bounds_long_line():
+    metrics = {}
+    scanner = _MetricScanner(metrics, max_line=16)
+    scanner.feed(b'::metric a=1 b=')
+    scanner.feed(b'2 c=3')
+    assert metrics == {'a': 1.0, 'b': 2.0, 'c': 3.0}
+    scanner.feed(b' d=4\n::metric e=5\n')
+    assert 'd' not in metrics and metrics['e'] == 5.0
+
+
+def test_output_capture_chunks():
+    capture = OutputCapture(4, 4)
+    assert capture.feed(b'abcdef') == b'abcd'
+    assert capture.feed(b'ghijkl') == b''
+    assert capture.tail() == b'ijkl'
+    assert capture.dropped == 4
+
+
+def test_output_pipe_backpressure():
+    async def main():
+        pipe = OutputPipe(limit=4)
+        await pipe.write(b'abcd')
+        writer = asyncio.ensure_future(pipe.write(b'ef'))
+        await asyncio.sleep(0.01)
+        # 缓冲已满 写入方等待读取
+        assert not writer.done()
+        assert await pipe.read(3) == b'abc'
+        await asyncio.wait_for(writer, 1)
+        pipe.feed_eof()
+        assert await pipe.read() == b'def'
+        assert await pipe.read() == b''
+    asyncio.run(main())
+
+
+def test_http_long_line(make_core, shoot):
+    body = b'x' * (3 * 1024 * 1024) + b'\nend\n'
+
+    async def main():
+        async def handler(request):
+            return aiohttp.web.Response(body=body)
+        app = aiohttp.web.Application()
+        app.router.add_get('/big', handler)
+        runner = aiohttp.web.AppRunner(app)
+        await runner.setup()
+        site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', f'http://127.0.0.1:{port}/big', '', name='big',
+                                     options={'exec_mode': 'http', 'warn_patterns': ['^end$']})
+            record = await asyncio.wait_for(shoot(core, job), 30)
+            assert record.state == 'WARN'
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100)
+            assert body.decode() in log
+        finally:
+            await core.stop()
+            await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_http_unexpected_error_is_logged(make_core, shoot, monkeypatch):
+    def failing(self, method, url, **kwargs):
+        raise RuntimeError('boom')
+    monkeypatch.setattr(aiohttp.ClientSession, 'request', failing)
+
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'http://127.0.0.1:1/x', '', name='http',
+                                     options={'exec_mode': 'http'})
+            record = await asyncio.wait_for(shoot(core, job), 30)
+            assert record.state == 'ERROR'
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100)
+            assert "Request Failed: RuntimeError('boom')" in log and 'Exit Code: -1' in log
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_output_cap_keeps_raw_head(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', 'seq 1 100000', '', name='seq',
+                                     options={'output_head_kb': 1, 'output_tail_kb': 1})
+            record = await shoot(core, job)
+            log = await core.job_log_get_by_shot_id(record.shot_id, limit_line=100000)
+            output = ''.join(f'{i}\n' for i in range(1, 100001))
+            head, marker, rest = log.partition('#### OUTPUT ####\n')[2].partition('\n#### OUTPUT TRUNCATED ')
+            # 截断位置在行中间时不补换行
+            assert head == output[:1024]
+            assert rest.split(' ', 1)[0] == str(len(output) - 2048)
+            assert rest.split('####\n', 1)[1].startswith(output[-1024:])
+        finally:
+            await core.stop()
+    asyncio.run(main())
+
+
+def test_job_metrics_without_line_consumers(make_core, shoot):
+    async def main():
+        core = await make_core(logger={'compress': 'none'})
+        try:
+            job = await core.add_job('0 0 1 1 *', "printf 'x\\n::metric rows=3\\n::metric ms=1.5'", '', name='metrics')
+            record = await shoot(core, job)
+            assert record.state == 'DONE'
+            rows = await core.job_metrics_get(job.uuid)
+            assert {row.name: row.value for row in rows} == {'rows': 3.0, 'ms': 1.5}
+        finally:
+            await core.stop()
+    asyncio.run(main())
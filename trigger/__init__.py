@@ -16,6 +16,8 @@ class JobInfo(typing.NamedTuple):
     date_create: str
     date_update: str
     active: int
+    # job的扩展配置 例如执行方式等 见worker.JobOptions
+    options: typing.Optional[typing.Dict[str, typing.Any]] = None
 
 
 class JobDuplicateError(Exception):
@@ -39,13 +41,15 @@ class TriggerBase(abc.ABC):
     @abc.abstractmethod
     def add_job(self, cron_exp: str, command: str, param: str,
                 date_create: str, date_update: typing.Optional[str] = None,
-                uuid: typing.Optional[str] = None, name: str = '', active: int = 1) -> JobInfo:
+                uuid: typing.Optional[str] = None, name: str = '', active: int = 1,
+                options: typing.Optional[typing.Dict[str, typing.Any]] = None) -> JobInfo:
         pass
 
     @abc.abstractmethod
     def update_job(self, uuid: str, cron_exp: str, command: str, param: str,
                    date_update: str,
-                   name: str = '') -> JobInfo:
+                   name: str = '',
+                   options: typing.Optional[typing.Dict[str, typing.Any]] = None) -> JobInfo:
         pass
 
     @abc.abstractmethod
@@ -64,12 +68,31 @@ class TriggerBase(abc.ABC):
     def trigger_manual(self, uuid: str) -> typing.Optional[JobInfo]:
         pass
 
+    @abc.abstractmethod
+    def trigger_retry(self, uuid: str, attempt: int, shot_id_root: typing.Optional[str],
+                      run_id: typing.Optional[str] = None) -> typing.Optional[JobInfo]:
+        """以重试类型启动任务 attempt为第几次重试 shot_id_root为第一次运行失败的shot_id
+        run_id不为None时重试这次分片运行中失败的分片
+        """
+        pass
+
+    @abc.abstractmethod
+    def trigger_schedule(self, uuid: str, fire_ts: float) -> typing.Optional[JobInfo]:
+        """以定时触发类型启动任务 fire_ts为计划触发时间(unix时间戳) 用于补发交接期间的定时触发."""
+        pass
+
+    @abc.abstractmethod
+    def fire_times(self, uuid: str, since: float, until: float) -> typing.List[float]:
+        """job在(since, until]之间的计划触发时间(unix时间戳)."""
+        pass
+
     @abc.abstractmethod
     def get_jobs(self) -> typing.Dict[str, JobInfo]:
         pass
 
     @abc.abstractmethod
     def stop_all(self) -> typing.Dict[str, JobInfo]:
+        """停止所有任务的定时触发 之后添加 更新和启动的任务只记录active状态 不再启动定时触发."""
         pass
 
     @staticmethod
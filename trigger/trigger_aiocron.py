@@ -20,6 +20,7 @@ class CronJob(typing.NamedTuple):
     date_create: str
     date_update: str
     active: int
+    options: typing.Dict[str, typing.Any]
 
 
 class TriggerAioCron(trigger.TriggerBase):
@@ -28,10 +29,13 @@ class TriggerAioCron(trigger.TriggerBase):
         super().__init__(controller)
         self._job_dict: typing.Dict[str, CronJob] = {}
         self.tz = pytz.timezone(tz) if tz else None
+        # stop_all之后(排空或退出)添加 更新和启动的任务只记录active状态 不再启动定时触发
+        self._stopped = False
 
     def add_job(self, cron_exp: str, command: str, param: str,
                 date_create: str, date_update: typing.Optional[str] = None,
                 uuid: typing.Optional[str] = None, name: str = '', active: int = 1,
+                options: typing.Optional[typing.Dict[str, typing.Any]] = None,
                 update: bool = True) -> typing.Optional[trigger.JobInfo]:
         self._py_logger.info('新建trigger job 任务名:%s active=%s', name, active)
         self._py_logger.debug('job 周期:%s 命令:%s', cron_exp, command)
@@ -43,35 +47,47 @@ class TriggerAioCron(trigger.TriggerBase):
                 raise trigger.JobDuplicateError(f'job {uuid} has been exists')
             self._py_logger.warning('任务uuid:%s 任务名:%s 已存在 尝试更新', uuid, name)
             date_update = date_update or str(datetime.datetime.now())
-            return self.update_job(uuid, cron_exp, command, param, date_update, name)
+            return self.update_job(uuid, cron_exp, command, param, date_update, name, options)
+        options = options or {}
 
         def job_func(core_inner: cronweb.CronWeb,
                      command_inner: str, param_inner: str,
-                     name_inner: str,
+                     name_inner: str, options_inner: typing.Dict[str, typing.Any],
                      timeout: float = 1800,
-                     job_type=worker.JobTypeEnum.SCHEDULE):
+                     job_type=worker.JobTypeEnum.SCHEDULE,
+                     attempt: int = 0,
+                     shot_id_root: typing.Optional[str] = None,
+                     fire_ts: typing.Optional[float] = None,
+                     run_id: typing.Optional[str] = None):
+            if job_type == worker.JobTypeEnum.SCHEDULE and fire_ts is None:
+                fire_ts = self._scheduled_ts(cron)
             return asyncio.ensure_future(core_inner.shoot(command_inner, param_inner, uuid, timeout, name_inner,
-                                                          job_type=job_type))
+                                                          job_type=job_type, options=options_inner,
+                                                          attempt=attempt, shot_id_root=shot_id_root,
+                                                          fire_ts=fire_ts, run_id=run_id))
 
         cron = aiocron.Cron(spec=cron_exp,
                             func=job_func,
-                            args=(self._core, command, param, name),
-                            start=True if active == 1 else False,
+                            args=(self._core, command, param, name, options),
+                            start=active == 1 and not self._stopped,
                             uuid=uuid,
                             tz=self.tz
                             )
-        self._job_dict[uuid] = CronJob(cron, command, param, name, date_create, date_update or date_create, active)
+        self._job_dict[uuid] = CronJob(cron, command, param, name, date_create, date_update or date_create, active,
+                                       options)
         return self._cronjob_to_jobinfo(self._job_dict[uuid])
 
     def update_job(self, uuid: str, cron_exp: str, command: str, param: str,
                    date_update: str,
-                   name: str = '') -> typing.Optional[trigger.JobInfo]:
+                   name: str = '',
+                   options: typing.Optional[typing.Dict[str, typing.Any]] = None) -> typing.Optional[trigger.JobInfo]:
         self._py_logger.info('更新trigger任务 %s', uuid)
         if uuid not in self:
             self._py_logger.warning('uuid不存在于trigger 不可更新: %s', uuid)
             return None
         date_create = self.remove_job(uuid).date_create
-        return self.add_job(cron_exp, command, param, date_create, date_update, uuid, name, update=False)
+        return self.add_job(cron_exp, command, param, date_create, date_update, uuid, name,
+                            options=options, update=False)
 
     def remove_job(self, uuid: str) -> typing.Optional[trigger.JobInfo]:
         self._py_logger.info('从trigger删除任务 %s', uuid)
@@ -91,7 +107,7 @@ class TriggerAioCron(trigger.TriggerBase):
         job = self._job_dict.pop(uuid)
         job.cron.stop()
         self._job_dict[uuid] = CronJob(job.cron, job.command, job.param, job.name,
-                                       job.date_create, job.date_update, 0)
+                                       job.date_create, job.date_update, 0, job.options)
         return self._cronjob_to_jobinfo(self._job_dict[uuid])
 
     def start_job(self, uuid: str) -> typing.Optional[trigger.JobInfo]:
@@ -100,9 +116,12 @@ class TriggerAioCron(trigger.TriggerBase):
             self._py_logger.warning('uuid不存在于trigger 不可启动: %s', uuid)
             return None
         job = self._job_dict.pop(uuid)
-        job.cron.start()
+        if self._stopped:
+            self._py_logger.warning('trigger已停止 任务%s只记录为启动状态', uuid)
+        else:
+            job.cron.start()
         self._job_dict[uuid] = CronJob(job.cron, job.command, job.param, job.name,
-                                       job.date_create, job.date_update, 1)
+                                       job.date_create, job.date_update, 1, job.options)
         return self._cronjob_to_jobinfo(self._job_dict[uuid])
 
     def trigger_manual(self, uuid: str) -> typing.Optional[trigger.JobInfo]:
@@ -114,6 +133,49 @@ class TriggerAioCron(trigger.TriggerBase):
         job.cron.call_func(job_type=worker.JobTypeEnum.MANUAL)
         return self._cronjob_to_jobinfo(job)
 
+    def trigger_retry(self, uuid: str, attempt: int, shot_id_root: typing.Optional[str],
+                      run_id: typing.Optional[str] = None) -> typing.Optional[trigger.JobInfo]:
+        self._py_logger.info('重试trigger任务 %s 第%s次重试', uuid, attempt)
+        if uuid not in self:
+            self._py_logger.warning('uuid不存在于trigger 不可重试: %s', uuid)
+            return None
+        job = self._job_dict[uuid]
+        job.cron.func(job_type=worker.JobTypeEnum.RETRY, attempt=attempt, shot_id_root=shot_id_root, run_id=run_id)
+        return self._cronjob_to_jobinfo(job)
+
+    def trigger_schedule(self, uuid: str, fire_ts: float) -> typing.Optional[trigger.JobInfo]:
+        self._py_logger.info('补发trigger任务的定时触发 %s %s', uuid, fire_ts)
+        if uuid not in self:
+            self._py_logger.warning('uuid不存在于trigger 不可启动: %s', uuid)
+            return None
+        job = self._job_dict[uuid]
+        job.cron.func(job_type=worker.JobTypeEnum.SCHEDULE, fire_ts=fire_ts)
+        return self._cronjob_to_jobinfo(job)
+
+    def fire_times(self, uuid: str, since: float, until: float) -> typing.List[float]:
+        if uuid not in self:
+            return []
+        cron = self._job_dict[uuid].cron
+        iter_cron = croniter.croniter(cron.spec, start_time=datetime.datetime.fromtimestamp(since, cron.tz))
+        out_list = []
+        while True:
+            fire_ts = iter_cron.get_next(float)
+            if fire_ts > until:
+                return out_list
+            out_list.append(fire_ts)
+
+    @staticmethod
+    def _scheduled_ts(cron: aiocron.Cron) -> float:
+        """本次定时触发的计划时间 aiocron在调用前已经将croniter推进到了下一次触发时间
+        多个实例对同一次触发计算出相同的时间 用于认领触发
+        """
+        if cron.croniter is not None:
+            start_time = cron.croniter.get_current(datetime.datetime)
+        else:
+            # 触发后调度被停止
+            start_time = datetime.datetime.now(cron.tz) + datetime.timedelta(seconds=1)
+        return croniter.croniter(cron.spec, start_time=start_time).get_prev(float)
+
     def get_jobs(self) -> typing.Dict[str, trigger.JobInfo]:
         self._py_logger.debug('从trigger中获取所有任务')
         return {uuid: self._cronjob_to_jobinfo(cronjob)
@@ -121,6 +183,7 @@ class TriggerAioCron(trigger.TriggerBase):
 
     def stop_all(self) -> typing.Dict[str, trigger.JobInfo]:
         self._py_logger.info('停止trigger中所有任务')
+        self._stopped = True
         for job in self._job_dict.values():
             job.cron.stop()
         return {uuid: self._cronjob_to_jobinfo(cronjob)
@@ -134,7 +197,7 @@ class TriggerAioCron(trigger.TriggerBase):
     def _cronjob_to_jobinfo(job: CronJob) -> trigger.JobInfo:
         return trigger.JobInfo(job.cron.uuid, job.cron.spec, job.command,
                                job.param, job.name, job.date_create, job.date_update,
-                               job.active)
+                               job.active, job.options)
 
     def __contains__(self, uuid: str) -> bool:
         return uuid in self._job_dict
@@ -33,6 +33,11 @@ class WebBase(abc.ABC):
     def on_shutdown(self, func: typing.Callable):
         pass
 
+    @abc.abstractmethod
+    def shutdown(self):
+        """停止服务 之后执行on_shutdown添加的回调."""
+        pass
+
     @abc.abstractmethod
     async def start_server(self, host: str = '127.0.0.1', port: int = 8000, **kwargs):
         pass
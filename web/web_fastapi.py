@@ -31,6 +31,7 @@ class WebFastAPI(web.WebBase):
         self.host = host
         self.port = port
         self.app = fastapi.FastAPI(**fa_kwargs)
+        self._server: typing.Optional[uvicorn.Server] = None
         self.init_api()
 
         self.token_algo = token_algo
@@ -123,18 +124,140 @@ class WebFastAPI(web.WebBase):
                 '2': '执行失败，查看response'
             }
 
+        @self.app.get('/api/sys/webhook', dependencies=[fastapi.Depends(check_auth)])
+        async def get_webhook_stats():
+            """
+            {
+              "response": {
+                "depth": 0,
+                "lag": 0.0,
+                "delivered": 120,
+                "failed": 3,
+                "dropped": 0,
+                "last_lag": 0.012
+              },
+              "code": 0
+            }
+            """
+            return {'response': await self._core.get_webhook_stats(), 'code': 0}
+
+        @self.app.get('/api/sys/hooks', dependencies=[fastapi.Depends(check_auth)])
+        async def get_hook_stats():
+            """
+            histogram为耗时分布 le_x为耗时不超过x秒的次数
+            {
+              "response": {
+                "queue": 0,
+                "spilled": 0,
+                "running": 1,
+                "hooks": {
+                  "hooks.notify.on_done": {
+                    "count": 12,
+                    "errors": 0,
+                    "timeouts": 1,
+                    "dropped": 0,
+                    "time_avg": 0.21,
+                    "time_max": 30.0,
+                    "histogram": {"le_0.01": 0, "le_0.05": 3, ..., "le_30": 1, "inf": 0}
+                  }
+                }
+              },
+              "code": 0
+            }
+            """
+            return {'response': self._core.get_hook_stats(), 'code': 0}
+
+        @self.app.get('/api/sys/agents', dependencies=[fastapi.Depends(check_auth)])
+        async def get_agents():
+            """
+            {
+              "response": [
+                {
+                  "id": "5b1fd0c2a3e34f7c9f3c4f2ad0f1c1e2",
+                  "name": "build-01",
+                  "labels": ["gpu", "linux"],
+                  "capacity": 4,
+                  "running": 1
+                }
+              ],
+              "code": 0
+            }
+            """
+            return {'response': self._core.get_agents(), 'code': 0}
+
+        @self.app.get('/api/sys/instances', dependencies=[fastapi.Depends(check_auth)])
+        async def get_instances():
+            """使用同一个数据库的CronWeb实例 时间均为unix时间戳
+            {
+              "response": [
+                {
+                  "instance_id": "0f6f7a1c9d2b4c1e8a5d3b2c1a0f9e8d",
+                  "hostname": "server-01",
+                  "pid": 12345,
+                  "state": "DRAINING",
+                  "date_start": 1622479620.02,
+                  "date_heartbeat": 1622483220.02,
+                  "date_drain": 1622483210.5,
+                  "handoff_taken": 1,
+                  "alive": true
+                }
+              ],
+              "code": 0
+            }
+            """
+            return {'response': await self._core.get_instances(), 'code': 0}
+
+        @self.app.get('/api/sys/drain', dependencies=[fastapi.Depends(check_auth)])
+        async def get_drain_status():
+            """
+            {
+              "response": {
+                "instance_id": "0f6f7a1c9d2b4c1e8a5d3b2c1a0f9e8d",
+                "draining": true,
+                "deadline": 1622486810.5,
+                "running": 2
+              },
+              "code": 0
+            }
+            """
+            return {'response': self._core.get_drain_status(), 'code': 0}
+
+        class DrainInfo(pydantic.BaseModel):
+            timeout: typing.Optional[float] = None
+
+        @self.app.post('/api/sys/drain', dependencies=[fastapi.Depends(check_auth)])
+        async def drain(drain_info: DrainInfo):
+            """开始排空 不再调度新的触发 等待运行中的任务结束后退出 timeout为最多等待的秒数."""
+            return {'response': await self._core.drain(drain_info.timeout), 'code': 0}
+
+        @self.app.websocket('/api/agent/ws')
+        async def agent_websocket(websocket: fastapi.WebSocket):
+            # agent在连接后发送的hello消息中使用agent_token验证
+            await websocket.accept()
+            await self._core.serve_agent(websocket)
+            try:
+                await websocket.close()
+            except RuntimeError:
+                # 连接已经关闭
+                pass
+
         class JobInfo(pydantic.BaseModel):
             cron_exp: str
             command: str
             name: str
             param: str = ''
+            options: typing.Dict[str, typing.Any] = {}
 
         @self.app.post('/api/job', dependencies=[fastapi.Depends(check_auth)])
         async def add_job(job_info: JobInfo):
             if not self._core.cron_is_valid(job_info.cron_exp):
                 return {'response': 'cron表达式无效', 'code': 2}
-            job = await self._core.add_job(job_info.cron_exp, job_info.command,
-                                           job_info.param, name=job_info.name)
+            try:
+                job = await self._core.add_job(job_info.cron_exp, job_info.command,
+                                               job_info.param, name=job_info.name,
+                                               options=job_info.options)
+            except (TypeError, ValueError) as e:
+                return {'response': f'options无效: {e}', 'code': 2}
             if not job:
                 return {'response': 'failed', 'code': 1}
             return {'response': 'success', 'code': 0}
@@ -183,7 +306,9 @@ class WebFastAPI(web.WebBase):
                   "param": "",
                   "name": "睡眠",
                   "date_create": "2021-06-01 00:46:39.090237",
-                  "date_update": "2021-06-01 00:46:39.090237"
+                  "date_update": "2021-06-01 00:46:39.090237",
+                  "active": 1,
+                  "options": {"exec_mode": "exec"}
                 }
               ],
               "code": 0
@@ -223,6 +348,34 @@ class WebFastAPI(web.WebBase):
                 return {'response': '任务未在运行或已运行结束', 'code': 0}
             return {'response': '成功停止运行', 'code': 0}
 
+        @self.app.get('/api/retries', dependencies=[fastapi.Depends(check_auth)])
+        async def get_retries():
+            """等待执行的重试 date_due为计划执行时间(unix时间戳)
+            {
+            "response": [
+                {
+                  "id": 3,
+                  "uuid": "ee5141b095d0426dbd3b375aa00de533",
+                  "shot_id_root": "676389e11bf04195a8c4ac3537b640ac",
+                  "attempt": 1,
+                  "date_due": 1622479650.02,
+                  "date_create": 1622479620.02,
+                  "run_id": null
+                }
+              ],
+              "code": 0
+            }
+            """
+            retries = await self._core.retry_get_all()
+            return {'response': [retry._asdict() for retry in retries], 'code': 0}
+
+        @self.app.delete('/api/retries/{retry_id}', dependencies=[fastapi.Depends(check_auth)])
+        async def cancel_retry(retry_id: int):
+            retry = await self._core.retry_cancel(retry_id)
+            if not retry:
+                return {'response': '重试不存在或已开始执行', 'code': 2}
+            return {'response': '取消成功', 'code': 0}
+
         @self.app.get('/api/logs', dependencies=[fastapi.Depends(check_auth)])
         async def get_logs_records_undeleted(limit: int = 50):
             """
@@ -234,7 +387,12 @@ class WebFastAPI(web.WebBase):
                   "state": "DONE",
                   "log_path": "logs\\1622479620020-676389e11bf04195a8c4ac3537b640ac.log",
                   "date_start": "2021-06-01 00:47:00.020000",
-                  "date_end": "2021-06-01 00:47:30.067080"
+                  "date_end": "2021-06-01 00:47:30.067080",
+                  "cpu_user": 0.031,
+                  "cpu_sys": 0.012,
+                  "max_rss": 9216,
+                  "io_read": 0,
+                  "io_write": 8
                 }
               ],
               "code": 0
@@ -243,6 +401,55 @@ class WebFastAPI(web.WebBase):
             records = await self._core.job_logs_get_undeleted(limit)
             return {'response': [rec._asdict() for rec in records], 'code': 0}
 
+        @self.app.get('/api/logs/top', dependencies=[fastapi.Depends(check_auth)])
+        async def get_top_consumers(by: str = 'cpu', limit: int = 10, days: typing.Optional[int] = None):
+            """按job汇总资源占用 by可选cpu rss io
+            {
+            "response": [
+                {
+                  "uuid": "ee5141b095d0426dbd3b375aa00de533",
+                  "name": "睡眠",
+                  "shots": 120,
+                  "cpu_user": 3.72,
+                  "cpu_sys": 1.44,
+                  "max_rss": 9216,
+                  "io_read": 0,
+                  "io_write": 960
+                }
+              ],
+              "code": 0
+            }
+            """
+            try:
+                summaries = await self._core.job_logs_top_consumers(by, limit, days)
+            except ValueError as e:
+                return {'response': str(e), 'code': 2}
+            return {'response': [summary._asdict() for summary in summaries], 'code': 0}
+
+        @self.app.get('/api/logs/search', dependencies=[fastapi.Depends(check_auth)])
+        async def search_logs(q: str, uuid: typing.Optional[str] = None,
+                              limit: int = fastapi.Query(50, ge=1, le=1000)):
+            """搜索日志内容 q作为一个完整的短语匹配(不区分大小写) 按运行时间降序
+            line为这段内容的起始行 可以用/api/log/{shot_id}?offset={line}查看上下文
+            {
+            "response": [
+                {
+                  "shot_id": "676389e11bf04195a8c4ac3537b640ac",
+                  "uuid": "ee5141b095d0426dbd3b375aa00de533",
+                  "line": 200,
+                  "snippet": "...Traceback (most recent call last)...[ConnectionResetError]: ...",
+                  "date_start": "2021-06-01 00:47:00.020000"
+                }
+              ],
+              "code": 0
+            }
+            """
+            try:
+                hits = await self._core.log_search(q, uuid, limit)
+            except RuntimeError as e:
+                return {'response': str(e), 'code': 2}
+            return {'response': [hit._asdict() for hit in hits], 'code': 0}
+
         @self.app.get('/api/job/{uuid}/logs', dependencies=[fastapi.Depends(check_auth)])
         async def get_logs_record_by_uuid(uuid: str):
             """
@@ -254,7 +461,12 @@ class WebFastAPI(web.WebBase):
                   "state": "DONE",
                   "log_path": "logs\\1622479620020-676389e11bf04195a8c4ac3537b640ac.log",
                   "date_start": "2021-06-01 00:47:00.020000",
-                  "date_end": "2021-06-01 00:47:30.067080"
+                  "date_end": "2021-06-01 00:47:30.067080",
+                  "cpu_user": 0.031,
+                  "cpu_sys": 0.012,
+                  "max_rss": 9216,
+                  "io_read": 0,
+                  "io_write": 8
                 }
               ],
               "code": 0
@@ -263,15 +475,120 @@ class WebFastAPI(web.WebBase):
             records = await self._core.job_logs_get_by_uuid(uuid)
             return {'response': [rec._asdict() for rec in records], 'code': 0}
 
+        @self.app.get('/api/job/{uuid}/metrics', dependencies=[fastapi.Depends(check_auth)])
+        async def get_metrics_by_uuid(uuid: str, name: typing.Optional[str] = None,
+                                      days: typing.Optional[int] = None, limit: int = 1000):
+            """任务输出中::metric行报告的指标 按时间升序 ts为运行结束时间(unix时间戳)
+            {
+            "response": [
+                {
+                  "shot_id": "676389e11bf04195a8c4ac3537b640ac",
+                  "name": "rows",
+                  "value": 1024.0,
+                  "ts": 1622479650.02
+                }
+              ],
+              "code": 0
+            }
+            """
+            metrics = await self._core.job_metrics_get(uuid, name, days, limit)
+            return {'response': [metric._asdict() for metric in metrics], 'code': 0}
+
+        @self.app.get('/api/job/{uuid}/durations', dependencies=[fastapi.Depends(check_auth)])
+        async def get_duration_stats(uuid: str):
+            """最近成功运行时长的估计(秒)和当前的自适应超时 样本不足时adaptive_timeout为null
+            {
+            "response": {
+                "count": 42,
+                "ewma": 61.3,
+                "p50": 58.9,
+                "p90": 70.2,
+                "p99": 88.7,
+                "adaptive_timeout": 266.1
+              },
+              "code": 0
+            }
+            """
+            stats = self._core.job_duration_stats(uuid)
+            if stats is None:
+                return {'response': '任务不存在 未开启自适应超时或还未运行', 'code': 2}
+            return {'response': stats, 'code': 0}
+
+        @self.app.get('/api/job/{uuid}/runs', dependencies=[fastapi.Depends(check_auth)])
+        async def get_runs_by_uuid(uuid: str, limit: int = 20):
+            """分片任务最近的运行 按开始时间降序
+            {
+            "response": [
+                {
+                  "run_id": "5b1f0c3e8f4a4e6f9d2c7a1b0e9d8c7b",
+                  "uuid": "ee5141b095d0426dbd3b375aa00de533",
+                  "state": "ERROR",
+                  "shards": 8,
+                  "date_start": "2021-06-01 00:47:00.020000",
+                  "date_end": "2021-06-01 00:47:30.067080"
+                }
+              ],
+              "code": 0
+            }
+            """
+            runs = await self._core.runs_get_by_uuid(uuid, limit)
+            return {'response': [run._asdict() for run in runs], 'code': 0}
+
+        @self.app.get('/api/runs/{run_id}', dependencies=[fastapi.Depends(check_auth)])
+        async def get_run_detail(run_id: str):
+            """分片运行和其中每个分片的运行记录(包括重试) shots按开始时间升序
+            {
+            "response": {
+                "run": {"run_id": "5b1f0c3e8f4a4e6f9d2c7a1b0e9d8c7b", "state": "ERROR", ...},
+                "shots": [{"shot_id": "676389e11bf04195a8c4ac3537b640ac", "shard": "0", "state": "DONE", ...}]
+              },
+              "code": 0
+            }
+            """
+            detail = await self._core.run_get_detail(run_id)
+            if detail is None:
+                return {'response': 'run_id不存在', 'code': 2}
+            run, records = detail
+            return {'response': {'run': run._asdict(), 'shots': [rec._asdict() for rec in records]}, 'code': 0}
+
+        @self.app.post('/api/runs/{run_id}/retry', dependencies=[fastapi.Depends(check_auth)])
+        async def retry_run(run_id: str):
+            """重新运行分片运行中失败的分片."""
+            job_info = await self._core.run_retry(run_id)
+            if not job_info:
+                return {'response': 'run_id不存在 任务不存在或仍在运行', 'code': 2}
+            return {'response': job_info._asdict(), 'code': 0}
+
         @self.app.get('/api/log/{shot_id}',
                       dependencies=[fastapi.Depends(check_auth)],
                       response_class=fastapi.responses.PlainTextResponse)
-        async def get_log_by_shot_id(shot_id: str):
-            log_record = await self._core.job_log_get_by_shot_id(shot_id)
-            if not log_record:
+        async def get_log_by_shot_id(shot_id: str,
+                                     offset: int = fastapi.Query(0, ge=0),
+                                     limit: int = fastapi.Query(1000, ge=0),
+                                     tail: typing.Optional[int] = fastapi.Query(None, ge=0)):
+            """从第offset行(从0开始)开始的limit行 指定tail时为最后tail行."""
+            log_record = await self._core.job_log_get_by_shot_id(shot_id, limit, offset, tail)
+            if log_record is None:
                 return '日志不存在'
             return log_record
 
+        @self.app.get('/api/log/{shot_id}/stream', dependencies=[fastapi.Depends(check_auth)])
+        async def stream_log_by_shot_id(shot_id: str):
+            """以Server-Sent Events实时返回日志
+            先返回已写入的内容 任务运行中时继续返回新的输出 运行结束后发送end事件
+            """
+            stream = await self._core.job_log_stream(shot_id)
+            if stream is None:
+                return {'response': '日志不存在', 'code': 2}
+
+            async def events():
+                async for content in stream:
+                    yield ''.join(f'data: {line}\n' for line in content.split('\n')) + '\n'
+                yield 'event: end\ndata: \n\n'
+
+            return fastapi.responses.StreamingResponse(events(), media_type='text/event-stream',
+                                                       headers={'Cache-Control': 'no-cache'})
+
         self.app.mount("/", fastapi.staticfiles.StaticFiles(directory="static", html=True), name="site")
 
     @staticmethod
@@ -350,5 +667,10 @@ class WebFastAPI(web.WebBase):
             uv_kwargs['ssl_cert_reqs'] = ssl.CERT_REQUIRED
 
         config = uvicorn.Config(self.app, host, port, workers=1, **uv_kwargs)
-        server = uvicorn.Server(config)
-        return await server.serve()
+        self._server = uvicorn.Server(config)
+        return await self._server.serve()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._py_logger.info('停止fastAPI')
+            self._server.should_exit = True
@@ -3,9 +3,11 @@ import abc
 import typing
 import enum
 import logging
+import re
 
 if typing.TYPE_CHECKING:
     import cronweb
+    import storage
 
 
 class JobStateEnum(enum.Enum):
@@ -14,6 +16,8 @@ class JobStateEnum(enum.Enum):
     ERROR = 3
     KILLED = 4
     UNKNOWN = 5
+    # 退出码为0 但输出匹配到了warn_patterns
+    WARN = 6
 
 
 class JobTypeEnum(enum.Enum):
@@ -22,12 +26,216 @@ class JobTypeEnum(enum.Enum):
     MANUAL = 3
 
 
+class JobOptionsError(ValueError):
+    """invalid job options."""
+
+
+class JobOptions(typing.NamedTuple):
+    """job的扩展配置 以dict的形式保存在job中
+    未出现在字段中的key会被忽略
+    """
+    # shell: 经过shell执行command  exec: 将command解析为argv后直接执行 不经过shell
+    # http: command为url param为请求体 在CronWeb进程内发送http请求 不启动子进程
+    exec_mode: str = 'shell'
+    # 以下为子进程启动时设置的执行参数(仅Linux完整支持) None为不设置
+    # nice值 -20~19
+    nice: typing.Optional[int] = None
+    # io调度类型 realtime best-effort idle 及其优先级0~7
+    ionice_class: typing.Optional[str] = None
+    ionice_level: int = 4
+    # 允许使用的CPU编号列表
+    cpu_affinity: typing.Optional[typing.List[int]] = None
+    # 虚拟内存上限(字节) CPU时间上限(秒) 打开文件数上限
+    rlimit_as: typing.Optional[int] = None
+    rlimit_cpu: typing.Optional[int] = None
+    rlimit_nofile: typing.Optional[int] = None
+    # 远程agent标签 不为None时只在拥有全部标签的agent上运行
+    labels: typing.Optional[typing.List[str]] = None
+    # 输出上限 只保留前head KB和后tail KB的输出 都为None时使用worker的默认配置
+    output_head_kb: typing.Optional[int] = None
+    output_tail_kb: typing.Optional[int] = None
+    # 分片 每次触发时每个分片作为param分别运行一次 shards为分片参数列表 shard_range为[start, stop(, step)]
+    shards: typing.Optional[typing.List[typing.Union[str, int]]] = None
+    shard_range: typing.Optional[typing.List[int]] = None
+    # 同时运行的分片数量上限
+    shard_concurrency: int = 4
+    # param的传递方式 argv: 作为命令行参数--param传入  stdin: 作为子进程的标准输入
+    # file: 写入匿名文件 文件路径通过环境变量CRONWEB_PARAM_FILE传入
+    param_mode: str = 'argv'
+    # 输出分类 输出中有行匹配fail_patterns时运行状态为ERROR 匹配warn_patterns且退出码为0时为WARN
+    # 与worker配置中的全局表达式合并使用
+    fail_patterns: typing.Optional[typing.List[str]] = None
+    warn_patterns: typing.Optional[typing.List[str]] = None
+    # 自适应超时 不为None时运行时长超过 adaptive_timeout * max(p99, ewma) 的任务被停止(kill)或标记为WARN(warn)
+    # p99和ewma由最近成功运行的时长估计 样本不足时不生效
+    adaptive_timeout: typing.Optional[float] = None
+    adaptive_timeout_action: str = 'kill'
+    # http模式的请求方法和请求头
+    http_method: str = 'GET'
+    http_headers: typing.Optional[typing.Dict[str, str]] = None
+    # 运行结束后日志文件的压缩方式 auto: 已安装zstandard时为zstd 否则为gzip  none: 不压缩  None为logger的默认配置
+    log_compress: typing.Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, options: typing.Optional[typing.Dict[str, typing.Any]]) -> JobOptions:
+        if not options:
+            return cls()
+        job_options = cls(**{key: value for key, value in options.items() if key in cls._fields})
+        job_options.check()
+        return job_options
+
+    def check(self):
+        if self.exec_mode not in ('shell', 'exec', 'http'):
+            raise JobOptionsError(f'exec_mode must be shell, exec or http, not {self.exec_mode}')
+        if self.param_mode not in ('argv', 'stdin', 'file'):
+            raise JobOptionsError(f'param_mode must be argv, stdin or file, not {self.param_mode}')
+        for name in ('fail_patterns', 'warn_patterns'):
+            patterns = getattr(self, name)
+            if patterns is None:
+                continue
+            if not isinstance(patterns, list) or not all(isinstance(pattern, str) for pattern in patterns):
+                raise JobOptionsError(f'{name} must be a list of regular expressions')
+            for pattern in patterns:
+                try:
+                    re.compile(pattern.encode('utf8'))
+                except re.error as e:
+                    raise JobOptionsError(f'invalid pattern in {name}: {pattern!r} {e}') from None
+        if self.adaptive_timeout is not None and (
+                not isinstance(self.adaptive_timeout, (int, float)) or self.adaptive_timeout < 1):
+            raise JobOptionsError('adaptive_timeout must be a number >= 1')
+        if self.adaptive_timeout_action not in ('kill', 'warn'):
+            raise JobOptionsError('adaptive_timeout_action must be kill or warn')
+        if not isinstance(self.http_method, str) or not self.http_method.isalpha():
+            raise JobOptionsError('http_method must be a http method name')
+        if self.http_headers is not None and (
+                not isinstance(self.http_headers, dict)
+                or not all(isinstance(k, str) and isinstance(v, str) for k, v in self.http_headers.items())):
+            raise JobOptionsError('http_headers must be a dict of strings')
+        if self.log_compress is not None and self.log_compress not in ('auto', 'zstd', 'gzip', 'none'):
+            raise JobOptionsError('log_compress must be auto, zstd, gzip or none')
+        if self.nice is not None and not -20 <= self.nice <= 19:
+            raise JobOptionsError('nice must be in -20~19')
+        if self.ionice_class is not None and self.ionice_class not in ('realtime', 'best-effort', 'idle'):
+            raise JobOptionsError('ionice_class must be realtime, best-effort or idle')
+        if not 0 <= self.ionice_level <= 7:
+            raise JobOptionsError('ionice_level must be in 0~7')
+        if self.cpu_affinity is not None and (
+                not self.cpu_affinity or not all(isinstance(cpu, int) and cpu >= 0 for cpu in self.cpu_affinity)):
+            raise JobOptionsError('cpu_affinity must be a non-empty list of cpu numbers')
+        for name in ('rlimit_as', 'rlimit_cpu', 'rlimit_nofile'):
+            value = getattr(self, name)
+            if value is not None and (not isinstance(value, int) or value <= 0):
+                raise JobOptionsError(f'{name} must be a positive integer')
+        if self.labels is not None and not all(isinstance(label, str) and label for label in self.labels):
+            raise JobOptionsError('labels must be a list of non-empty strings')
+        if self.shards is not None and self.shard_range is not None:
+            raise JobOptionsError('only one of shards and shard_range can be set')
+        if self.shards is not None and (
+                not self.shards or not all(isinstance(shard, (str, int)) for shard in self.shards)):
+            raise JobOptionsError('shards must be a non-empty list of strings or integers')
+        if self.shard_range is not None:
+            if not 2 <= len(self.shard_range) <= 3 or not all(isinstance(i, int) for i in self.shard_range):
+                raise JobOptionsError('shard_range must be [start, stop] or [start, stop, step]')
+            if (len(self.shard_range) == 3 and self.shard_range[2] == 0) or not range(*self.shard_range):
+                raise JobOptionsError('shard_range must not be empty')
+        if not isinstance(self.shard_concurrency, int) or self.shard_concurrency <= 0:
+            raise JobOptionsError('shard_concurrency must be a positive integer')
+        for name in ('output_head_kb', 'output_tail_kb'):
+            value = getattr(self, name)
+            if value is not None and (not isinstance(value, int) or value < 0):
+                raise JobOptionsError(f'{name} must be a non-negative integer')
+
+    def shard_params(self) -> typing.Optional[typing.List[str]]:
+        """分片参数列表 非分片任务返回None."""
+        if self.shards is not None:
+            return [str(shard) for shard in self.shards]
+        if self.shard_range is not None:
+            return [str(i) for i in range(*self.shard_range)]
+        return None
+
+    def need_preexec(self) -> bool:
+        """是否有需要在子进程exec之前设置的执行参数."""
+        return any(value is not None for value in (self.nice, self.ionice_class, self.cpu_affinity,
+                                                   self.rlimit_as, self.rlimit_cpu, self.rlimit_nofile))
+
+
+class ShotUsage(typing.NamedTuple):
+    """子进程的资源占用 来自wait4返回的rusage."""
+    # 用户态/内核态CPU时间 单位:秒
+    cpu_user: float
+    cpu_sys: float
+    # 最大常驻内存 单位:KB(Linux)
+    max_rss: int
+    # 块设备读写次数
+    io_read: int
+    io_write: int
+
+
 class JobState(typing.NamedTuple):
     uuid: str
     state: JobStateEnum
     shot_id: str
     date_start: str
     date_end: str = ''
+    usage: typing.Optional[ShotUsage] = None
+    # 任务输出中::metric行报告的指标 {name: value} 同名指标保留最后一次的值
+    metrics: typing.Optional[typing.Dict[str, float]] = None
+    # 分片任务的运行id和分片参数
+    run_id: typing.Optional[str] = None
+    shard: typing.Optional[str] = None
+    # 子进程的pid 进程组id和启动标识(boot_id:启动时间) 用于CronWeb重启后找回子进程
+    pid: typing.Optional[int] = None
+    pgid: typing.Optional[int] = None
+    proc_start: typing.Optional[str] = None
+
+
+class JobDoneContext:
+    """单次运行结束时传给hook的上下文 包含运行结果和内存中的最后几行输出 hook不需要再查询storage或读取日志
+    exit_code在子进程启动失败时为None
+    """
+    __slots__ = ('uuid', 'shot_id', 'name', 'state', 'job_type', 'exit_code', 'date_start', 'date_end',
+                 'duration', 'usage', 'metrics', 'output_tail', 'log_path', 'run_id', 'shard')
+
+    def __init__(self, uuid: str, shot_id: str, name: str, state: JobStateEnum, job_type: JobTypeEnum,
+                 exit_code: typing.Optional[int], date_start: str, date_end: str, duration: float,
+                 usage: typing.Optional[ShotUsage] = None,
+                 metrics: typing.Optional[typing.Dict[str, float]] = None,
+                 output_tail: str = '', log_path: str = '',
+                 run_id: typing.Optional[str] = None, shard: typing.Optional[str] = None):
+        self.uuid = uuid
+        self.shot_id = shot_id
+        self.name = name
+        self.state = state
+        self.job_type = job_type
+        self.exit_code = exit_code
+        self.date_start = date_start
+        self.date_end = date_end
+        # 运行时长 单位:秒
+        self.duration = duration
+        self.usage = usage
+        self.metrics = metrics
+        self.output_tail = output_tail
+        self.log_path = log_path
+        self.run_id = run_id
+        self.shard = shard
+
+    def __repr__(self) -> str:
+        return f'JobDoneContext(shot_id={self.shot_id!r}, name={self.name!r}, state={self.state.name})'
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        out = {name: getattr(self, name) for name in self.__slots__}
+        out['state'] = self.state.name
+        out['job_type'] = self.job_type.name
+        out['usage'] = self.usage._asdict() if self.usage is not None else None
+        return out
+
+    @classmethod
+    def from_dict(cls, data: typing.Dict[str, typing.Any]) -> JobDoneContext:
+        data = dict(data)
+        data['state'] = JobStateEnum[data['state']]
+        data['job_type'] = JobTypeEnum[data['job_type']]
+        data['usage'] = ShotUsage(**data['usage']) if data.get('usage') else None
+        return cls(**data)
 
 
 class WorkerBase(abc.ABC):
@@ -36,13 +244,20 @@ class WorkerBase(abc.ABC):
         self._core: typing.Optional[cronweb.CronWeb] = controller
         self._py_logger: logging.Logger = logging.getLogger(f'cronweb.{self.__class__.__name__}')
         self.controller_default()
-        self._job_done_hooks: typing.List[
-            typing.Callable[[str, str, JobStateEnum, JobTypeEnum], typing.Coroutine[None]]] = []
+        self._job_done_hooks: typing.List[typing.Callable[..., typing.Coroutine[None]]] = []
+        # 以JobDoneContext调用的hook 其余hook以(name, shot_id, state, job_type)调用
+        self._context_hooks: typing.Set[typing.Callable[[JobDoneContext], typing.Coroutine[None]]] = set()
 
     def add_job_done_hook(self, func: typing.Callable[[str, str, JobStateEnum, JobTypeEnum], typing.Coroutine[None]]):
         if func not in self._job_done_hooks:
             self._job_done_hooks.append(func)
 
+    def add_job_done_context_hook(self, func: typing.Callable[[JobDoneContext], typing.Coroutine[None]]):
+        """添加以JobDoneContext调用的hook."""
+        if func not in self._job_done_hooks:
+            self._job_done_hooks.append(func)
+            self._context_hooks.add(func)
+
     def set_controller(self, controller: cronweb.CronWeb):
         self._core = controller
 
@@ -51,7 +266,15 @@ class WorkerBase(abc.ABC):
             self._core.set_worker_default(self)
 
     @abc.abstractmethod
-    async def shoot(self, command: str, param: str, uuid: str, timeout: float, name: str, job_type: JobTypeEnum):
+    async def shoot(self, command: str, param: str, uuid: str, timeout: float, name: str, job_type: JobTypeEnum,
+                    options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                    attempt: int = 0, shot_id_root: typing.Optional[str] = None,
+                    run_id: typing.Optional[str] = None):
+        """执行一次job
+        attempt为第几次重试(0为首次运行) shot_id_root为第一次运行失败的shot_id
+        run_id不为None时重试这次分片运行中失败的分片
+        运行失败时由worker决定是否通过controller安排下一次重试
+        """
         pass
 
     @abc.abstractmethod
@@ -66,6 +289,31 @@ class WorkerBase(abc.ABC):
     async def kill_by_shot_id(self, shot_id: str) -> typing.Optional[str]:
         pass
 
+    async def start(self):
+        """CronWeb启动时调用 用于启动worker的后台任务."""
+        pass
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        """worker运行状态统计."""
+        return {}
+
+    async def adopt_orphan(self, record: storage.LogRecord, name: str) -> bool:
+        """CronWeb重启前启动的运行记录仍为RUNNING时调用
+        子进程仍在运行时接管(或停止)它并在其结束后记录运行状态 返回True 子进程已不存在时返回False
+        """
+        return False
+
+    def get_duration_stats(self, uuid: str, job_options: typing.Optional[JobOptions] = None
+                           ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """job运行时长的估计和自适应超时 没有估计时返回None."""
+        return None
+
+    async def serve_agent(self, connection: typing.Any) -> None:
+        """处理远程agent的连接 connection需要提供send_json/receive_json/close方法
+        连接断开后返回 不支持远程agent的worker直接返回
+        """
+        self._py_logger.warning('当前worker不支持远程agent')
+
     @abc.abstractmethod
     def stop(self):
         pass
@@ -0,0 +1,110 @@
+"""在子进程中设置nice io优先级 CPU亲和性和资源限制
+worker启动子进程后通过apply(settings, pid)从外部设置(子进程在exec任务命令之前等待设置完成)
+系统不支持从外部设置时(没有resource.prlimit 例如macOS) 以python exec_wrapper.py {设置} 命令 参数...启动子进程
+由这个新进程设置后exec任务命令 两种方式都不在fork之后的子进程中执行Python代码(在有其他线程时不安全)
+只使用标准库和可选的psutil 以脚本方式运行时不导入cronweb的模块
+"""
+import os
+import sys
+import json
+import ctypes
+import struct
+import platform
+import typing
+
+try:
+    import resource
+except (ImportError, ModuleNotFoundError):
+    # windows
+    resource = None
+
+try:
+    import psutil
+except (ImportError, ModuleNotFoundError):
+    psutil = None
+
+IOPRIO_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+# 没有安装psutil时直接调用ioprio_set(标准库没有设置io优先级的接口)
+# 系统调用号取决于当前解释器的ABI而不是内核的架构 platform.machine()返回的是内核的架构
+# 所以按(架构, 指针位数)查找 64位内核上运行的32位解释器使用32位的调用号 未列出的组合不支持
+_SYSCALL_IOPRIO_SET = {('x86_64', 64): 251, ('x86_64', 32): 289, ('i386', 32): 289, ('i686', 32): 289,
+                       ('aarch64', 64): 30, ('aarch64', 32): 314, ('armv7l', 32): 314,
+                       ('ppc64le', 64): 273, ('riscv64', 64): 30}
+# 设置失败或命令无法执行时的退出码 与shell一致
+EXIT_SETUP_FAILED = 126
+EXIT_NOT_FOUND = 127
+
+
+def _ioprio_syscall_number() -> typing.Optional[int]:
+    if sys.platform != 'linux':
+        return None
+    return _SYSCALL_IOPRIO_SET.get((platform.machine(), struct.calcsize('P') * 8))
+
+
+def ioprio_supported() -> bool:
+    if psutil is not None:
+        return hasattr(psutil.Process, 'ionice') and sys.platform == 'linux'
+    return _ioprio_syscall_number() is not None
+
+
+def pid_supported(settings: typing.Dict[str, typing.Any]) -> bool:
+    """settings能否在子进程启动后从外部设置 资源限制需要resource.prlimit(Linux)."""
+    return not settings.get('rlimits') or hasattr(resource, 'prlimit')
+
+
+def wrap_args(settings: typing.Dict[str, typing.Any], args: typing.Sequence[str]) -> typing.List[str]:
+    """通过启动器执行args的命令行 settings的内容见apply."""
+    return [sys.executable, '-I', os.path.abspath(__file__), json.dumps(settings), *args]
+
+
+def _set_ionice(pid: int, ionice_class: str, level: int):
+    if psutil is not None:
+        psutil_class = {'realtime': psutil.IOPRIO_CLASS_RT, 'best-effort': psutil.IOPRIO_CLASS_BE,
+                        'idle': psutil.IOPRIO_CLASS_IDLE}[ionice_class]
+        psutil.Process(pid or os.getpid()).ionice(psutil_class, None if ionice_class == 'idle' else level)
+        return
+    number = _ioprio_syscall_number()
+    if number is None:
+        raise OSError('ioprio_set is not supported')
+    libc = ctypes.CDLL(None, use_errno=True)
+    # IOPRIO_WHO_PROCESS=1 who为0时是当前进程
+    if libc.syscall(number, 1, pid, (IOPRIO_CLASSES[ionice_class] << 13) | level) != 0:
+        raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+
+
+def apply(settings: typing.Dict[str, typing.Any], pid: int = 0):
+    """设置进程pid(0为当前进程)的执行参数
+    nice: nice值 ionice: (io调度类型, 优先级) cpus: CPU编号列表 rlimits: [(资源名, 软限制, 硬限制)]
+    """
+    if settings.get('nice') is not None:
+        os.setpriority(os.PRIO_PROCESS, pid, settings['nice'])
+    if settings.get('ionice') is not None:
+        _set_ionice(pid, *settings['ionice'])
+    if settings.get('cpus'):
+        os.sched_setaffinity(pid, settings['cpus'])
+    for name, soft, hard in settings.get('rlimits', ()):
+        if pid:
+            resource.prlimit(pid, getattr(resource, name), (soft, hard))
+        else:
+            resource.setrlimit(getattr(resource, name), (soft, hard))
+
+
+def main(argv: typing.List[str]) -> int:
+    if len(argv) < 3:
+        print(f'usage: {argv[0]} SETTINGS COMMAND [ARGS...]', file=sys.stderr)
+        return 2
+    try:
+        apply(json.loads(argv[1]))
+    except Exception as e:
+        print(f'cronweb exec_wrapper: 设置执行参数失败 {e!r}', file=sys.stderr)
+        return EXIT_SETUP_FAILED
+    sys.stderr.flush()
+    try:
+        os.execvp(argv[2], argv[2:])
+    except OSError as e:
+        print(f'cronweb exec_wrapper: 无法执行 {argv[2]} {e!r}', file=sys.stderr)
+        return EXIT_NOT_FOUND if isinstance(e, FileNotFoundError) else EXIT_SETUP_FAILED
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
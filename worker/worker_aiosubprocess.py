@@ -1,12 +1,19 @@
 import concurrent.futures
+import collections
+import bisect
+import enum
+import sys
 import logging
 import os
 import json
 import pathlib
 import asyncio
 import datetime
+import time
 import typing
 import worker
+import worker.exec_wrapper
+import storage
 import cronweb
 import logger
 import locale
@@ -15,8 +22,22 @@ import base64
 import aiohttp
 import asyncio.subprocess
 import threading
+import shlex
+import signal
+import subprocess
+import tempfile
+import re
+import math
+import codecs
+import itertools
 from uuid import uuid4
 
+try:
+    import resource
+except (ImportError, ModuleNotFoundError):
+    # windows
+    resource = None
+
 
 class EventLoopThreadStopError(Exception):
     pass
@@ -48,7 +69,7 @@ class HookEventLoopThread(threading.Thread):
 
     async def _timeout_wrap(self, coroutine: typing.Coroutine, timeout: float):
         try:
-            await asyncio.wait_for(coroutine, timeout)
+            return await asyncio.wait_for(coroutine, timeout)
         except asyncio.TimeoutError as e:
             self._py_logger.warning('hook执行超时')
             self._py_logger.exception(e)
@@ -73,14 +94,1094 @@ class HookEventLoopThread(threading.Thread):
         self.join()
 
 
+class HookStats:
+    """单个hook的执行次数 错误次数和耗时分布."""
+    # 耗时直方图的桶上限 单位:秒 最后一个桶为超过30s
+    buckets = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+    __slots__ = ('count', 'errors', 'timeouts', 'dropped', 'time_total', 'time_max', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.dropped = 0
+        self.time_total = 0.0
+        self.time_max = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def record(self, elapsed: float):
+        self.count += 1
+        self.time_total += elapsed
+        self.time_max = max(self.time_max, elapsed)
+        self.histogram[bisect.bisect_left(self.buckets, elapsed)] += 1
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'dropped': self.dropped,
+            'time_avg': self.time_total / self.count if self.count else 0.0,
+            'time_max': self.time_max,
+            'histogram': {**{f'le_{le}': n for le, n in zip(self.buckets, self.histogram)},
+                          'inf': self.histogram[-1]},
+        }
+
+
+class DurationEstimator:
+    """job运行时长的流式估计
+    ewma为指数加权平均 分位数由按对数分桶的草图估计(相对误差不超过accuracy)
+    每加入一个样本 旧样本的权重乘以(1 - 1/window) 估计值只反映最近约window次运行
+    """
+    __slots__ = ('window', 'count', 'ewma', '_alpha', '_decay', '_gamma', '_gamma_log', '_buckets', '_weight')
+
+    def __init__(self, window: int = 200, accuracy: float = 0.02):
+        self.window = window
+        self.count = 0
+        self.ewma = 0.0
+        self._alpha = 2 / (min(window, 20) + 1)
+        self._decay = 1 - 1 / window
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._gamma_log = math.log(self._gamma)
+        # {桶序号: 权重} 桶i覆盖(gamma^(i-1), gamma^i]
+        self._buckets: typing.Dict[int, float] = {}
+        self._weight = 0.0
+
+    def add(self, seconds: float):
+        seconds = max(seconds, 0.001)
+        self.ewma = seconds if self.count == 0 else self.ewma + self._alpha * (seconds - self.ewma)
+        self.count += 1
+        decay = self._decay
+        for index in list(self._buckets):
+            weight = self._buckets[index] * decay
+            # 权重很小的桶直接丢弃 桶的数量保持在很小的范围内
+            if weight < 1e-3:
+                del self._buckets[index]
+            else:
+                self._buckets[index] = weight
+        self._weight = self._weight * decay + 1
+        index = math.ceil(math.log(seconds) / self._gamma_log)
+        self._buckets[index] = self._buckets.get(index, 0.0) + 1
+
+    def quantile(self, q: float) -> float:
+        if not self._buckets:
+            return 0.0
+        rank = q * sum(self._buckets.values())
+        total = 0.0
+        for index in sorted(self._buckets):
+            total += self._buckets[index]
+            if total >= rank:
+                break
+        # 桶的中点 相对误差不超过accuracy
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {'count': self.count, 'ewma': self.ewma,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class HookExecutor:
+    """在多个hook事件循环线程中执行hook
+    提交的hook先进入有界队列 由固定数量的分发task取出执行 同时执行的hook数量不超过concurrency
+    队列已满时按overflow策略处理:
+    drop_oldest: 丢弃队列中最早的hook
+    block: 提交方最多等待block_timeout秒 仍然没有空位则丢弃
+    spill: 追加写入磁盘文件 队列空闲时从记录的读取位置继续读取执行(重启后同样会读取) 全部读取后清空文件
+    hook按函数对象区分 注册时分配唯一的名称用于统计和写入磁盘
+    """
+    overflow_policies = ('drop_oldest', 'block', 'spill')
+
+    def __init__(self, threads: int = 1, queue_size: int = 1000, concurrency: int = 16,
+                 overflow: str = 'drop_oldest', timeout: float = 30, block_timeout: float = 30,
+                 spill_path: typing.Optional[typing.Union[str, pathlib.Path]] = None):
+        if overflow not in self.overflow_policies:
+            raise ValueError(f'hook overflow must be one of {self.overflow_policies}')
+        if overflow == 'spill' and spill_path is None:
+            raise ValueError('spill_path is required when hook overflow is spill')
+        self._py_logger = logging.getLogger('cronweb.worker.HookExecutor')
+        self.threads = [HookEventLoopThread(name=f'cronweb-hook-{i}') for i in range(max(threads, 1))]
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.overflow = overflow
+        self.timeout = timeout
+        self.block_timeout = block_timeout
+        self.spill_path = pathlib.Path(spill_path).absolute() if spill_path else None
+        # 磁盘文件中已经读取到的位置 记录在{spill_path}.pos中
+        self.spill_pos_path = self.spill_path.with_name(f'{self.spill_path.name}.pos') if spill_path else None
+        self._spill_offset = 0
+        self._spill_lock = asyncio.Lock()
+        self._queue: typing.Deque[typing.Tuple[str, typing.Callable[..., typing.Coroutine], tuple]] = \
+            collections.deque()
+        self._hooks: typing.Dict[str, typing.Callable[..., typing.Coroutine]] = {}
+        self._names: typing.Dict[typing.Callable[..., typing.Coroutine], str] = {}
+        self._stats: typing.Dict[str, HookStats] = {}
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._spilled = 0
+        self._dispatchers: typing.List[asyncio.Task] = []
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def hook_name(func: typing.Callable) -> str:
+        """hook的默认名称 同一个工厂函数创建的闭包名称相同."""
+        func_name = getattr(func, '__qualname__', None) or type(func).__qualname__
+        return f'{getattr(func, "__module__", None) or type(func).__module__}.{func_name}'
+
+    def register(self, func: typing.Callable[..., typing.Coroutine], name: typing.Optional[str] = None) -> str:
+        """注册hook函数 返回分配的名称 同一个函数重复注册时返回已分配的名称
+        名称已被其它函数使用时 spill策略下无法区分写入磁盘的hook 抛出ValueError 其它策略在名称后加序号
+        """
+        if func in self._names:
+            return self._names[func]
+        name = name or self.hook_name(func)
+        if name in self._hooks:
+            if self.overflow == 'spill':
+                raise ValueError(f'hook name {name} is already registered, '
+                                 f'hooks must have unique names when hook overflow is spill')
+            name = next(f'{name}#{i}' for i in itertools.count(2) if f'{name}#{i}' not in self._hooks)
+        self._hooks[name] = func
+        self._names[func] = name
+        self._stats.setdefault(name, HookStats())
+        return name
+
+    def start(self):
+        if self.spill_path is not None and self.spill_path.exists():
+            if self.spill_pos_path.exists():
+                self._spill_offset = int(self.spill_pos_path.read_text() or 0)
+            with open(self.spill_path, 'rb') as fp:
+                fp.seek(self._spill_offset)
+                self._spilled = sum(1 for _ in fp)
+            if self._spilled:
+                self._py_logger.info('发现%s个未执行的hook', self._spilled)
+                self._not_empty.set()
+        if not self._dispatchers:
+            self._dispatchers = [asyncio.ensure_future(self._dispatch()) for _ in range(self.concurrency)]
+
+    def run_coroutine(self, coroutine: typing.Coroutine, timeout: float) -> asyncio.Future:
+        """直接在负载最小的线程中执行coroutine 不经过队列."""
+        thread = min(self.threads, key=lambda t: len(t.running_futures))
+        return thread.run_coroutine(coroutine, timeout=timeout)
+
+    def run_on_all_threads(self, func: typing.Callable[[], typing.Coroutine], timeout: float):
+        """在每个线程中执行一次coroutine 阻塞直到完成 用于停止前清理线程中的资源."""
+        for thread in self.threads:
+            if not thread.running:
+                continue
+            future = asyncio.run_coroutine_threadsafe(func(), thread.loop_child)
+            try:
+                future.result(timeout=timeout)
+            except Exception as e:
+                self._py_logger.exception(e)
+
+    async def submit(self, func: typing.Callable[..., typing.Coroutine], args: tuple):
+        name = self.register(func)
+        if len(self._queue) >= self.queue_size:
+            if self.overflow == 'drop_oldest':
+                dropped_name, _, _ = self._queue.popleft()
+                self._stats[dropped_name].dropped += 1
+                self._py_logger.warning('hook队列已满 丢弃最早的hook %s', dropped_name)
+            elif self.overflow == 'spill':
+                await self._spill_calls([(name, args)])
+                return
+            else:
+                loop = asyncio.get_event_loop()
+                deadline = loop.time() + self.block_timeout
+                while len(self._queue) >= self.queue_size:
+                    self._not_full.clear()
+                    try:
+                        await asyncio.wait_for(self._not_full.wait(), timeout=max(deadline - loop.time(), 0))
+                    except asyncio.TimeoutError:
+                        self._stats[name].dropped += 1
+                        self._py_logger.warning('hook队列已满 等待超时 丢弃hook %s', name)
+                        return
+        self._queue.append((name, func, args))
+        self._not_empty.set()
+
+    async def _spill_calls(self, calls: typing.List[typing.Tuple[str, tuple]]):
+        """在线程池中将hook写入磁盘."""
+        loop = asyncio.get_event_loop()
+        async with self._spill_lock:
+            await loop.run_in_executor(None, self._spill, calls)
+        self._spilled += len(calls)
+        self._not_empty.set()
+
+    async def _load_spilled(self):
+        """在线程池中从磁盘读取最多queue_size个hook放回队列."""
+        loop = asyncio.get_event_loop()
+        async with self._spill_lock:
+            if self._queue or not self._spilled:
+                return
+            lines = await loop.run_in_executor(None, self._unspill, self.queue_size)
+        self._spilled = max(self._spilled - len(lines), 0) if self._spill_offset else 0
+        for line in lines:
+            call = json.loads(line)
+            func = self._hooks.get(call['hook'])
+            if func is None:
+                self._py_logger.warning('hook %s 未注册 丢弃', call['hook'])
+                continue
+            self._queue.append((call['hook'], func, tuple(self._decode_arg(arg) for arg in call['args'])))
+        if self._queue:
+            self._not_empty.set()
+
+    def _spill(self, calls: typing.List[typing.Tuple[str, tuple]]):
+        with open(self.spill_path, 'a', encoding='utf8') as fp:
+            fp.writelines(json.dumps({'hook': name, 'args': [self._encode_arg(arg) for arg in args]},
+                                     ensure_ascii=False) + '\n' for name, args in calls)
+
+    def _unspill(self, limit: int) -> typing.List[bytes]:
+        """从读取位置开始读取最多limit行 并记录新的读取位置 全部读取后清空文件."""
+        with open(self.spill_path, 'rb') as fp:
+            fp.seek(self._spill_offset)
+            lines = list(itertools.islice(fp, limit))
+            offset = fp.tell()
+            size = os.fstat(fp.fileno()).st_size
+        if offset >= size:
+            open(self.spill_path, 'wb').close()
+            self._spill_offset = 0
+            if self.spill_pos_path.exists():
+                os.remove(self.spill_pos_path)
+        else:
+            self._spill_offset = offset
+            self.spill_pos_path.write_text(str(offset))
+        return lines
+
+    @staticmethod
+    def _encode_arg(arg: typing.Any) -> typing.Any:
+        if isinstance(arg, enum.Enum):
+            return {'__enum__': type(arg).__name__, 'name': arg.name}
+        if isinstance(arg, worker.JobDoneContext):
+            return {'__context__': arg.to_dict()}
+        return arg
+
+    @staticmethod
+    def _decode_arg(arg: typing.Any) -> typing.Any:
+        if isinstance(arg, dict) and '__enum__' in arg:
+            return getattr(worker, arg['__enum__'])[arg['name']]
+        if isinstance(arg, dict) and '__context__' in arg:
+            return worker.JobDoneContext.from_dict(arg['__context__'])
+        return arg
+
+    async def _dispatch(self):
+        while True:
+            if not self._queue and self._spilled:
+                await self._load_spilled()
+            if not self._queue:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+                continue
+            name, func, args = self._queue.popleft()
+            self._not_full.set()
+            await self._run(name, func, args)
+
+    async def _run(self, name: str, func: typing.Callable[..., typing.Coroutine], args: tuple):
+        stats = self._stats[name]
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            result = await self.run_coroutine(self._mark_done(func(*args)), timeout=self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats.errors += 1
+            self._py_logger.error('hook执行失败 %s', name)
+            self._py_logger.exception(e)
+            result = True
+        if result is None:
+            stats.timeouts += 1
+        stats.record(loop.time() - start)
+
+    @staticmethod
+    async def _mark_done(coroutine: typing.Coroutine) -> bool:
+        # 超时时HookEventLoopThread返回None 以此区分超时
+        await coroutine
+        return True
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        return {
+            'queue': len(self._queue),
+            'spilled': self._spilled,
+            'running': sum(len(thread.running_futures) for thread in self.threads),
+            'hooks': {name: stats.to_dict() for name, stats in self._stats.items()},
+        }
+
+    def stop(self):
+        for task in self._dispatchers:
+            task.cancel()
+        self._dispatchers = []
+        if self.overflow == 'spill' and self._queue:
+            self._py_logger.info('保存%s个未执行的hook', len(self._queue))
+            self._spill([(name, args) for name, _, args in self._queue])
+            self._queue.clear()
+        for thread in self.threads:
+            thread.stop()
+
+
+def _gate_args(args: typing.Union[str, typing.List[str]], shell: bool, fd: int) -> typing.Union[str, typing.List[str]]:
+    """子进程的shell先等待fd的写端关闭再执行命令 nice等设置在exec之后仍然有效
+    dash等shell的重定向不支持大于9的文件描述符 通过/dev/fd打开
+    """
+    gate = f'read -r _ < /dev/fd/{fd}'
+    if shell:
+        return f'{gate}; {args}'
+    return ['/bin/sh', '-c', f'{gate}; exec "$@"', 'sh', *args]
+
+
+def _status_to_exit_code(status: int) -> int:
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+# 任务输出中以此开头的行为指标 ::metric name=value [name=value ...]
+_METRIC_PREFIX = b'::metric '
+_METRIC_NAME = re.compile(r'[A-Za-z_][\w.\-]{0,63}')
+# 每次运行最多记录的指标数量
+_METRIC_MAX_NAMES = 100
+
+
+def _parse_metric_line(line: bytes, metrics: typing.Dict[str, float]):
+    """解析::metric行 将指标写入metrics 无效的指标被忽略."""
+    for item in line[len(_METRIC_PREFIX):].decode('utf8', errors='replace').split():
+        name, sep, value = item.partition('=')
+        if not sep or not _METRIC_NAME.fullmatch(name):
+            continue
+        if name not in metrics and len(metrics) >= _METRIC_MAX_NAMES:
+            continue
+        try:
+            metrics[name] = float(value)
+        except ValueError:
+            continue
+
+
+# param_mode为file时 param文件路径的环境变量名
+PARAM_FILE_ENV = 'CRONWEB_PARAM_FILE'
+# 日志中记录的param最大长度(param_mode不为argv时)
+_PARAM_LOG_MAX = 1024
+
+
+def _create_param_fd(param: str) -> int:
+    """将param写入匿名文件 返回读取位置在开头的文件描述符
+    优先使用memfd(仅Linux) 否则使用创建后立即删除的临时文件 文件只能通过继承的描述符访问
+    """
+    data = param.encode('utf8')
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('cronweb-param', 0)
+    else:
+        fd, path = tempfile.mkstemp(prefix='cronweb-param-')
+        os.unlink(path)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.lseek(fd, 0, os.SEEK_SET)
+    except OSError:
+        os.close(fd)
+        raise
+    return fd
+
+
+class OutputCapture:
+    """限制单次运行写入日志的输出量 按读取到的输出块截断 与换行无关
+    前head_limit字节直接写入日志 之后的输出写入预分配的环形缓冲区 只保留最后tail_limit字节
+    运行结束时写入截断标记和缓冲区中的内容 环形缓冲区写入时不会分配新的内存
+    """
+    __slots__ = ('head_limit', 'tail_limit', 'head_size', 'tail_received', '_ring', '_ring_pos')
+
+    def __init__(self, head_limit: int, tail_limit: int):
+        self.head_limit = head_limit
+        self.tail_limit = tail_limit
+        self.head_size = 0
+        # 超过head_limit之后收到的字节数
+        self.tail_received = 0
+        self._ring = bytearray(tail_limit)
+        self._ring_pos = 0
+
+    @property
+    def dropped(self) -> int:
+        """被丢弃(没有写入日志)的字节数."""
+        return max(self.tail_received - self.tail_limit, 0)
+
+    def feed(self, data: bytes) -> bytes:
+        """写入一段输出 返回需要直接写入日志的部分."""
+        head = b''
+        if self.head_size < self.head_limit:
+            head = data[:self.head_limit - self.head_size]
+            self.head_size += len(head)
+            if len(head) == len(data):
+                return head
+            data = data[len(head):]
+        self.tail_received += len(data)
+        if not self.tail_limit:
+            return head
+        view = memoryview(data)
+        if len(view) >= self.tail_limit:
+            # 只有最后tail_limit字节会被保留
+            self._ring[:] = view[-self.tail_limit:]
+            self._ring_pos = 0
+            return head
+        end = self._ring_pos + len(view)
+        if end <= self.tail_limit:
+            self._ring[self._ring_pos:end] = view
+        else:
+            split = self.tail_limit - self._ring_pos
+            self._ring[self._ring_pos:] = view[:split]
+            self._ring[:end - self.tail_limit] = view[split:]
+        self._ring_pos = end % self.tail_limit
+        return head
+
+    def tail(self) -> bytes:
+        """环形缓冲区中按顺序排列的输出."""
+        if self.tail_received < self.tail_limit:
+            return bytes(self._ring[:self._ring_pos])
+        return bytes(self._ring[self._ring_pos:]) + bytes(self._ring[:self._ring_pos])
+
+
+# 每次从stdout读取的最大字节数
+_READ_CHUNK_SIZE = 64 * 1024
+# 超过这个长度还没有换行的输出按这个长度切分成行 避免没有换行的输出占用无限内存
+_LINE_MAX = 1024 * 1024
+
+
+class _LineSplitter:
+    """将按块读取的输出切分为行 供指标解析和输出匹配使用 返回的行包含结尾的换行符
+    超过max_line字节还没有换行的部分作为一行返回
+    """
+    __slots__ = ('max_line', '_pending')
+
+    def __init__(self, max_line: int = _LINE_MAX):
+        self.max_line = max_line
+        self._pending = b''
+
+    def feed(self, chunk: bytes) -> typing.List[bytes]:
+        data = self._pending + chunk if self._pending else chunk
+        end = data.rfind(b'\n') + 1
+        lines = [line + b'\n' for line in data[:end - 1].split(b'\n')] if end else []
+        self._pending = data[end:]
+        if len(self._pending) >= self.max_line:
+            lines.append(self._pending)
+            self._pending = b''
+        return lines
+
+    def finish(self) -> typing.List[bytes]:
+        """输出结束 返回最后一行没有换行的部分."""
+        pending, self._pending = self._pending, b''
+        return [pending] if pending else []
+
+
+class _MetricScanner:
+    """在按块读取的输出中查找::metric行 不切分行
+    对整块数据查找_METRIC_PREFIX 只处理位于行首的位置 块末尾可能是指标行的不完整行保留到下一块
+    """
+    __slots__ = ('metrics', 'max_line', '_pending', '_line_start')
+
+    def __init__(self, metrics: typing.Dict[str, float], max_line: int = _LINE_MAX):
+        self.metrics = metrics
+        self.max_line = max_line
+        # 上一块末尾以行首开始的不完整行(_METRIC_PREFIX或它的前缀开头)
+        self._pending = b''
+        # 下一块是否从行首开始
+        self._line_start = True
+
+    def feed(self, chunk: bytes):
+        if self._pending:
+            data = self._pending + chunk
+            self._pending = b''
+        elif self._line_start:
+            data = chunk
+        else:
+            # 上一块结尾的行还没有结束 跳过这一行剩下的部分
+            end = chunk.find(b'\n') + 1
+            if not end:
+                return
+            data = chunk[end:]
+        pos = 0
+        while True:
+            hit = data.find(_METRIC_PREFIX, pos)
+            if hit == -1:
+                break
+            if hit and data[hit - 1] != 0x0a:
+                pos = hit + 1
+                continue
+            end = data.find(b'\n', hit) + 1
+            if not end:
+                self._keep(data[hit:])
+                return
+            _parse_metric_line(data[hit:end], self.metrics)
+            pos = end
+        tail = data.rfind(b'\n') + 1
+        if tail == len(data):
+            self._line_start = True
+            return
+        self._line_start = False
+        # 块末尾的不完整行可能是被截断的_METRIC_PREFIX
+        if len(data) - tail < len(_METRIC_PREFIX) and _METRIC_PREFIX.startswith(data[tail:]):
+            self._pending = data[tail:]
+
+    def _keep(self, line: bytes):
+        self._line_start = False
+        if len(line) >= self.max_line:
+            # 与_LineSplitter一致 超长的部分作为一行处理
+            _parse_metric_line(line, self.metrics)
+        else:
+            self._pending = line
+
+    def finish(self):
+        """输出结束 处理最后一行没有换行的指标."""
+        pending, self._pending = self._pending, b''
+        if pending.startswith(_METRIC_PREFIX):
+            _parse_metric_line(pending, self.metrics)
+
+
+_REGEX_GLOBAL_FLAGS = re.compile(r'^\(\?([aiLmsux]+)\)')
+
+
+def _scope_pattern(pattern: str) -> str:
+    """开头的全局flag((?i)等)改为只作用于这个表达式的flag 以便与其它表达式合并."""
+    m = _REGEX_GLOBAL_FLAGS.match(pattern)
+    return f'(?{m.group(1)}:{pattern[m.end():]})' if m else f'(?:{pattern})'
+
+
+# 表示单个字符的转义
+_ESCAPE_CHARS = {'a': b'\a', 'f': b'\f', 'n': b'\n', 'r': b'\r', 't': b'\t', 'v': b'\v'}
+_OCT_DIGITS = '01234567'
+_HEX_DIGITS = '0123456789abcdefABCDEF'
+
+
+def _parse_escape(pattern: str, i: int) -> typing.Tuple[typing.Optional[bytes], int]:
+    """解析pattern[i]处的转义 返回(转义表示的字节 无法确定为单个字面量时为None, 转义结束的位置)
+    表达式按字节串编译 十六进制(x)和八进制转义表示单个字节
+    """
+    escaped = pattern[i + 1:i + 2]
+    if not escaped:
+        return None, i + 1
+    if not escaped.isalnum():
+        return escaped.encode('utf8'), i + 2
+    if escaped in _ESCAPE_CHARS:
+        return _ESCAPE_CHARS[escaped], i + 2
+    if escaped == 'x':
+        digits = pattern[i + 2:i + 4]
+        if len(digits) == 2 and all(c in _HEX_DIGITS for c in digits):
+            return bytes((int(digits, 16),)), i + 4
+        return None, i + 2
+    if escaped == '0' or (escaped in _OCT_DIGITS and pattern[i + 2:i + 3] in tuple(_OCT_DIGITS)
+                          and pattern[i + 3:i + 4] in tuple(_OCT_DIGITS)):
+        # \0开头最多3位 否则需要正好3位八进制数字 其余的数字转义为反向引用
+        end = i + 2
+        while end < i + 4 and pattern[end:end + 1] in tuple(_OCT_DIGITS):
+            end += 1
+        value = int(pattern[i + 1:end], 8)
+        return (bytes((value,)) if value <= 0xff else None), end
+    if escaped == 'N' and pattern[i + 2:i + 3] == '{':
+        end = pattern.find('}', i)
+        return None, (len(pattern) if end == -1 else end + 1)
+    if escaped in 'uU':
+        return None, i + 2 + (4 if escaped == 'u' else 8)
+    if escaped.isdigit():
+        # 反向引用
+        end = i + 2
+        while end < len(pattern) and pattern[end].isdigit():
+            end += 1
+        return None, end
+    # \d \w \b等字符类和断言
+    return None, i + 2
+
+
+def _required_literal(pattern: str) -> typing.Optional[bytes]:
+    """正则表达式匹配时必须出现的最长字面量 用于在执行正则之前快速排除不可能匹配的行
+    只分析最外层的普通字符和表示单个字符的转义 包含|或忽略大小写等无法确定时返回None
+    """
+    if '|' in pattern or re.compile(pattern).flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    # run中每一项为一个字符编码后的字节 以便量词去掉前一个字符
+    best: typing.List[bytes] = []
+    run: typing.List[bytes] = []
+
+    def longest(*runs: typing.List[bytes]) -> typing.List[bytes]:
+        return max(runs, key=lambda items: sum(len(item) for item in items))
+
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        literal = None
+        if c == '\\':
+            literal, i = _parse_escape(pattern, i)
+            if literal is None:
+                best, run = longest(best, run), []
+            elif depth == 0:
+                run.append(literal)
+            continue
+        elif c == '[':
+            # 跳过字符集
+            best, run = longest(best, run), []
+            i += 1
+            if pattern[i:i + 1] == '^':
+                i += 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+            if i >= len(pattern):
+                return None
+        elif c in '*?{':
+            # 前一个字符可以不出现
+            best, run = longest(best, run[:-1]), []
+            if c == '{':
+                i = pattern.find('}', i)
+                if i == -1:
+                    return None
+        elif c == '(':
+            depth += 1
+            best, run = longest(best, run), []
+        elif c == ')':
+            depth -= 1
+            best, run = longest(best, run), []
+        elif c in '.^$+':
+            best, run = longest(best, run), []
+        else:
+            literal = c.encode('utf8')
+        if literal is not None and depth == 0:
+            run.append(literal)
+        i += 1
+    best = longest(best, run)
+    return b''.join(best) if best else None
+
+
+class _MatchStage:
+    """合并后的正则和用于预先过滤的字面量 literals为None时每行都需要执行正则."""
+    __slots__ = ('regex', 'literals', 'fail_group')
+
+    def __init__(self, fail_patterns: typing.Sequence[str], warn_patterns: typing.Sequence[str]):
+        parts = []
+        for patterns in (fail_patterns, warn_patterns):
+            if patterns:
+                parts.append('(' + '|'.join(_scope_pattern(pattern) for pattern in patterns) + ')')
+        self.regex = re.compile('|'.join(parts).encode('utf8'))
+        # 合并后第一组为fail 只有warn时没有fail组
+        self.fail_group = 1 if fail_patterns else None
+        literals = [_required_literal(pattern) for pattern in (*fail_patterns, *warn_patterns)]
+        self.literals = None if None in literals else tuple(set(literals))
+
+
+class OutputMatcher:
+    """将fail和warn两组正则表达式编译为一个正则 每行输出只需执行一次
+    所有表达式都包含必须出现的字面量时 先用字面量过滤(bytes查找) 只对包含字面量的行执行正则
+    """
+    __slots__ = ('combined', 'fail_only')
+
+    def __init__(self, fail_patterns: typing.Sequence[str], warn_patterns: typing.Sequence[str]):
+        self.combined = _MatchStage(fail_patterns, warn_patterns)
+        # 已经匹配到warn后只需要继续查找fail
+        self.fail_only = _MatchStage(fail_patterns, ()) if fail_patterns and warn_patterns else None
+
+    def classifier(self) -> 'OutputClassifier':
+        return OutputClassifier(self)
+
+
+class OutputClassifier:
+    """单次运行的输出分类 state为匹配到的最严重的结果(ERROR或WARN) 没有匹配时为None
+    直接接收按块读取的输出 写入缓冲区 每chunk_size字节处理一次缓冲区中完整的行
+    可以使用字面量过滤时 在整块数据中查找字面量 只对包含字面量的行执行正则 否则逐行执行正则
+    运行结束时需要调用finish处理剩余的缓冲区 匹配到fail之后不再检查后续的输出
+    """
+    __slots__ = ('state', 'line', 'max_line', '_stage', '_fail_only', '_buffer')
+    chunk_size = 256 * 1024
+
+    def __init__(self, matcher: OutputMatcher, max_line: int = _LINE_MAX):
+        self.state: typing.Optional[worker.JobStateEnum] = None
+        # 第一次使state变化的行
+        self.line: typing.Optional[bytes] = None
+        # 与_LineSplitter一致 超过max_line字节还没有换行的部分作为一行
+        self.max_line = max_line
+        self._stage: typing.Optional[_MatchStage] = matcher.combined
+        self._fail_only = matcher.fail_only
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes):
+        if self._stage is None:
+            return
+        self._buffer += chunk
+        if len(self._buffer) >= self.chunk_size:
+            self._scan(False)
+
+    def finish(self):
+        if self._buffer and self._stage is not None:
+            self._scan(True)
+        self._buffer.clear()
+
+    def _scan(self, final: bool):
+        """处理缓冲区中完整的行 最后一行没有换行的部分留在缓冲区中
+        记录每个字面量下一次出现的位置 只有位置已经被跳过的字面量才重新查找 每个字面量在缓冲区中只扫描一遍
+        """
+        buffer = self._buffer
+        end = len(buffer) if final else buffer.rfind(b'\n') + 1
+        if not end:
+            if len(buffer) < self.max_line:
+                return
+            end = len(buffer)
+        pos = 0
+        stage = self._stage
+        hits: typing.Dict[bytes, int] = {}
+        while stage is not None and pos < end:
+            if stage.literals is None:
+                line_start = pos
+            else:
+                hit = -1
+                for literal in stage.literals:
+                    found = hits.get(literal)
+                    if found is None or (found != -1 and found < pos):
+                        found = hits[literal] = buffer.find(literal, pos, end)
+                    if found != -1 and (hit == -1 or found < hit):
+                        hit = found
+                if hit == -1:
+                    break
+                line_start = buffer.rfind(b'\n', 0, hit) + 1
+            line_end = buffer.find(b'\n', line_start, end)
+            line_end = end if line_end == -1 else line_end + 1
+            self._match_line(bytes(buffer[line_start:line_end]))
+            stage = self._stage
+            pos = line_end
+        if self._stage is None:
+            buffer.clear()
+        else:
+            del buffer[:end]
+
+    def _match_line(self, line: bytes):
+        stage = self._stage
+        m = stage.regex.search(line)
+        if m is None:
+            return
+        if stage.fail_group is None or m.start(stage.fail_group) == -1:
+            self.state = worker.JobStateEnum.WARN
+            self.line = line
+            self._stage = stage = self._fail_only
+            # 同一行中可能在warn之后出现fail
+            if stage is None or stage.regex.search(line) is None:
+                return
+        self.state = worker.JobStateEnum.ERROR
+        self.line = line
+        self._stage = None
+
+
+class ReapedProcess:
+    """由worker自身通过os.wait4回收的子进程 用于获取每个子进程的rusage
+    asyncio(以及uvloop)的child watcher回收子进程时会丢弃rusage 所以这里直接使用Popen启动
+    子进程退出由pidfd通知 不支持pidfd时定时轮询
+    子进程运行在自己的进程组中 信号发送给整个进程组 避免shell启动的孙进程在停止后遗留
+    接口与asyncio.subprocess.Process保持一致 仅用于posix
+    """
+    poll_interval = 0.5
+
+    def __init__(self, popen: subprocess.Popen, stdout: asyncio.StreamReader):
+        self._popen = popen
+        self.pid: int = popen.pid
+        self.stdout = stdout
+        self.returncode: typing.Optional[int] = None
+        self.usage: typing.Optional[worker.ShotUsage] = None
+        self._loop = asyncio.get_event_loop()
+        self._waiter: asyncio.Future = self._loop.create_future()
+        self._pidfd: typing.Optional[int] = None
+        self._poll_task: typing.Optional[asyncio.Task] = None
+
+    @classmethod
+    async def create(cls, args: typing.Union[str, typing.Sequence[str]], shell: bool,
+                     **kwargs) -> 'ReapedProcess':
+        loop = asyncio.get_event_loop()
+        popen = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 start_new_session=True, **kwargs)
+        reader = asyncio.StreamReader(loop=loop)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), popen.stdout)
+        proc = cls(popen, reader)
+        proc._watch()
+        return proc
+
+    def _watch(self):
+        try:
+            self._pidfd = os.pidfd_open(self.pid)
+        except (AttributeError, OSError):
+            self._poll_task = self._loop.create_task(self._poll())
+        else:
+            self._loop.add_reader(self._pidfd, self._try_reap)
+
+    async def _poll(self):
+        while not self._try_reap():
+            await asyncio.sleep(self.poll_interval)
+
+    def _try_reap(self) -> bool:
+        """非阻塞地回收子进程 子进程未退出时返回False."""
+        if self.returncode is not None:
+            return True
+        try:
+            pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            # 已经被其它地方回收 无法得知退出码和资源占用
+            pid, status, rusage = self.pid, 255 << 8, None
+        if pid == 0:
+            return False
+        if rusage is not None:
+            self.usage = worker.ShotUsage(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+                                          rusage.ru_inblock, rusage.ru_oublock)
+        self.returncode = _status_to_exit_code(status)
+        # 避免Popen在析构时再次waitpid(此时pid可能已被复用)
+        self._popen.returncode = self.returncode
+        if self._pidfd is not None:
+            self._loop.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        if not self._waiter.done():
+            self._waiter.set_result(self.returncode)
+        return True
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._waiter)
+
+    def send_signal(self, sig: int):
+        # 不使用Popen.send_signal 它会先poll 导致子进程被提前回收而丢失rusage
+        # 子进程回收之前pid(同时也是进程组id)不会被复用
+        if self.returncode is None:
+            try:
+                os.killpg(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+_boot_id: typing.Optional[str] = None
+
+
+def _process_start_id(pid: int) -> typing.Optional[str]:
+    """进程的启动标识(boot_id:启动时间) 重启后用于确认pid没有被其它进程复用 仅Linux 无法获取时返回None."""
+    global _boot_id
+    try:
+        if _boot_id is None:
+            with open('/proc/sys/kernel/random/boot_id', 'r') as fp:
+                _boot_id = fp.read().strip()
+        with open(f'/proc/{pid}/stat', 'rb') as fp:
+            stat = fp.read()
+    except OSError:
+        return None
+    # 进程名中可能包含空格和括号 从最后一个')'之后开始分割 starttime为第22个字段
+    fields = stat[stat.rindex(b')') + 2:].split()
+    return f'{_boot_id}:{int(fields[19])}'
+
+
+class AdoptedProcess:
+    """CronWeb重启前启动 重启后仍在运行的子进程
+    它已经不是当前进程的子进程 无法获取退出码和资源占用 原来的stdout管道也已经关闭
+    退出由pidfd通知 不支持pidfd时定时轮询 信号发送给整个进程组 接口与ReapedProcess保持一致
+    发送信号前重新确认启动标识 组长进程已经退出或pid已被复用时不发送
+    """
+    poll_interval = 1
+
+    def __init__(self, pid: int, pgid: int, proc_start: typing.Optional[str] = None):
+        self.pid = pid
+        self.pgid = pgid
+        self.proc_start = proc_start
+        self.returncode: typing.Optional[int] = None
+        self.usage: typing.Optional[worker.ShotUsage] = None
+        self._loop = asyncio.get_event_loop()
+        self._waiter: asyncio.Future = self._loop.create_future()
+        self._pidfd: typing.Optional[int] = None
+        self._poll_task: typing.Optional[asyncio.Task] = None
+        try:
+            # pidfd持有的是进程本身 之后即使pid被复用也不会误判
+            self._pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            self._poll_task = self._loop.create_task(self._poll())
+        else:
+            self._loop.add_reader(self._pidfd, self._set_exited)
+
+    def _alive(self) -> bool:
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    async def _poll(self):
+        while self._alive():
+            await asyncio.sleep(self.poll_interval)
+        self._set_exited()
+
+    def _set_exited(self):
+        if self._pidfd is not None:
+            self._loop.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+        if self.returncode is None:
+            # 退出码无法获取
+            self.returncode = -1
+            self._waiter.set_result(self.returncode)
+
+    def close(self):
+        """放弃接管 不发送信号."""
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+        if self._pidfd is not None:
+            self._loop.remove_reader(self._pidfd)
+            os.close(self._pidfd)
+            self._pidfd = None
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._waiter)
+
+    def send_signal(self, sig: int):
+        if self.returncode is not None:
+            return
+        if self.proc_start is not None and _process_start_id(self.pid) != self.proc_start:
+            # 接管的进程已经退出 进程组号可能已经属于其它进程
+            self._set_exited()
+            raise ProcessLookupError(f'adopted process {self.pid} is gone')
+        os.killpg(self.pgid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class OutputPipe:
+    """进程内任务的输出管道 read与StreamReader.read相同
+    缓冲的输出超过limit字节时写入方等待读取 读取慢于写入时不会将全部输出缓存在内存中
+    """
+
+    def __init__(self, limit: int = 1024 * 1024):
+        self.limit = limit
+        self._buffer = bytearray()
+        self._eof = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    async def write(self, data: bytes):
+        await self._writable.wait()
+        self._buffer += data
+        self._readable.set()
+        if len(self._buffer) >= self.limit:
+            self._writable.clear()
+
+    def feed_eof(self):
+        self._eof = True
+        self._readable.set()
+        self._writable.set()
+
+    async def read(self, n: int = -1) -> bytes:
+        while not self._buffer and not self._eof:
+            await self._readable.wait()
+        if n < 0 or n >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:n])
+            del self._buffer[:n]
+        if not self._buffer and not self._eof:
+            self._readable.clear()
+        if len(self._buffer) < self.limit:
+            self._writable.set()
+        return data
+
+
+class HttpProcess:
+    """exec_mode为http的任务 在CronWeb进程内通过共享的连接池发送请求 不启动子进程
+    接口与ReapedProcess保持一致 响应状态行和响应体作为输出 2xx时退出码为0 否则为状态码
+    请求失败时退出码为-1 被停止时为-signal
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, method: str, url: str,
+                 headers: typing.Optional[typing.Dict[str, str]], body: typing.Optional[bytes]):
+        self.pid: typing.Optional[int] = None
+        self.stdout = OutputPipe()
+        self.returncode: typing.Optional[int] = None
+        self.usage: typing.Optional[worker.ShotUsage] = None
+        self._task = asyncio.ensure_future(self._request(session, method, url, headers, body))
+        self._task.add_done_callback(self._done)
+
+    async def _request(self, session: aiohttp.ClientSession, method: str, url: str,
+                       headers: typing.Optional[typing.Dict[str, str]], body: typing.Optional[bytes]) -> int:
+        try:
+            async with session.request(method, url, headers=headers, data=body) as resp:
+                await self.stdout.write(f'HTTP {resp.status} {resp.reason}\n\n'.encode('utf8'))
+                async for chunk in resp.content.iter_any():
+                    await self.stdout.write(chunk)
+                return 0 if 200 <= resp.status < 300 else resp.status
+        except Exception as e:
+            # 除了连接错误 编码请求体等也可能抛出其它异常 原因都写入输出
+            await self.stdout.write(f'\nRequest Failed: {e!r}\n'.encode('utf8'))
+            return -1
+
+    def _done(self, task: asyncio.Task):
+        if self.returncode is None:
+            self.returncode = -1 if task.cancelled() or task.exception() else task.result()
+        self.stdout.feed_eof()
+
+    async def wait(self) -> int:
+        try:
+            await asyncio.shield(self._task)
+        except (asyncio.CancelledError, Exception):
+            if not self._task.done():
+                raise
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if not self._task.done():
+            self.returncode = -int(sig)
+            self._task.cancel()
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+
 class AioSubprocessWorker(worker.WorkerBase):
     def __init__(self, controller: typing.Optional[cronweb.CronWeb] = None,
                  work_dir: typing.Optional[typing.Union[str, pathlib.Path]] = None,
                  times_retry: int = 2, wait_retry_base: float = 30,
                  webhook_url: str = '',
-                 webhook_secret: str = ''):
+                 webhook_secret: str = '',
+                 reserved_cpus: typing.Optional[typing.List[int]] = None,
+                 webhook_limit: int = 20,
+                 webhook_limit_per_host: int = 8,
+                 webhook_keepalive: float = 60,
+                 webhook_batch_size: int = 1,
+                 webhook_retry_base: float = 5,
+                 webhook_retry_max: float = 3600,
+                 webhook_max_attempts: int = 0,
+                 webhook_poll_interval: float = 5,
+                 hook_threads: int = 1,
+                 hook_queue_size: int = 1000,
+                 hook_concurrency: int = 16,
+                 hook_overflow: str = 'drop_oldest',
+                 hook_timeout: float = 30,
+                 hook_spill_path: typing.Optional[typing.Union[str, pathlib.Path]] = None,
+                 output_head_kb: typing.Optional[int] = None,
+                 output_tail_kb: typing.Optional[int] = None,
+                 kill_timeout: float = 5,
+                 http_limit: int = 100,
+                 http_limit_per_host: int = 10,
+                 http_keepalive: float = 60,
+                 fail_patterns: typing.Optional[typing.List[str]] = None,
+                 warn_patterns: typing.Optional[typing.List[str]] = None,
+                 adaptive_window: int = 200,
+                 adaptive_min_samples: int = 10,
+                 adaptive_min_timeout: float = 60,
+                 hook_output_tail_lines: int = 20,
+                 orphan_policy: str = 'adopt'):
         super().__init__(controller)
-        self._running_jobs: typing.Dict[str, typing.Tuple[str, asyncio.subprocess.Process, worker.JobState]] = {}
+        self._running_jobs: typing.Dict[
+            str, typing.Tuple[str, typing.Union[ReapedProcess, HttpProcess, asyncio.subprocess.Process],
+                              worker.JobState]] = {}
         self._env: typing.Optional[typing.Dict[str, str]] = None
         self._scripts_dir: typing.Optional[typing.Union[str, pathlib.Path]] = None
         self._work_dir = pathlib.Path(work_dir).absolute() if work_dir else None
@@ -89,11 +1190,61 @@ class AioSubprocessWorker(worker.WorkerBase):
         self.webhook_url = webhook_url
         self.webhook_secret = webhook_secret if isinstance(webhook_secret, bytes) else webhook_secret.encode('utf8')
         self.webhook_timeout = aiohttp.ClientTimeout(total=30)
-        self._hook_thread = HookEventLoopThread()
-        self._hook_thread.start()
+        self.webhook_limit = webhook_limit
+        self.webhook_limit_per_host = webhook_limit_per_host
+        self.webhook_keepalive = webhook_keepalive
+        # 每个hook事件循环线程中各自创建和使用 复用连接
+        self._webhook_local = threading.local()
+        # 大于1时每次请求投递多个事件 {"events": [...]}
+        self.webhook_batch_size = webhook_batch_size
+        # 投递失败后按指数退避重试 max_attempts为0时不限制重试次数
+        self.webhook_retry_base = webhook_retry_base
+        self.webhook_retry_max = webhook_retry_max
+        self.webhook_max_attempts = webhook_max_attempts
+        self.webhook_poll_interval = webhook_poll_interval
+        self._webhook_task: typing.Optional[asyncio.Task] = None
+        self._webhook_wakeup = asyncio.Event()
+        self._webhook_stats = {'delivered': 0, 'failed': 0, 'dropped': 0, 'last_lag': 0.0}
+        if hook_overflow == 'spill' and hook_spill_path is None and self._core is not None:
+            hook_spill_path = self._core.dir_project / 'hooks_spill.jsonl'
+        self._hook_executor = HookExecutor(threads=hook_threads, queue_size=hook_queue_size,
+                                           concurrency=hook_concurrency, overflow=hook_overflow,
+                                           timeout=hook_timeout, spill_path=hook_spill_path)
 
+        # CronWeb重启后仍在运行的子进程的处理方式 adopt: 等待其结束后记录状态  kill: 停止整个进程组
+        if orphan_policy not in ('adopt', 'kill'):
+            raise ValueError(f'orphan_policy must be adopt or kill, not {orphan_policy}')
+        self.orphan_policy = orphan_policy
+        # 传给接收JobDoneContext的hook的输出行数
+        self.hook_output_tail_lines = hook_output_tail_lines
         self._killed_shot_id: typing.Set[str] = set()
-        self._waiting_for_retry: typing.Set[str] = set()
+        # exec模式下解析后的argv缓存 {uuid: (command, argv)}
+        self._argv_cache: typing.Dict[str, typing.Tuple[str, typing.List[str]]] = {}
+        # 所有job共用的输出分类表达式 与job options中的表达式合并
+        self.fail_patterns: typing.List[str] = list(fail_patterns or ())
+        self.warn_patterns: typing.List[str] = list(warn_patterns or ())
+        # 合并编译后的输出分类器 {uuid: ((fail_patterns, warn_patterns), matcher)}
+        if self.fail_patterns or self.warn_patterns:
+            # 配置有误时在启动时报错
+            OutputMatcher(self.fail_patterns, self.warn_patterns)
+        self._matcher_cache: typing.Dict[str, typing.Tuple[tuple, typing.Optional[OutputMatcher]]] = {}
+        # 设置了adaptive_timeout的job的运行时长估计 第一次运行时从storage载入最近的运行时长
+        self.adaptive_window = adaptive_window
+        self.adaptive_min_samples = adaptive_min_samples
+        self.adaptive_min_timeout = adaptive_min_timeout
+        self._durations: typing.Dict[str, DurationEstimator] = {}
+        # 停止任务时等待SIGTERM生效的时间 超时后发送SIGKILL
+        self.kill_timeout = kill_timeout
+        # 默认的输出上限(KB) 都为None时不限制 job options中的设置优先
+        self.output_head_kb = output_head_kb
+        self.output_tail_kb = output_tail_kb
+        # http模式任务共用的连接池 在主事件循环中创建
+        self.http_limit = http_limit
+        self.http_limit_per_host = http_limit_per_host
+        self.http_keepalive = http_keepalive
+        self._http_session: typing.Optional[aiohttp.ClientSession] = None
+        # 保留给CronWeb自身的CPU 未指定cpu_affinity的任务不会运行在这些CPU上
+        self.reserved_cpus: typing.Set[int] = set(reserved_cpus or ())
         if self._work_dir is not None and not self._work_dir.exists():
             self._work_dir.mkdir(parents=True)
 
@@ -102,6 +1253,12 @@ class AioSubprocessWorker(worker.WorkerBase):
 
     def load_env(self):
         self._py_logger.info('trigger载入子进程环境变量')
+        if self._core is None:
+            # 没有controller时(例如在远程agent中)使用当前环境变量
+            self._env = dict(os.environ)
+            if self._work_dir is None:
+                self._work_dir = pathlib.Path.cwd()
+            return
         file_env = self._core.dir_project / '.env_subprocess.json'
         if file_env.exists():
             self._py_logger.info('.env_subprocess.json文件存在，读取其中内容作为环境变量')
@@ -116,41 +1273,318 @@ class AioSubprocessWorker(worker.WorkerBase):
             if not self._work_dir.exists():
                 self._work_dir.mkdir(parents=True)
 
+    def _get_argv(self, uuid: str, command: str) -> typing.List[str]:
+        """exec模式下将command解析为argv
+        同一个job只在command变化时重新解析
+        """
+        cached = self._argv_cache.get(uuid)
+        if cached is None or cached[0] != command:
+            argv = shlex.split(command, posix=os.name != 'nt')
+            if not argv:
+                raise ValueError('empty command')
+            cached = (command, argv)
+            self._argv_cache[uuid] = cached
+        return cached[1]
+
+    def _get_output_matcher(self, uuid: str, job_options: worker.JobOptions) -> typing.Optional[OutputMatcher]:
+        """合并全局和job的输出分类表达式 同一个job只在表达式变化时重新编译
+        没有任何表达式时返回None
+        """
+        key = (tuple(self.fail_patterns + (job_options.fail_patterns or [])),
+               tuple(self.warn_patterns + (job_options.warn_patterns or [])))
+        cached = self._matcher_cache.get(uuid)
+        if cached is None or cached[0] != key:
+            matcher = None
+            if key[0] or key[1]:
+                try:
+                    matcher = OutputMatcher(*key)
+                except re.error as e:
+                    self._py_logger.error('输出分类表达式合并失败 忽略 uuid:%s %s', uuid, e)
+            cached = (key, matcher)
+            self._matcher_cache[uuid] = cached
+        return cached[1]
+
+    async def _get_adaptive_timeout(self, uuid: str, job_options: worker.JobOptions) -> typing.Optional[float]:
+        """根据最近成功运行的时长计算自适应超时 未开启或样本不足时返回None."""
+        if job_options.adaptive_timeout is None:
+            return None
+        estimator = self._durations.get(uuid)
+        if estimator is None:
+            loaded = DurationEstimator(self.adaptive_window)
+            for seconds in await self._core.job_logs_durations(uuid, self.adaptive_window):
+                loaded.add(seconds)
+            estimator = self._durations.setdefault(uuid, loaded)
+        return self._adaptive_limit(estimator, job_options)
+
+    def _adaptive_limit(self, estimator: DurationEstimator, job_options: worker.JobOptions) -> typing.Optional[float]:
+        if job_options.adaptive_timeout is None or estimator.count < self.adaptive_min_samples:
+            return None
+        return max(job_options.adaptive_timeout * max(estimator.quantile(0.99), estimator.ewma),
+                   self.adaptive_min_timeout)
+
+    def get_duration_stats(self, uuid: str, job_options: typing.Optional[worker.JobOptions] = None
+                           ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        estimator = self._durations.get(uuid)
+        if estimator is None:
+            return None
+        stats = estimator.to_dict()
+        stats['adaptive_timeout'] = self._adaptive_limit(estimator, job_options or worker.JobOptions())
+        return stats
+
+    def _get_exec_settings(self, job_options: worker.JobOptions) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        """根据job的执行参数生成在exec任务命令之前的设置(见worker.exec_wrapper.apply)
+        没有需要设置的参数时返回None(直接启动命令 Popen可以使用更快的vfork)
+        """
+        cpus: typing.Optional[typing.Set[int]] = None
+        if hasattr(os, 'sched_setaffinity'):
+            if job_options.cpu_affinity is not None:
+                cpus = set(job_options.cpu_affinity)
+                unavailable = cpus - os.sched_getaffinity(0)
+                if unavailable:
+                    raise ValueError(f'cpu_affinity contains unavailable cpus {sorted(unavailable)}')
+            elif self.reserved_cpus:
+                cpus = os.sched_getaffinity(0) - self.reserved_cpus or None
+        elif job_options.cpu_affinity is not None:
+            self._py_logger.warning('当前系统不支持设置CPU亲和性 忽略cpu_affinity')
+        if not job_options.need_preexec() and cpus is None:
+            return None
+
+        settings: typing.Dict[str, typing.Any] = {'nice': job_options.nice}
+        if cpus:
+            settings['cpus'] = sorted(cpus)
+        if job_options.ionice_class is not None:
+            if not worker.exec_wrapper.ioprio_supported():
+                self._py_logger.warning('当前系统不支持设置io优先级 忽略ionice_class')
+            else:
+                settings['ionice'] = (job_options.ionice_class, job_options.ionice_level)
+        rlimits = []
+        if resource is not None:
+            for name, value in (('RLIMIT_AS', job_options.rlimit_as),
+                                ('RLIMIT_CPU', job_options.rlimit_cpu),
+                                ('RLIMIT_NOFILE', job_options.rlimit_nofile)):
+                if value is None or not hasattr(resource, name):
+                    continue
+                # 只设置软限制 硬限制保持不变(非特权进程无法再次提高硬限制)
+                hard = resource.getrlimit(getattr(resource, name))[1]
+                if hard != resource.RLIM_INFINITY and value > hard:
+                    self._py_logger.warning('%s超过硬限制%s 使用硬限制', name, hard)
+                    value = hard
+                rlimits.append((name, value, hard))
+        settings['rlimits'] = rlimits
+        return settings
+
+    async def create_process(self, command: str, param: str, uuid: str,
+                             job_options: worker.JobOptions
+                             ) -> typing.Union[ReapedProcess, HttpProcess, asyncio.subprocess.Process]:
+        """按job的执行参数启动子进程 stdout和stderr合并 远程agent也使用这个方法启动子进程."""
+        if job_options.exec_mode == 'http':
+            return HttpProcess(self._get_http_session(), job_options.http_method.upper(), command,
+                               job_options.http_headers, param.encode('utf8') if param else None)
+        # param_mode不为argv时param不出现在命令行中
+        param_argv = param if job_options.param_mode == 'argv' else ''
+        if os.name == 'posix':
+            if job_options.exec_mode == 'exec':
+                args = [*self._get_argv(uuid, command), *(('--param', param_argv) if param_argv else ())]
+            else:
+                args = f'{command} --param {param_argv}' if param_argv else command
+            shell = job_options.exec_mode != 'exec'
+            settings = self._get_exec_settings(job_options)
+            gate = None
+            if settings is not None and worker.exec_wrapper.pid_supported(settings):
+                # 子进程等待gate的写端关闭后再exec任务命令 在此之前由worker从外部设置
+                gate = os.pipe()
+                args = _gate_args(args, shell, gate[0])
+            elif settings is not None:
+                # 不支持从外部设置时由exec_wrapper设置后exec命令 不在fork之后的子进程中执行Python代码
+                args = worker.exec_wrapper.wrap_args(settings, ['/bin/sh', '-c', args] if shell else args)
+                shell = False
+            kwargs = {'pass_fds': (gate[0],) if gate else ()}
+            param_fd = None
+            if job_options.param_mode != 'argv':
+                param_fd = _create_param_fd(param)
+                if job_options.param_mode == 'stdin':
+                    kwargs['stdin'] = param_fd
+                else:
+                    kwargs['pass_fds'] += (param_fd,)
+                    kwargs['env'] = {**self._env, PARAM_FILE_ENV: f'/dev/fd/{param_fd}'}
+            try:
+                proc = await ReapedProcess.create(args, shell=shell,
+                                                  env=kwargs.pop('env', self._env), cwd=str(self._work_dir),
+                                                  **kwargs)
+                if gate is not None:
+                    try:
+                        worker.exec_wrapper.apply(settings, proc.pid)
+                    except Exception:
+                        # 任务命令还没有执行
+                        proc.kill()
+                        raise
+                return proc
+            finally:
+                # 子进程已经继承了文件描述符
+                if param_fd is not None:
+                    os.close(param_fd)
+                if gate is not None:
+                    os.close(gate[0])
+                    os.close(gate[1])
+        # 非posix系统无法获取子进程的资源占用 也不支持设置执行参数
+        if job_options.need_preexec():
+            self._py_logger.warning('当前系统不支持设置子进程执行参数 忽略 uuid:%s', uuid)
+        if job_options.param_mode == 'file':
+            raise ValueError('param_mode file is only supported on posix')
+        stdin = None
+        if job_options.param_mode == 'stdin':
+            stdin = tempfile.TemporaryFile()
+            stdin.write(param.encode('utf8'))
+            stdin.seek(0)
+        try:
+            if job_options.exec_mode == 'exec':
+                argv = self._get_argv(uuid, command)
+                # 不经过shell param作为独立的argv元素传入 无需转义
+                return await asyncio.create_subprocess_exec(
+                    *argv, *(('--param', param_argv) if param_argv else ()),
+                    stdin=stdin,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    env=self._env,
+                    cwd=str(self._work_dir)
+                )
+            return await asyncio.create_subprocess_shell(
+                # 只有当param存在时传入param参数(用于传递特殊参数 约定后可以是json)
+                f'{command} --param {param_argv}' if param_argv else command,
+                stdin=stdin,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=self._env,
+                cwd=str(self._work_dir)
+            )
+        finally:
+            if stdin is not None:
+                stdin.close()
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """http模式任务共用的长连接session 超时由job的timeout控制."""
+        if self._http_session is None or self._http_session.closed:
+            self._py_logger.debug('创建http任务session')
+            connector = aiohttp.TCPConnector(limit=self.http_limit,
+                                             limit_per_host=self.http_limit_per_host,
+                                             keepalive_timeout=self.http_keepalive)
+            self._http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None))
+        return self._http_session
+
+    def _get_output_capture(self, job_options: worker.JobOptions) -> typing.Optional[OutputCapture]:
+        if job_options.output_head_kb is not None or job_options.output_tail_kb is not None:
+            head_kb, tail_kb = job_options.output_head_kb, job_options.output_tail_kb
+        elif self.output_head_kb is not None or self.output_tail_kb is not None:
+            head_kb, tail_kb = self.output_head_kb, self.output_tail_kb
+        else:
+            return None
+        return OutputCapture((head_kb or 0) * 1024, (tail_kb or 0) * 1024)
+
+    @staticmethod
+    async def _flush_output_capture(queue: asyncio.Queue, capture: typing.Optional[OutputCapture],
+                                    encoding: str, decoder: typing.Optional[codecs.IncrementalDecoder] = None):
+        """写入decoder中剩余的不完整字符 截断标记和被保留的最后一部分输出."""
+        if decoder is not None:
+            rest = decoder.decode(b'', final=True)
+            if rest:
+                await queue.put(rest)
+        if capture is None or not capture.tail_received:
+            return
+        if capture.dropped:
+            await queue.put(f'\n#### OUTPUT TRUNCATED {capture.dropped} bytes ####\n')
+        tail = capture.tail()
+        if tail:
+            await queue.put(tail.decode(encoding, errors='replace'))
+
     async def _shoot(self, command: str, param: str,
-                     uuid: str, timeout: float, job_type: worker.JobTypeEnum) -> typing.Tuple[str, worker.JobStateEnum]:
+                     uuid: str, timeout: float, name: str, job_type: worker.JobTypeEnum,
+                     job_options: worker.JobOptions,
+                     run_id: typing.Optional[str] = None,
+                     shard: typing.Optional[str] = None) -> worker.JobDoneContext:
         if self._env is None:
             self.load_env()
         shot_id = uuid4().hex
         self._py_logger.debug('执行启动 uuid:%s command:%s param:%s', uuid, command, param)
 
-        proc = await asyncio.create_subprocess_shell(
-            # 只有当param存在时传入param参数(用于传递特殊参数 约定后可以是json)
-            f'{command} --param {param}' if param else command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-            env=self._env,
-            cwd=str(self._work_dir)
-        )
+        try:
+            proc = await self.create_process(command, param, uuid, job_options)
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            # exec模式下命令不存在 执行参数设置失败等错误不会由shell输出 直接记录到日志中
+            self._py_logger.error('子进程启动失败 uuid:%s', uuid)
+            self._py_logger.exception(e)
+            proc = None
+            spawn_error = e
         now = datetime.datetime.now()
-        queue, log_path = self._core.get_log_queue(uuid, shot_id, timeout)
+        queue, log_path = self._core.get_log_queue(uuid, shot_id, timeout, job_options.log_compress)
         state_proc = worker.JobStateEnum.RUNNING
-        job_state = worker.JobState(uuid, state_proc, shot_id, str(now))
+        job_state = worker.JobState(uuid, state_proc, shot_id, str(now), run_id=run_id, shard=shard)
+        if isinstance(proc, ReapedProcess):
+            # 子进程是自己进程组的组长 记录下来以便CronWeb重启后找回
+            job_state = job_state._replace(pid=proc.pid, pgid=proc.pid, proc_start=_process_start_id(proc.pid))
+        if proc is not None:
+            # 在storage中记录为RUNNING之前加入 检查任务一致性时不会把这次运行当作遗留的子进程
+            self._running_jobs[shot_id] = (uuid, proc, job_state)
         await self._core.set_job_running(log_path, job_state)
-        self._running_jobs[shot_id] = (uuid, proc, job_state)
+        if job_options.param_mode != 'argv' and len(param) > _PARAM_LOG_MAX:
+            # 通过stdin或文件传入的param可能很大 日志中只记录开头部分
+            param = f'{param[:_PARAM_LOG_MAX]}... ({len(param)} chars)'
         await queue.put(f'shot_id: {shot_id}\nuuid: {uuid}\n'
                         f'command: {command}\nparam: {param}\n\n#### OUTPUT ####\n')
+        if proc is None:
+            await queue.put(f'\n#### OUTPUT END ####\n\nStart Failed: {spawn_error!r}\nJob FAILED')
+            await queue.put(logger.LogStop)
+            state_proc = worker.JobStateEnum.ERROR
+            end = datetime.datetime.now()
+            await self._set_job_done(job_state._replace(state=state_proc, date_end=str(end)), name, job_type)
+            return worker.JobDoneContext(uuid, shot_id, name, state_proc, job_type, None, str(now), str(end),
+                                         (end - now).total_seconds(), output_tail=f'Start Failed: {spawn_error!r}',
+                                         log_path=str(log_path), run_id=run_id, shard=shard)
         default_encoding = locale.getpreferredencoding()
+        # 输出按块读取 截断在切分行之前进行 写入日志的内容保持原样
+        decoder = codecs.getincrementaldecoder(default_encoding)(errors='replace')
+        capture = self._get_output_capture(job_options)
+        # 只有注册了接收上下文的hook时才保留最后几行输出
+        tail_lines = collections.deque(maxlen=self.hook_output_tail_lines) if self._context_hooks else None
+        matcher = self._get_output_matcher(uuid, job_options)
+        classifier = matcher.classifier() if matcher is not None else None
+        # 指标和输出匹配在整块数据中查找 只有需要保留最后几行时才切分行
+        splitter = _LineSplitter() if tail_lines is not None else None
+        metrics: typing.Dict[str, float] = {}
+        metric_scanner = _MetricScanner(metrics)
+        loop = asyncio.get_event_loop()
+        adaptive_limit = await self._get_adaptive_timeout(uuid, job_options)
+        # 自适应超时的截止时间 与timeout(等待输出的超时)分别计算
+        adaptive_deadline = loop.time() + adaptive_limit if adaptive_limit is not None else None
+        adaptive_flagged = False
         while True:
             try:
-                line = await asyncio.wait_for(proc.stdout.readline(), timeout)
-                if not line:
+                wait = timeout
+                if adaptive_deadline is not None:
+                    wait = min(timeout, max(adaptive_deadline - loop.time(), 0))
+                chunk = await asyncio.wait_for(proc.stdout.read(_READ_CHUNK_SIZE), wait)
+                if not chunk:
                     # test?进程运行结束时自动关闭管道并发送EOF？如果不是wait会导致可能的死锁
+                    metric_scanner.finish()
+                    if splitter is not None:
+                        tail_lines.extend(splitter.finish())
                     exit_code = await proc.wait()
+                    await self._flush_output_capture(queue, capture, default_encoding, decoder)
                     await queue.put(f'\n#### OUTPUT END ####\n\nExit Code: {exit_code}')
-                    if exit_code == 0:
+                    matched = None
+                    if classifier is not None:
+                        classifier.finish()
+                        matched = classifier.state
+                    if matched is not None:
+                        await queue.put(f'\nPattern Matched: '
+                                        f'{classifier.line.decode(default_encoding, errors="replace").rstrip()}')
+                    if exit_code == 0 and matched is None and not adaptive_flagged:
                         state_proc = worker.JobStateEnum.DONE
                         self._py_logger.debug('任务完成 shot_id:%s', shot_id)
                         await queue.put('\nJob DONE')
+                    elif exit_code == 0 and (matched == worker.JobStateEnum.WARN or adaptive_flagged):
+                        state_proc = worker.JobStateEnum.WARN
+                        self._py_logger.debug('任务完成 输出匹配warn或运行时间过长 shot_id:%s', shot_id)
+                        await queue.put('\nJob WARN')
                     elif shot_id in self._killed_shot_id:
                         self._killed_shot_id.remove(shot_id)
                         state_proc = worker.JobStateEnum.KILLED
@@ -163,61 +1597,197 @@ class AioSubprocessWorker(worker.WorkerBase):
                     # 停止日志记录
                     await queue.put(logger.LogStop)
                     break
-                await queue.put(f'{line.decode(default_encoding).rstrip()}\n')
+                metric_scanner.feed(chunk)
+                if classifier is not None:
+                    classifier.feed(chunk)
+                if splitter is not None:
+                    tail_lines.extend(splitter.feed(chunk))
+                if capture is not None:
+                    chunk = capture.feed(chunk)
+                content = decoder.decode(chunk)
+                if content:
+                    await queue.put(content)
             except asyncio.TimeoutError:
-                self._py_logger.error('等待stdout %ss超时 shot_id:%s', timeout, shot_id)
-                await queue.put(f'\n#### OUTPUT END ####\n\nKilled Timeout {timeout}s\nJob TIMEOUT')
+                if adaptive_deadline is not None and loop.time() >= adaptive_deadline:
+                    adaptive_deadline = None
+                    if job_options.adaptive_timeout_action == 'warn':
+                        self._py_logger.warning('任务运行时长超过自适应超时%.1fs shot_id:%s', adaptive_limit, shot_id)
+                        await queue.put(f'\n#### RUNNING LONGER THAN ADAPTIVE TIMEOUT {adaptive_limit:.1f}s ####\n')
+                        adaptive_flagged = True
+                        continue
+                    self._py_logger.error('任务运行时长超过自适应超时%.1fs shot_id:%s', adaptive_limit, shot_id)
+                    await self._flush_output_capture(queue, capture, default_encoding, decoder)
+                    await queue.put(f'\n#### OUTPUT END ####\n\n'
+                                    f'Killed Adaptive Timeout {adaptive_limit:.1f}s\nJob TIMEOUT')
+                else:
+                    self._py_logger.error('等待stdout %ss超时 shot_id:%s', timeout, shot_id)
+                    await self._flush_output_capture(queue, capture, default_encoding, decoder)
+                    await queue.put(f'\n#### OUTPUT END ####\n\nKilled Timeout {timeout}s\nJob TIMEOUT')
                 await queue.put(logger.LogStop)
                 proc.kill()
                 self._py_logger.error('任务超时 killed shot_id:%s', shot_id)
                 state_proc = worker.JobStateEnum.KILLED
+                try:
+                    # 等待子进程被回收 以便记录资源占用
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    self._py_logger.warning('超时任务回收超时 shot_id:%s', shot_id)
+                break
+            except (ValueError, asyncio.LimitOverrunError) as e:
+                # 读取输出失败 停止任务并结束日志记录
+                self._py_logger.error('读取输出失败 shot_id:%s %r', shot_id, e)
+                await self._flush_output_capture(queue, capture, default_encoding, decoder)
+                await queue.put(f'\n#### OUTPUT END ####\n\nRead Failed: {e!r}\nJob FAILED')
+                await queue.put(logger.LogStop)
+                proc.kill()
+                state_proc = worker.JobStateEnum.ERROR
+                try:
+                    await asyncio.wait_for(proc.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    self._py_logger.warning('读取输出失败的任务回收超时 shot_id:%s', shot_id)
                 break
         end = datetime.datetime.now()
-        await self._core.set_job_done(worker.JobState(uuid, state_proc, shot_id, str(now), str(end)))
+        if uuid in self._durations and state_proc in (worker.JobStateEnum.DONE, worker.JobStateEnum.WARN):
+            self._durations[uuid].add((end - now).total_seconds())
+        usage = getattr(proc, 'usage', None)
+        await self._set_job_done(job_state._replace(state=state_proc, date_end=str(end),
+                                                    usage=usage, metrics=metrics or None),
+                                 name, job_type)
         self._running_jobs.pop(shot_id)
-        return shot_id, state_proc
+        output_tail = b''.join(tail_lines).decode(default_encoding, errors='replace') if tail_lines else ''
+        return worker.JobDoneContext(uuid, shot_id, name, state_proc, job_type, proc.returncode, str(now), str(end),
+                                     (end - now).total_seconds(), usage, metrics or None, output_tail,
+                                     str(log_path), run_id, shard)
+
+    async def adopt_orphan(self, record: storage.LogRecord, name: str) -> bool:
+        if record.shot_id in self._running_jobs:
+            return True
+        if os.name != 'posix' or record.pid is None or record.proc_start is None:
+            return False
+        if _process_start_id(record.pid) != record.proc_start:
+            return False
+        proc = AdoptedProcess(record.pid, record.pgid or record.pid, record.proc_start)
+        # 打开pidfd之后再确认一次 避免检查和打开之间pid被复用
+        if _process_start_id(record.pid) != record.proc_start:
+            proc.close()
+            return False
+        job_state = worker.JobState(record.uuid, worker.JobStateEnum.RUNNING, record.shot_id, record.date_start,
+                                    run_id=record.run_id, shard=record.shard, pid=record.pid, pgid=record.pgid,
+                                    proc_start=record.proc_start)
+        self._running_jobs[record.shot_id] = (record.uuid, proc, job_state)
+        self._py_logger.warning('发现CronWeb重启前启动的子进程仍在运行 %s pid:%s shot_id:%s',
+                                '停止' if self.orphan_policy == 'kill' else '接管', record.pid, record.shot_id)
+        asyncio.ensure_future(self._watch_orphan(record, name, proc, job_state))
+        if self.orphan_policy == 'kill':
+            asyncio.ensure_future(self._kill_shots([record.shot_id]))
+        return True
+
+    async def _watch_orphan(self, record: storage.LogRecord, name: str, proc: AdoptedProcess,
+                            job_state: worker.JobState):
+        """等待被接管的子进程结束 记录运行状态 退出码未知时状态为UNKNOWN."""
+        try:
+            await proc.wait()
+        finally:
+            self._running_jobs.pop(record.shot_id, None)
+        if record.shot_id in self._killed_shot_id:
+            self._killed_shot_id.remove(record.shot_id)
+            state = worker.JobStateEnum.KILLED
+        else:
+            state = worker.JobStateEnum.UNKNOWN
+        end = datetime.datetime.now()
+        # 通过logger追加到原来的日志末尾 与正常结束的日志一样压缩 建立索引或写入分段文件
+        queue, _ = self._core.get_log_queue(record.uuid, record.shot_id, 60, log_path=record.log_path)
+        await queue.put(f'\n#### CRONWEB RESTARTED ####\n\nProcess {record.pid} adopted, exited at {end}'
+                        f'\nJob {state.name}')
+        await queue.put(logger.LogStop)
+        # 原来的触发方式未知 不发送webhook和hook
+        await self._core.set_job_done(job_state._replace(state=state, date_end=str(end)))
+        self._py_logger.info('被接管的子进程已结束 pid:%s shot_id:%s %s', record.pid, record.shot_id, state.name)
+
+    async def _set_job_done(self, shot_state: worker.JobState, name: str, job_type: worker.JobTypeEnum):
+        """记录运行结果 开启webhook时同时写入webhook待投递队列."""
+        payload = self._webhook_payload(name, shot_state.shot_id, shot_state.state, job_type)
+        await self._core.set_job_done(shot_state, payload)
+        if payload is not None:
+            self._webhook_wakeup.set()
 
     async def shoot(self, command: str, param: str, uuid: str, timeout: float, name: str,
-                    job_type: worker.JobTypeEnum) -> None:
-        is_retry = False
-        shot_id_root: typing.Optional[str] = None
-        hook_futures: typing.List[asyncio.Future] = []
-        hook_timeout = 30
-        for count_shoot in range(self.times_retry + 1):
-            if is_retry:
-                wait_seconds = ((2 ** count_shoot) - 1) * self.wait_retry_base
-                self._py_logger.debug('等待%s秒后开始第%s次重试 共%s次重试',
-                                      wait_seconds, count_shoot, self.times_retry)
-                job_type = worker.JobTypeEnum.RETRY
-                await asyncio.sleep(wait_seconds)
-            shot_id, state = await self._shoot(command, param, uuid, timeout, job_type)
-
-            # 优先webhook
-            if self.webhook_url:
-                hook_futures.append(
-                    self._hook_thread.run_coroutine(
-                        self._webhook_job_done(name, shot_id, state, job_type),
-                        timeout=hook_timeout
-                    )
-                )
-            # 其后本地hook 为避免影响重试机制使用task交给loop执行
-            for func in self._job_done_hooks:
-                hook_futures.append(
-                    self._hook_thread.run_coroutine(func(name, shot_id, state, job_type), timeout=hook_timeout)
-                )
+                    job_type: worker.JobTypeEnum,
+                    options: typing.Optional[typing.Dict[str, typing.Any]] = None,
+                    attempt: int = 0, shot_id_root: typing.Optional[str] = None,
+                    run_id: typing.Optional[str] = None) -> None:
+        job_options = worker.JobOptions.from_dict(options)
+        if job_options.shard_params() is not None:
+            return await self._shoot_shards(command, param, uuid, timeout, name, job_type, job_options,
+                                            attempt, shot_id_root, run_id)
+        context = await self._shoot(command, param, uuid, timeout, name, job_type, job_options)
 
-            if state.name != 'ERROR':
-                break
-            elif not is_retry:
-                self._py_logger.warning('初次运行失败 启动重试 shot_id: %s', shot_id)
-                is_retry = True
-                shot_id_root = shot_id
-                self._waiting_for_retry.add(shot_id_root)
-        # 不管是运行成功 重试后成功 还是超出重试次数 都要检查
-        if shot_id_root and shot_id_root in self._waiting_for_retry:
-            self._py_logger.warning('移除等待重试集合 shot_id: %s', shot_id_root)
-            self._waiting_for_retry.remove(shot_id_root)
+        # 重试写入storage 由controller按时间调度 重启后不会丢失
+        if context.state.name == 'ERROR' and attempt < self.times_retry:
+            if attempt == 0:
+                self._py_logger.warning('初次运行失败 启动重试 shot_id: %s', context.shot_id)
+            await self._schedule_retry(uuid, shot_id_root or context.shot_id, attempt)
 
+        await self._submit_job_done_hooks(context)
+        return None
+
+    async def _schedule_retry(self, uuid: str, shot_id_root: str, attempt: int,
+                              run_id: typing.Optional[str] = None):
+        wait_seconds = ((2 ** (attempt + 1)) - 1) * self.wait_retry_base
+        self._py_logger.debug('等待%s秒后开始第%s次重试 共%s次重试',
+                              wait_seconds, attempt + 1, self.times_retry)
+        try:
+            await self._core.retry_schedule(uuid, shot_id_root, attempt + 1, wait_seconds, run_id)
+        except Exception as e:
+            self._py_logger.error('重试安排失败 shot_id: %s', shot_id_root)
+            self._py_logger.exception(e)
+
+    async def _submit_job_done_hooks(self, context: worker.JobDoneContext):
+        # webhook已经在运行记录更新时写入待投递队列 由投递循环发送
+        # 本地hook交给hook executor执行 不等待执行结果 所有hook共用同一个上下文
+        for func in self._job_done_hooks:
+            if func in self._context_hooks:
+                await self._hook_executor.submit(func, (context,))
+            else:
+                await self._hook_executor.submit(func, (context.name, context.shot_id, context.state,
+                                                        context.job_type))
+
+    @staticmethod
+    def _shard_param(param: str, shard: str) -> str:
+        """param中包含{shard}时替换为分片参数 否则分片参数作为param."""
+        return param.replace('{shard}', shard) if '{shard}' in param else shard
+
+    async def _shoot_shards(self, command: str, param: str, uuid: str, timeout: float, name: str,
+                            job_type: worker.JobTypeEnum, job_options: worker.JobOptions,
+                            attempt: int, shot_id_root: typing.Optional[str], run_id: typing.Optional[str]) -> None:
+        """分片任务 每个分片作为一次独立的运行 同时运行的分片数量不超过shard_concurrency
+        run_id不为None时为重试 只重新运行上次运行中失败的分片
+        shot_id_root为第一次运行中第一个失败分片的shot_id
+        """
+        shards = job_options.shard_params()
+        if run_id is not None:
+            shards = await self._core.run_resume(run_id, shards)
+        if shards is None or run_id is None:
+            shards = job_options.shard_params()
+            run_id = await self._core.run_start(uuid, len(shards))
+        self._py_logger.info('分片任务开始 run_id:%s 分片数:%s', run_id, len(shards))
+        semaphore = asyncio.Semaphore(job_options.shard_concurrency)
+
+        async def shoot_shard(shard: str) -> worker.JobDoneContext:
+            async with semaphore:
+                context = await self._shoot(command, self._shard_param(param, shard), uuid, timeout, name,
+                                            job_type, job_options, run_id=run_id, shard=shard)
+            await self._submit_job_done_hooks(context)
+            return context
+
+        contexts = await asyncio.gather(*(shoot_shard(shard) for shard in shards))
+        state = await self._core.run_finish(run_id)
+        if shot_id_root is None:
+            shot_id_root = next((context.shot_id for context in contexts
+                                 if context.state.name not in ('DONE', 'WARN')), None)
+        if state.name == 'ERROR' and attempt < self.times_retry and shot_id_root is not None:
+            self._py_logger.warning('分片任务存在失败的分片 启动重试 run_id: %s', run_id)
+            await self._schedule_retry(uuid, shot_id_root, attempt, run_id)
         return None
 
     def _webhook_sign(self, payload: bytes) -> str:
@@ -225,11 +1795,30 @@ class AioSubprocessWorker(worker.WorkerBase):
         sign = base64.b64encode(sign_bytes).decode()
         return sign
 
-    async def _webhook_job_done(self, name: str, shot_id: str, state: worker.JobStateEnum,
-                                job_type: worker.JobTypeEnum) -> None:
+    def _get_webhook_session(self) -> aiohttp.ClientSession:
+        """获取webhook使用的长连接session 必须在hook事件循环线程中调用."""
+        session: typing.Optional[aiohttp.ClientSession] = getattr(self._webhook_local, 'session', None)
+        if session is None or session.closed:
+            self._py_logger.debug('创建webhook session')
+            connector = aiohttp.TCPConnector(limit=self.webhook_limit,
+                                             limit_per_host=self.webhook_limit_per_host,
+                                             keepalive_timeout=self.webhook_keepalive)
+            session = aiohttp.ClientSession(connector=connector, timeout=self.webhook_timeout)
+            self._webhook_local.session = session
+        return session
+
+    async def _close_webhook_session(self):
+        session: typing.Optional[aiohttp.ClientSession] = getattr(self._webhook_local, 'session', None)
+        if session is not None and not session.closed:
+            self._py_logger.debug('关闭webhook session')
+            await session.close()
+        self._webhook_local.session = None
+
+    def _webhook_payload(self, name: str, shot_id: str, state: worker.JobStateEnum,
+                         job_type: worker.JobTypeEnum) -> typing.Optional[str]:
+        """生成任务结束事件 未开启webhook时返回None."""
         if not self.webhook_url:
             return None
-        self._py_logger.info('触发任务结束webhook')
         payload_dict = {
             'name': name,
             'shot_id': shot_id,
@@ -237,24 +1826,109 @@ class AioSubprocessWorker(worker.WorkerBase):
             'job_type': job_type.name,
             'timestamp': int(datetime.datetime.now().timestamp() * 1000)
         }
-        payload = json.dumps(payload_dict, ensure_ascii=False).encode('utf8')
-        sign = self._webhook_sign(payload)
+        return json.dumps(payload_dict, ensure_ascii=False)
+
+    async def _webhook_post(self, payload: bytes, count: int = 1) -> bool:
+        """发送webhook请求 必须在hook事件循环线程中执行
+        成功时返回True 接收方返回非2xx状态码时抛出异常
+        """
+        self._py_logger.info('发送webhook 事件数:%s', count)
+        timestamp = int(datetime.datetime.now().timestamp() * 1000)
         headers = {
             'Accept': 'application/json',
             'User-Agent': 'CronWeb/Webhook',
             'Content-Type': 'application/json; charset=UTF-8',
-            'X-Cronweb-Token': sign,
-            'X-Cronweb-Timestamp': f'{payload_dict["timestamp"]}'
+            'X-Cronweb-Token': self._webhook_sign(payload),
+            'X-Cronweb-Timestamp': f'{timestamp}'
         }
+        session = self._get_webhook_session()
+        async with session.post(self.webhook_url, data=payload, headers=headers) as resp:
+            # 读取完响应后连接才会回到连接池
+            await resp.read()
+            resp.raise_for_status()
+        self._py_logger.info('webhook结束')
+        return True
 
-        async with aiohttp.ClientSession(timeout=self.webhook_timeout) as session:
+    async def _webhook_deliver_loop(self):
+        """从待投递队列中取出到达投递时间的事件并发送
+        有新事件写入时立即唤醒 否则按poll_interval检查重试的事件
+        """
+        self._py_logger.info('webhook投递循环启动')
+        while True:
+            self._webhook_wakeup.clear()
+            limit = max(self.webhook_batch_size, 1) * self.webhook_limit_per_host
             try:
-                resp = await session.post(self.webhook_url, data=payload, headers=headers)
-                resp.close()
+                count = await self._webhook_deliver_due(limit)
             except Exception as e:
-                self._py_logger.error('webhook调用失败')
+                self._py_logger.error('webhook投递循环出错')
                 self._py_logger.exception(e)
-        self._py_logger.info('webhook结束')
+                count = 0
+            if count >= limit:
+                # 可能还有到达投递时间的事件
+                continue
+            try:
+                await asyncio.wait_for(self._webhook_wakeup.wait(), timeout=self.webhook_poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _webhook_deliver_due(self, limit: int) -> int:
+        events = await self._core.webhook_outbox_get_due(limit)
+        if not events:
+            return 0
+        if self.webhook_batch_size > 1:
+            groups = [events[i:i + self.webhook_batch_size] for i in range(0, len(events), self.webhook_batch_size)]
+        else:
+            groups = [[event] for event in events]
+        # 并发数受webhook_limit_per_host限制
+        await asyncio.gather(*(self._webhook_deliver_group(group) for group in groups))
+        return len(events)
+
+    async def _webhook_deliver_group(self, events: typing.List[storage.OutboxEvent]):
+        if self.webhook_batch_size > 1:
+            body = '{"events": [' + ', '.join(event.payload for event in events) + ']}'
+        else:
+            body = events[0].payload
+        event_ids = [event.id for event in events]
+        try:
+            result = await self._hook_executor.run_coroutine(
+                self._webhook_post(body.encode('utf8'), len(events)),
+                timeout=self.webhook_timeout.total
+            )
+            if result is not True:
+                raise asyncio.TimeoutError('webhook timeout')
+        except Exception as e:
+            self._py_logger.error('webhook投递失败 事件数:%s', len(events))
+            self._py_logger.exception(e)
+            self._webhook_stats['failed'] += len(events)
+            attempts = min(event.attempts for event in events) + 1
+            if self.webhook_max_attempts and attempts >= self.webhook_max_attempts:
+                self._py_logger.error('webhook超过最大尝试次数 丢弃事件 shot_id:%s',
+                                      [event.shot_id for event in events])
+                self._webhook_stats['dropped'] += len(events)
+                await self._core.webhook_outbox_done(event_ids)
+                return
+            wait_seconds = min(self.webhook_retry_base * 2 ** (attempts - 1), self.webhook_retry_max)
+            await self._core.webhook_outbox_retry(event_ids, time.time() + wait_seconds, repr(e))
+            return
+        await self._core.webhook_outbox_done(event_ids)
+        self._webhook_stats['delivered'] += len(events)
+        self._webhook_stats['last_lag'] = time.time() - min(event.date_create for event in events)
+
+    async def start(self):
+        self._hook_executor.start()
+        if self.webhook_url and self._webhook_task is None:
+            self._webhook_task = asyncio.ensure_future(self._webhook_deliver_loop())
+
+    def add_job_done_hook(self, func: typing.Callable[..., typing.Awaitable[None]]):
+        super().add_job_done_hook(func)
+        self._hook_executor.register(func)
+
+    def add_job_done_context_hook(self, func: typing.Callable[[worker.JobDoneContext], typing.Awaitable[None]]):
+        super().add_job_done_context_hook(func)
+        self._hook_executor.register(func)
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        return {'webhook': dict(self._webhook_stats), 'hooks': self._hook_executor.get_stats()}
 
     def get_running_jobs(self) -> typing.Dict[str, typing.Tuple[str, str]]:
         """返回worker中正在运行任务的所有信息
@@ -271,13 +1945,7 @@ class AioSubprocessWorker(worker.WorkerBase):
         {shot_id: uuid}
         """
         self._py_logger.info('停止worker中所有正在运行任务')
-        success_dict = {}
-        for key, job in self._running_jobs.items():
-            try:
-                await self.kill_by_shot_id(key)
-                success_dict[key] = job[0]
-            except Exception as e:
-                self._py_logger.exception(e)
+        success_dict = await self._kill_shots(list(self._running_jobs))
         self._py_logger.info('已停止%s个正在运行的任务', len(success_dict))
         return success_dict
 
@@ -285,18 +1953,51 @@ class AioSubprocessWorker(worker.WorkerBase):
         self._py_logger.info('停止worker中正在运行任务 shot_id:%s', shot_id)
         if shot_id not in self:
             return None
-        job = self._running_jobs[shot_id]
-        self._killed_shot_id.add(shot_id)
-        job[1].terminate()
-        try:
-            await asyncio.wait_for(job[1].wait(), timeout=5)
-        except asyncio.TimeoutError:
-            self._py_logger.warning('子进程正常中止超时 尝试强制停止')
-            job[1].kill()
+        await self._kill_shots([shot_id])
         return shot_id
 
+    async def _kill_shots(self, shot_ids: typing.List[str]) -> typing.Dict[str, str]:
+        """同时向所有任务发送SIGTERM 共用kill_timeout的等待时间 超时未退出的任务发送SIGKILL
+        返回{shot_id: uuid}
+        """
+        jobs = {shot_id: self._running_jobs[shot_id] for shot_id in shot_ids if shot_id in self._running_jobs}
+        waiters: typing.Dict[asyncio.Future, str] = {}
+        for shot_id, (uuid, proc, _) in jobs.items():
+            self._killed_shot_id.add(shot_id)
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+            except Exception as e:
+                self._py_logger.error('停止任务失败 shot_id:%s', shot_id)
+                self._py_logger.exception(e)
+            waiters[asyncio.ensure_future(proc.wait())] = shot_id
+        if not waiters:
+            return {}
+        _, pending = await asyncio.wait(waiters, timeout=self.kill_timeout)
+        if pending:
+            self._py_logger.warning('%s个子进程正常中止超时 尝试强制停止', len(pending))
+            for waiter in pending:
+                try:
+                    jobs[waiters[waiter]][1].kill()
+                except ProcessLookupError:
+                    pass
+            _, pending = await asyncio.wait(pending, timeout=self.kill_timeout)
+            for waiter in pending:
+                self._py_logger.error('子进程强制停止超时 shot_id:%s', waiters[waiter])
+                waiter.cancel()
+        return {shot_id: job[0] for shot_id, job in jobs.items()}
+
     def stop(self):
-        self._hook_thread.stop()
+        if self._webhook_task is not None:
+            self._webhook_task.cancel()
+            self._webhook_task = None
+        self._hook_executor.run_on_all_threads(self._close_webhook_session, timeout=5)
+        self._hook_executor.stop()
+        if self._http_session is not None and not self._http_session.closed:
+            # 所有任务已经停止 关闭连接不需要等待
+            asyncio.ensure_future(self._http_session.close())
+            self._http_session = None
 
     def __contains__(self, shot_id: str) -> bool:
         return shot_id in self._running_jobs
@@ -0,0 +1,217 @@
+import asyncio
+import hmac
+import locale
+import logging
+import signal
+import typing
+from uuid import uuid4
+
+import cronweb
+import worker
+from worker.worker_aiosubprocess import AioSubprocessWorker, ReapedProcess
+
+
+class AgentUnavailableError(ConnectionError):
+    """没有满足job标签且有空闲容量的agent."""
+
+
+class RemoteProcess:
+    """在远程agent上运行的子进程
+    接口与ReapedProcess保持一致 输出和退出码由agent通过连接发回
+    """
+
+    def __init__(self, agent: 'AgentConnection', task_id: str):
+        self.agent = agent
+        self.task_id = task_id
+        self.pid: typing.Optional[int] = None
+        self.stdout = asyncio.StreamReader()
+        self.returncode: typing.Optional[int] = None
+        self.usage: typing.Optional[worker.ShotUsage] = None
+        self._waiter: asyncio.Future = asyncio.get_event_loop().create_future()
+        self._encoding = locale.getpreferredencoding()
+
+    def feed_output(self, data: str):
+        if self.returncode is None:
+            self.stdout.feed_data(data.encode(self._encoding, errors='replace'))
+
+    def set_done(self, exit_code: int, usage: typing.Optional[worker.ShotUsage] = None):
+        if self.returncode is not None:
+            return
+        self.returncode = exit_code
+        self.usage = usage
+        self.stdout.feed_eof()
+        self._waiter.set_result(exit_code)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._waiter)
+
+    def send_signal(self, sig: int):
+        if self.returncode is None:
+            self.agent.send_nowait({'type': 'signal', 'task_id': self.task_id, 'signal': int(sig)})
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+
+class AgentConnection:
+    """一个已连接的远程agent."""
+
+    def __init__(self, connection: typing.Any, name: str, labels: typing.Iterable[str], capacity: int):
+        self.id = uuid4().hex
+        self.name = name
+        self.labels: typing.FrozenSet[str] = frozenset(labels)
+        self.capacity = capacity
+        self.processes: typing.Dict[str, RemoteProcess] = {}
+        self._connection = connection
+        self._send_lock = asyncio.Lock()
+        self._py_logger = logging.getLogger('cronweb.worker.AgentConnection')
+
+    @property
+    def load(self) -> float:
+        return len(self.processes) / self.capacity
+
+    def accept(self, labels: typing.Optional[typing.Iterable[str]]) -> bool:
+        """是否拥有全部标签且有空闲容量."""
+        return len(self.processes) < self.capacity and self.labels.issuperset(labels or ())
+
+    async def send(self, message: typing.Dict[str, typing.Any]):
+        async with self._send_lock:
+            await self._connection.send_json(message)
+
+    def send_nowait(self, message: typing.Dict[str, typing.Any]):
+        def callback(ta: asyncio.Task):
+            err = ta.exception()
+            if err:
+                self._py_logger.error('发送消息到agent失败 %s', self.name)
+                self._py_logger.exception(err)
+
+        asyncio.ensure_future(self.send(message)).add_done_callback(callback)
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        return {'id': self.id, 'name': self.name, 'labels': sorted(self.labels),
+                'capacity': self.capacity, 'running': len(self.processes)}
+
+
+class RemoteWorker(AioSubprocessWorker):
+    """在本机或远程agent上运行job
+    job options中设置了labels的job分发给拥有全部标签且负载最低的agent 其余job在本机运行
+    agent通过websocket连接到CronWeb(见agent.py) 使用agent_token验证 agent_token为空时不接受agent连接
+    """
+
+    def __init__(self, controller: typing.Optional[cronweb.CronWeb] = None,
+                 agent_token: str = '',
+                 agent_hello_timeout: float = 10,
+                 agent_wait: float = 60,
+                 **kwargs):
+        super().__init__(controller, **kwargs)
+        self.agent_token = agent_token.encode('utf8')
+        self.agent_hello_timeout = agent_hello_timeout
+        # 没有空闲agent时最多等待的时间
+        self.agent_wait = agent_wait
+        self._agents: typing.Dict[str, AgentConnection] = {}
+        # agent连接或任务结束时通知等待空闲agent的任务
+        self._agent_idle = asyncio.Condition()
+
+    async def create_process(self, command: str, param: str, uuid: str,
+                             job_options: worker.JobOptions
+                             ) -> typing.Union[RemoteProcess, ReapedProcess, asyncio.subprocess.Process]:
+        if job_options.labels is None:
+            return await super().create_process(command, param, uuid, job_options)
+        agent = await self._select_agent(job_options.labels)
+        proc = RemoteProcess(agent, uuid4().hex)
+        agent.processes[proc.task_id] = proc
+        try:
+            await agent.send({'type': 'shoot', 'task_id': proc.task_id, 'uuid': uuid,
+                              'command': command, 'param': param, 'options': job_options._asdict()})
+        except Exception as e:
+            agent.processes.pop(proc.task_id, None)
+            raise AgentUnavailableError(f'send to agent {agent.name} failed: {e!r}') from e
+        self._py_logger.info('任务分发到agent %s uuid:%s task_id:%s', agent.name, uuid, proc.task_id)
+        return proc
+
+    async def _select_agent(self, labels: typing.List[str]) -> AgentConnection:
+        """选择拥有全部标签且负载最低的agent 没有空闲agent时最多等待agent_wait秒."""
+
+        def candidates() -> typing.List[AgentConnection]:
+            return [agent for agent in self._agents.values() if agent.accept(labels)]
+
+        async with self._agent_idle:
+            try:
+                await asyncio.wait_for(self._agent_idle.wait_for(candidates), self.agent_wait)
+            except asyncio.TimeoutError:
+                raise AgentUnavailableError(f'no agent available for labels {sorted(labels)}') from None
+            return min(candidates(), key=lambda a: a.load)
+
+    async def _notify_agent_idle(self):
+        async with self._agent_idle:
+            self._agent_idle.notify_all()
+
+    async def _agent_hello(self, connection: typing.Any) -> typing.Optional[AgentConnection]:
+        try:
+            hello = await asyncio.wait_for(connection.receive_json(), self.agent_hello_timeout)
+        except asyncio.TimeoutError:
+            self._py_logger.warning('agent未在%ss内发送hello', self.agent_hello_timeout)
+            return None
+        if not isinstance(hello, dict) or hello.get('type') != 'hello':
+            self._py_logger.warning('agent首个消息不是hello')
+            return None
+        token = str(hello.get('token', '')).encode('utf8')
+        if not self.agent_token or not hmac.compare_digest(token, self.agent_token):
+            self._py_logger.warning('agent验证失败 %s', hello.get('name'))
+            await connection.send_json({'type': 'error', 'message': 'invalid token'})
+            return None
+        labels = hello.get('labels') or []
+        capacity = hello.get('capacity', 1)
+        if not isinstance(labels, list) or not isinstance(capacity, int) or capacity <= 0:
+            await connection.send_json({'type': 'error', 'message': 'invalid labels or capacity'})
+            return None
+        return AgentConnection(connection, str(hello.get('name') or 'agent'), map(str, labels), capacity)
+
+    def _agent_message(self, agent: AgentConnection, message: typing.Dict[str, typing.Any]) -> bool:
+        """处理agent发回的输出和运行结果 任务结束时返回True."""
+        proc = agent.processes.get(message.get('task_id'))
+        if proc is None:
+            self._py_logger.debug('未知task_id的agent消息 %s', message.get('task_id'))
+            return False
+        if message.get('type') == 'output':
+            proc.feed_output(message.get('data', ''))
+        elif message.get('type') == 'done':
+            usage = message.get('usage')
+            agent.processes.pop(proc.task_id)
+            proc.set_done(int(message.get('exit_code', -1)), worker.ShotUsage(**usage) if usage else None)
+            return True
+        return False
+
+    async def serve_agent(self, connection: typing.Any) -> None:
+        agent = await self._agent_hello(connection)
+        if agent is None:
+            return
+        self._agents[agent.id] = agent
+        self._py_logger.info('agent已连接 %s labels:%s capacity:%s', agent.name, sorted(agent.labels), agent.capacity)
+        try:
+            await agent.send({'type': 'welcome', 'id': agent.id})
+            await self._notify_agent_idle()
+            while True:
+                message = await connection.receive_json()
+                if isinstance(message, dict) and self._agent_message(agent, message):
+                    await self._notify_agent_idle()
+        except Exception as e:
+            self._py_logger.info('agent连接断开 %s %r', agent.name, e)
+        finally:
+            self._agents.pop(agent.id, None)
+            # agent断开后无法得知运行结果 视为运行失败 由重试机制处理
+            for proc in list(agent.processes.values()):
+                proc.feed_output(f'\nagent {agent.name} disconnected\n')
+                proc.set_done(-1)
+            agent.processes.clear()
+
+    def get_agents(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        return [agent.to_dict() for agent in self._agents.values()]
+
+    def get_stats(self) -> typing.Dict[str, typing.Any]:
+        stats = super().get_stats()
+        stats['agents'] = self.get_agents()
+        return stats